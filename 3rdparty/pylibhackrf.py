@@ -66,6 +66,10 @@ HackRfError = enum(
     # Python defaults to returning none
     HACKRF_ERROR=None)
 
+HackRfSweepStyle = enum(
+    LINEAR=0,
+    INTERLEAVED=1)
+
 HackRfTranscieverMode = enum(
     HACKRF_TRANSCEIVER_MODE_OFF=0,
     HACKRF_TRANSCEIVER_MODE_RECEIVE=1,
@@ -193,6 +197,14 @@ libhackrf.hackrf_version_string_read.argtypes = [POINTER(hackrf_device), POINTER
 libhackrf.hackrf_set_freq.restype = c_int
 libhackrf.hackrf_set_freq.argtypes = [POINTER(hackrf_device), c_uint64]
 
+# extern ADDAPI int ADDCALL hackrf_init_sweep(hackrf_device* device,
+#         const uint16_t* frequency_list, const int num_ranges,
+#         const uint32_t num_bytes, const uint32_t step_width,
+#         const uint32_t offset, const enum sweep_style style);
+libhackrf.hackrf_init_sweep.restype = c_int
+libhackrf.hackrf_init_sweep.argtypes = [POINTER(hackrf_device),
+    POINTER(c_uint16), c_int, c_uint32, c_uint32, c_uint32, c_int]
+
 # extern ADDAPI int ADDCALL hackrf_set_freq_explicit(hackrf_device* device,
 #         const uint64_t if_freq_hz, const uint64_t lo_freq_hz,
 #         const enum rf_path_filter path);,
@@ -261,6 +273,28 @@ libhackrf.hackrf_compute_baseband_filter_bw_round_down_lt.argtypes = [c_uint32]
 libhackrf.hackrf_compute_baseband_filter_bw.restype = c_uint32
 libhackrf.hackrf_compute_baseband_filter_bw.argtypes = [c_uint32]
 
+class hackrf_device_list(Structure):
+        _fields_ = [("serial_numbers", POINTER(c_char_p)),
+                ("usb_board_ids", POINTER(c_int)),
+                ("usb_device_index", POINTER(c_int)),
+                ("devicecount", c_int),
+                ("usb_devices", POINTER(c_void_p)),
+                ("usb_devicecount", c_int) ]
+
+# extern ADDAPI hackrf_device_list_t* ADDCALL hackrf_device_list();
+libhackrf.hackrf_device_list.restype = POINTER(hackrf_device_list)
+libhackrf.hackrf_device_list.argtypes = []
+
+# extern ADDAPI void ADDCALL hackrf_device_list_free(hackrf_device_list_t *list);
+libhackrf.hackrf_device_list_free.restype = None
+libhackrf.hackrf_device_list_free.argtypes = [POINTER(hackrf_device_list)]
+
+# extern ADDAPI int ADDCALL hackrf_open_by_serial(
+#         const char* const desired_serial_number, hackrf_device** device);
+libhackrf.hackrf_open_by_serial.restype = c_int
+libhackrf.hackrf_open_by_serial.argtypes = [c_char_p,
+    POINTER(POINTER(hackrf_device))]
+
 class HackRf(object):
     __JELLYBEAN__ = 'Jellybean'
     __JAWBREAKER__ = 'Jawbreaker'
@@ -276,10 +310,26 @@ class HackRf(object):
         if self.is_open == True:
             self.exit()
 
-    def setup(self):
+    def setup(self, serial=None):
         libhackrf.hackrf_init()
+        if serial:
+            return self.open_by_serial(serial)
         return self.open()
 
+    def device_serials(self):
+        ''' Serial numbers of the attached HackRFs (call setup first) '''
+        serials = []
+        devlist = libhackrf.hackrf_device_list()
+        if not devlist:
+            return serials
+
+        for i in range(devlist.contents.devicecount):
+            serial = devlist.contents.serial_numbers[i]
+            if serial:  # old firmware does not report one
+                serials.append(serial.decode('utf-8'))
+        libhackrf.hackrf_device_list_free(devlist)
+        return serials
+
     def exit(self):
         ret = self.close()
         libhackrf.hackrf_exit()
@@ -294,6 +344,16 @@ class HackRf(object):
         else:
             logger.error('No Hack Rf Detected!')
 
+    def open_by_serial(self, serial):
+        ret = libhackrf.hackrf_open_by_serial(serial.encode('utf-8'),
+                self.device)
+        if ret == HackRfError.HACKRF_SUCCESS:
+            self.is_open = True
+            logger.debug('Successfully open HackRf device %s', serial)
+            return HackRfError.HACKRF_SUCCESS
+        else:
+            logger.error('No Hack Rf with serial %s', serial)
+
     def close(self):
         ret = libhackrf.hackrf_close(self.device)
         if ret == HackRfError.HACKRF_SUCCESS:
@@ -365,6 +425,20 @@ class HackRf(object):
         else:
             logger.error('Error setting frequency with value [%d]', freq_hz)
 
+    def init_sweep(self, ranges, num_bytes, step_width, offset,
+            style=HackRfSweepStyle.INTERLEAVED):
+        ''' Program the firmware sweep: ranges is [(low_mhz, high_mhz), ...],
+        num_bytes is the dwell per tuning (a multiple of 16384) '''
+        frequencies = (c_uint16 * (2 * len(ranges)))(
+                *[freq for rng in ranges for freq in rng])
+        ret = libhackrf.hackrf_init_sweep(self.device, frequencies,
+                len(ranges), num_bytes, step_width, offset, style)
+        if ret == HackRfError.HACKRF_SUCCESS:
+            logger.debug('Successfully initialized sweep')
+            return HackRfError.HACKRF_SUCCESS
+        else:
+            logger.error('Failed to initialize sweep')
+
     def is_streaming(self):
         ret = libhackrf.hackrf_is_streaming(self.device)
         if(ret == 1):
@@ -35,6 +35,7 @@ PSEUDO_DEVNUM_BASE = 9000
 REQ_MESSAGE = 4
 SYSTEM_MODS    = ['connector', 'devices', 'location', 'spectrum']
 VERSION_STRING = "ΓRF, Copyright 2018 (gammarf |at| covert.codes)"
+WATERFALL_SECONDS = 60
 
 MODPATH        = 'modules'
 MOD_PREFIX     = 'gammarf_'
@@ -93,7 +94,7 @@ class GrfState():
         system_mods['spectrum'] = core_manager.spectrum(config,
                 system_mods['devices'])
 
-        if system_mods['devices'].hackrf():
+        if system_mods['devices'].spectrum():
             while not system_mods['spectrum'].is_freqmap_ready():
                 gammarf_util.console_message("waiting for freqmap to populate...")
                 time.sleep(2)
@@ -101,6 +102,13 @@ class GrfState():
         system_mods['connector'] = core_manager.connector(config,
                 system_mods)
 
+        # read the freqmap from shared memory rather than through the proxy
+        if system_mods['devices'].spectrum():
+            shm_name = system_mods['spectrum'].shm_name()
+            if shm_name:
+                system_mods['spectrum'] = spectrum_mod.SpectrumView(
+                        system_mods['spectrum'], shm_name)
+
         for sysmod in system_mods:
             modcmds = system_mods[sysmod].commands()
             if not modcmds:
@@ -163,7 +171,7 @@ def startup_tasks(grfstate):
 
     jobs = []
 
-    if devmod.hackrf():
+    if devmod.spectrum():
         try:
             virtlist = config['startup']['startup_virtual']
         except KeyError:
@@ -274,6 +282,7 @@ def cmdloop(grfstate):
     gammarf_util.console_message("Type 'quit' to quit", showdt=False)
 
     # system commands
+    commands['band'] = cmd_band
     commands['help'] = cmd_help
     commands['interesting'] = cmd_interesting
     commands['interesting_add'] = cmd_interesting_add
@@ -286,7 +295,10 @@ def cmdloop(grfstate):
     commands['quit'] = cmd_quit
     commands['run'] = cmd_run
     commands['settings'] = cmd_settings
+    commands['spectrum_stats'] = cmd_spectrum_stats
     commands['stations'] = cmd_stations
+    commands['sweeprate'] = cmd_sweeprate
+    commands['waterfall'] = cmd_waterfall
 
     stationid = config['connector']['station_id']
     cmdprompt = '{} ΓRF> '.format(stationid)
@@ -328,6 +340,42 @@ def cmdloop(grfstate):
         else:
             gammarf_util.console_message("bad command.  Type 'help'.")
 
+def cmd_band_usage():
+    gammarf_util.console_message("usage: > band lowfreq highfreq")
+
+def cmd_band(grfstate, args):
+    """Show the max and mean power between two frequencies"""
+
+    system_mods = grfstate.system_mods
+
+    if not args or len(args.split()) != 2:
+        cmd_band_usage()
+        return
+
+    lowfreq, highfreq = [gammarf_util.str_to_hz(freq)
+            for freq in args.split()]
+    if not lowfreq or not highfreq or highfreq < lowfreq:
+        cmd_band_usage()
+        return
+
+    if not system_mods['devices'].spectrum():
+        gammarf_util.console_message("no hackrf installed")
+        return
+
+    try:
+        band = system_mods['spectrum'].band_power(lowfreq, highfreq)
+    except Exception as e:
+        gammarf_util.console_message("could not get band power: {}"
+                .format(e))
+        return
+
+    if not band:
+        gammarf_util.console_message("no spectrum data in that band")
+        return
+
+    gammarf_util.console_message("max {:.2f} dB, mean {:.2f} dB"
+            .format(*band))
+
 def cmd_help(commands):
     """Show system help"""
 
@@ -560,7 +608,7 @@ def cmd_run(grfstate, args):
         return
 
     if devtype == 'hackrf':
-        if not devmod.hackrf():
+        if not devmod.spectrum():
             gammarf_util.console_message("no hackrf installed")
             return
 
@@ -612,6 +660,33 @@ def cmd_settings(grfstate, args):
                     .format(module))
             return
 
+def cmd_spectrum_stats(grfstate, args):
+    """Show spectrum pipeline counters and timings"""
+
+    system_mods = grfstate.system_mods
+    if not system_mods['devices'].spectrum():
+        gammarf_util.console_message("no hackrf installed")
+        return
+
+    stats = system_mods['spectrum'].pipeline_stats()
+    gammarf_util.console_message("{} sweeps ({:.2f}/s), {} records, "\
+            "{} dropped".format(stats['sweeps'], stats['sweep_rate'],
+                stats['records'], stats['dropped']))
+    gammarf_util.console_message("{:.1f} MB read ({:.2f} MB/s), {} freqmap "\
+            "reads ({:.1f}/s)".format(stats['bytes_read'] / 1e6,
+                stats['byte_rate'] / 1e6, stats['reads'], stats['read_rate']))
+
+    for name, label in (('sweep_time', 'sweep duration'),
+            ('parse_time', 'parse per record'),
+            ('publish_time', 'publish per sweep'),
+            ('stale_age', 'oldest data at sweep')):
+        hist = stats[name]
+        gammarf_util.console_message("{:20s} n {:8d}  mean {:9.3g}  "\
+                "p50 {:9.3g}  p90 {:9.3g}  p99 {:9.3g}  max {:9.3g} {}"
+                .format(label, hist['n'], hist['mean'], hist['p50'],
+                    hist['p90'], hist['p99'], hist['max'], hist['unit']),
+                showdt=False)
+
 def cmd_stations(grfstate, args):
     """Show stations associated with the cluster"""
 
@@ -620,6 +695,85 @@ def cmd_stations(grfstate, args):
     return
 
 
+def cmd_sweeprate(grfstate, args):
+    """Show the spectrum sweep rate (sweeps/s) and feed health"""
+
+    system_mods = grfstate.system_mods
+    if not system_mods['devices'].spectrum():
+        gammarf_util.console_message("no hackrf installed")
+        return
+
+    spectrum = system_mods['spectrum']
+    status = spectrum.feed_status()
+    gammarf_util.console_message("{:.2f} sweeps/s, feed {}"
+            .format(spectrum.sweep_rate(),
+                "DOWN" if status['stale'] else "up"))
+    gammarf_util.console_message("{} outages, {} restarts, {:.1f}s down, "\
+            "{:.3%} uptime".format(status['outages'], status['restarts'],
+                status['downtime'], status['uptime']))
+    if status['last_error']:
+        gammarf_util.console_message("last error: {}"
+                .format(status['last_error']))
+
+
+def cmd_waterfall_usage():
+    gammarf_util.console_message("usage: > waterfall lowfreq highfreq "\
+            "[seconds] [outfile]; freqs are integers or rtl_power format")
+
+def cmd_waterfall(grfstate, args):
+    """Show / dump spectrum history: > waterfall lowfreq highfreq [secs] [file]"""
+
+    system_mods = grfstate.system_mods
+
+    if not args:
+        cmd_waterfall_usage()
+        return
+
+    parsed = args.split()
+    if len(parsed) < 2 or len(parsed) > 4:
+        cmd_waterfall_usage()
+        return
+
+    lowfreq = gammarf_util.str_to_hz(parsed[0])
+    highfreq = gammarf_util.str_to_hz(parsed[1])
+    if not lowfreq or not highfreq or highfreq < lowfreq:
+        cmd_waterfall_usage()
+        return
+
+    try:
+        seconds = float(parsed[2]) if len(parsed) > 2 else WATERFALL_SECONDS
+    except ValueError:
+        cmd_waterfall_usage()
+        return
+
+    if not system_mods['devices'].spectrum():
+        gammarf_util.console_message("no hackrf installed")
+        return
+
+    if len(parsed) == 4:
+        rows = system_mods['spectrum'].dump_history(lowfreq, highfreq,
+                seconds, parsed[3])
+        if rows is None:
+            gammarf_util.console_message("no history available")
+        else:
+            gammarf_util.console_message("wrote {} sweeps to {}"
+                    .format(rows, parsed[3]))
+        return
+
+    window = system_mods['spectrum'].history(lowfreq, highfreq, seconds)
+    if not window:
+        gammarf_util.console_message("no history available")
+        return
+
+    times, freqs, pwrs = window
+    for ts, row in zip(times, pwrs):
+        peak = row.argmax()
+        gammarf_util.console_message("{}  max {:7.2f} at {:11d}  mean {:7.2f}"
+                .format(datetime.datetime.utcfromtimestamp(ts)
+                    .strftime("%H:%M:%S"), row[peak], freqs[peak],
+                    row.mean()), showdt=False)
+
+
 class GrfCompleter(Completer):
     def __init__(self, grfstate):
         self.command_list = list(grfstate.commands)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# CFAR emitter detection
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+try:
+    from scipy import ndimage
+except ImportError:  # OS-CFAR needs scipy, CA-CFAR does not
+    ndimage = None
+
+CFAR_METHODS = ('ca', 'os')
+DEFAULT_CFAR_GUARD = 4  # bins each side of the cell under test
+DEFAULT_CFAR_MAX_EMITTERS = 256
+DEFAULT_CFAR_METHOD = 'ca'
+DEFAULT_CFAR_MIN_BINS = 1
+DEFAULT_CFAR_THRESHOLD = 10.0  # dB above the local floor
+DEFAULT_CFAR_TRAIN = 16  # bins each side, beyond the guard
+EMITTER_DTYPE = np.dtype([('freq', np.int64), ('bw', np.int64),
+    ('pwr', np.float32), ('snr', np.float32)])
+OS_PERCENTILE = 75  # training cell rank used as the OS-CFAR floor
+
+
+class CfarDetector():
+    """Find emitters in a sweep against a sliding noise-floor estimate
+
+    Works on the dB values hackrf_sweep reports (log-domain CFAR).  The
+    floor under each bin is the mean (CA) or an order statistic (OS) of
+    the training cells either side of it, skipping the guard cells, and
+    never reaching into a neighbouring segment of the freqmap.
+    Contiguous bins above floor + threshold form one emitter.
+    """
+
+    def __init__(self, segments, method=DEFAULT_CFAR_METHOD,
+            guard=DEFAULT_CFAR_GUARD, train=DEFAULT_CFAR_TRAIN,
+            threshold=DEFAULT_CFAR_THRESHOLD, min_bins=DEFAULT_CFAR_MIN_BINS,
+            max_emitters=DEFAULT_CFAR_MAX_EMITTERS):
+
+        if method not in CFAR_METHODS:
+            raise Exception("invalid cfar method: {}".format(method))
+        if method == 'os' and not ndimage:
+            raise Exception("OS-CFAR requires scipy")
+
+        bins = int(segments['bins'].sum())
+        self.segments = segments.copy()
+        self.bins = bins
+        self.method = method
+        self.threshold = threshold
+        self.min_bins = min_bins
+        self.max_emitters = max_emitters
+
+        if method == 'ca':
+            # training window bounds, clipped at the segment edges
+            idx = np.arange(bins, dtype=np.int64)
+            lo = np.repeat(segments['offset'], segments['bins'])
+            hi = lo + np.repeat(segments['bins'], segments['bins'])
+            self.lead_lo = np.clip(idx - guard - train, lo, hi)
+            self.lead_hi = np.clip(idx - guard, lo, hi)
+            self.lag_lo = np.clip(idx + guard + 1, lo, hi)
+            self.lag_hi = np.clip(idx + guard + train + 1, lo, hi)
+            cells = (self.lead_hi - self.lead_lo)\
+                    + (self.lag_hi - self.lag_lo)
+            self.cells = np.maximum(cells, 1).astype(np.float64)
+
+            self.csum = np.zeros(bins + 1, dtype=np.float64)
+            self.gather = np.empty(bins, dtype=np.float64)
+        else:
+            self.footprint = np.ones(2 * (guard + train) + 1, dtype=bool)
+            self.footprint[train:train + 2 * guard + 1] = False
+
+        self.floor = np.empty(bins, dtype=np.float64)
+        self.edges = np.zeros(bins + 2, dtype=np.int8)
+
+    def noise_floor(self, pwrs):
+        if self.method == 'os':
+            ndimage.percentile_filter(pwrs, OS_PERCENTILE,
+                    footprint=self.footprint, mode='nearest',
+                    output=self.floor)
+            return self.floor
+
+        np.cumsum(pwrs, out=self.csum[1:])
+        floor, gather = self.floor, self.gather
+        np.take(self.csum, self.lead_hi, out=floor)
+        floor -= np.take(self.csum, self.lead_lo, out=gather)
+        floor += np.take(self.csum, self.lag_hi, out=gather)
+        floor -= np.take(self.csum, self.lag_lo, out=gather)
+        floor /= self.cells
+        return floor
+
+    def detect(self, pwrs):
+        """Return the sweep's emitters (EMITTER_DTYPE), strongest first"""
+
+        floor = self.noise_floor(pwrs)
+
+        hits = self.edges[1:-1]
+        np.greater(pwrs, floor + self.threshold, out=hits.view(bool))
+        changes = np.flatnonzero(np.diff(self.edges))
+        hitbins = np.flatnonzero(hits)
+
+        # runs end at segment edges too
+        cuts = self.segments['offset'][1:]
+        cuts = cuts[(hits[cuts] != 0) & (hits[cuts - 1] != 0)]
+        hits[:] = 0
+        if not len(changes):
+            return np.empty(0, dtype=EMITTER_DTYPE)
+
+        starts, ends = changes[0::2], changes[1::2]
+        if len(cuts):
+            starts = np.sort(np.concatenate((starts, cuts)))
+            ends = np.sort(np.concatenate((ends, cuts)))
+
+        # reduce each run of hit bins, packed end to end
+        widths = ends - starts
+        packed = np.cumsum(widths) - widths
+
+        hitpwrs = pwrs[hitbins]
+        linear = np.power(10.0, hitpwrs / 10.0)
+        centroid = np.add.reduceat(linear * hitbins, packed)\
+                / np.add.reduceat(linear, packed)
+        peak = np.maximum.reduceat(hitpwrs, packed)
+        noise = np.add.reduceat(floor[hitbins], packed) / widths
+
+        keep = widths >= self.min_bins
+        segment = self.segments[np.searchsorted(self.segments['offset'],
+            starts[keep], 'right') - 1]
+
+        emitters = np.empty(np.count_nonzero(keep), dtype=EMITTER_DTYPE)
+        emitters['freq'] = np.rint(segment['minfreq'] + (centroid[keep]
+            - segment['offset']) * segment['step'])
+        emitters['bw'] = widths[keep] * segment['step']
+        emitters['pwr'] = peak[keep]
+        emitters['snr'] = peak[keep] - noise[keep]
+
+        order = np.argsort(emitters['snr'])[::-1][:self.max_emitters]
+        return emitters[order]
@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# pipelined command channel
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+import zmq
+
+import gammarf_util
+
+CMD_TIMEOUT = 5  # s, unless the request gives its own
+MOD_NAME = "commands"
+POLL_INT = 500  # ms, at most, between checks for a stop request
+
+
+def resolved(resp):
+    """A Future already holding resp"""
+
+    future = Future()
+    future.set_result(resp)
+    return future
+
+
+class CommandChannel(threading.Thread):
+    """Requests to the server's command port, many in flight at once
+
+    One thread owns a DEALER socket; request() queues a message and
+    returns a Future at once, resolved with the reply, or with an error
+    reply ({'reply': 'error', 'error': ...}) once its timeout passes,
+    like the blocking requests always returned.  Each message goes out
+    with an empty delimiter frame, as from a REQ socket, and a 'reqid'
+    the server echoes to match replies.  Until a reply has echoed one,
+    requests go one at a time, as they did over REQ, and one that times
+    out gets the socket replaced, as a REQ socket had to be, so the next
+    request is not stuck behind a reply that may never come.  (As with
+    REQ, a server that routes by identity may still hand a reply later
+    than its timeout to the new socket.)
+    """
+
+    def __init__(self, stationid, addr):
+        threading.Thread.__init__(self)
+        self.stoprequest = threading.Event()
+
+        self.stationid = stationid
+        self.addr = addr
+
+        self.outq = deque()  # (data, future, deadline), from any thread
+        self.pending = OrderedDict()  # reqid: (future, deadline)
+        self.reqids = itertools.count(1)
+        self.echoes = False  # the server echoes reqid, so we may pipeline
+        self.reopen = True
+
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_w, False)
+
+    def request(self, data, timeout=CMD_TIMEOUT):
+        """Future for the reply to data"""
+
+        future = Future()
+        self.outq.append((data, future, time.time() + timeout))
+        self.wake()
+        return future
+
+    def reconnect(self):
+        """Open a new socket; what is in flight fails with 'reconnect'"""
+
+        self.reopen = True
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wake_w, b'\0')
+        except BlockingIOError:  # already woken
+            pass
+
+    def open_socket(self, context, poller, sock):
+        if sock:
+            poller.unregister(sock)
+            sock.close()
+
+        for future, deadline in self.pending.values():
+            if not future.done():
+                future.set_result({'reply': 'error', 'error': 'reconnect'})
+        self.pending.clear()
+        self.echoes = False  # maybe another server, until it shows us
+
+        sock = context.socket(zmq.DEALER)
+        sock.setsockopt_string(zmq.IDENTITY, self.stationid)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.connect(self.addr)
+        poller.register(sock, zmq.POLLIN)
+        return sock
+
+    def receive(self, sock):
+        while True:
+            try:
+                frames = sock.recv_multipart(zmq.NOBLOCK)
+            except zmq.Again:
+                return
+
+            try:
+                resp = json.loads(frames[-1].decode('utf-8'))
+                reqid = resp.get('reqid')
+            except Exception as e:
+                continue
+
+            if reqid is None:  # the one request outstanding, if any
+                if self.echoes or not self.pending:
+                    continue
+                reqid = next(iter(self.pending))
+            else:
+                self.echoes = True
+            entry = self.pending.pop(reqid, None)
+            if entry and not entry[0].done():
+                entry[0].set_result(resp)
+
+    def transmit(self, sock):
+        while self.outq:
+            if self.pending and not self.echoes:  # one at a time
+                return
+
+            data, future, deadline = self.outq.popleft()
+            if future.done():  # timed out waiting its turn
+                continue
+
+            reqid = next(self.reqids)
+            data['reqid'] = reqid
+
+            try:
+                sock.send_multipart([b'', json.dumps(data).encode('utf-8')],
+                        zmq.NOBLOCK)
+            except Exception as e:
+                future.set_result({'reply': 'error', 'error': 'txerror'})
+                continue
+
+            self.pending[reqid] = (future, deadline)
+
+    def expire(self, now):
+        """Time out requests; seconds until the next deadline, if any"""
+
+        waiting = [(future, deadline) for data, future, deadline
+                in list(self.outq)]  # held back, one at a time
+        for reqid, (future, deadline) in list(self.pending.items()):
+            if deadline > now:
+                waiting.append((future, deadline))
+                continue
+
+            del self.pending[reqid]  # a late reply has no one to answer
+            future.set_result({'reply': 'error', 'error': 'noresp'})
+            if not self.echoes:  # its late reply would answer the next
+                self.reopen = True
+        if self.reopen:
+            return 0
+
+        wait = None
+        for future, deadline in waiting:
+            if future.done():
+                continue
+            if deadline <= now:
+                future.set_result({'reply': 'error', 'error': 'noresp'})
+            else:
+                left = deadline - now
+                wait = left if wait is None else min(wait, left)
+        return wait
+
+    def run(self):
+        context = zmq.Context.instance()
+        poller = zmq.Poller()
+        poller.register(self.wake_r, zmq.POLLIN)
+        sock = None
+
+        while not self.stoprequest.isSet():
+            if self.reopen:
+                self.reopen = False
+                sock = self.open_socket(context, poller, sock)
+
+            self.transmit(sock)
+            wait = self.expire(time.time())
+            timeout = POLL_INT if wait is None\
+                    else min(POLL_INT, int(wait * 1000) + 1)
+
+            events = dict(poller.poll(timeout))
+            if self.wake_r in events:
+                os.read(self.wake_r, 4096)
+            if sock in events:
+                self.receive(sock)
+
+        if sock:
+            sock.close()
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        self.wake()
+        super(CommandChannel, self).join(timeout)
+
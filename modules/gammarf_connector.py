@@ -17,23 +17,32 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
 import datetime
+import itertools
 import json
 import time
 import threading
 import urllib3
 import zmq
-import queue
+from collections import deque
 from hashlib import md5
 from multiprocessing import Pipe
 from uuid import uuid4
 
 import gammarf_util
 from gammarf_base import GrfModuleBase
-
-CMD_POLL_TIMEOUT = 1500  # ms
-CMD_ATTEMPTS = 2
-CMD_ATTEMPT_FAIL_SLEEP = 2
+from gammarf_commands import CMD_TIMEOUT, CommandChannel, resolved
+from gammarf_spool import DEFAULT_SPOOL_BUDGET, Spool
+from gammarf_wire import AUTH_VERSION, WIRE_VERSION, auth_frame,\
+        derive_key, encode_batch, has_layout
+
+BATCH_BYTES = int(256e3)  # flush a batch frame at this size...
+BATCH_MAX = 200  # ...or this many records...
+BATCH_VERSION = 1  # json lists of records, offered in the heartbeat
+BATCH_WAIT = 0.05  # ...or this long (s) after the last flush
+DEFAULT_SPOOL_RATE = 500  # records/s replayed from the spool
+ENCODINGS = ('auto', 'json')
 HEARTBEAT_INT = 10
 LOOP_SLEEP = 0.5
 MOD_NAME = "connector"
@@ -43,12 +52,227 @@ REQ_HEARTBEAT = 0
 REQ_INTERESTING_ADD = 11
 REQ_INTERESTING_DEL = 12
 REQ_INTERESTING_GET = 1
+TICKET_TTL = 30  # s to keep a reply nobody came back for
 ZMQ_HWM = 0
 
 
 def start(config, system_mods):
     return GrfModuleConnector(config, system_mods)
 
+def sign_message(data, station_pass):
+    data['rand'] = str(uuid4())[:8]
+    m = md5()
+    m.update((station_pass + data['rand'] + str(data['dt']))
+            .encode('utf-8'))
+    data['sign'] = m.hexdigest()[:12]
+
+
+class DataSender(threading.Thread):
+    """Sign and send queued data messages, off the producers' threads
+
+    Producers append to a deque (atomic, so no lock) and return; this
+    thread owns the data socket and drains the deque whenever the
+    connector is up.  Each record is its own JSON object, as before,
+    unless the server has accepted batches: then records are sent as
+    one JSON list per frame, up to batch_max records or BATCH_BYTES, at
+    least every BATCH_WAIT seconds.  Once the server has accepted the
+    binary wire format, the records of modules with a wire layout go in
+    a binary frame instead.
+    Records are md5 signed one by one, or once the server has accepted
+    batch authentication, not at all: each message is sent behind an
+    auth frame holding one HMAC over it all.  A message with a binary
+    payload goes out alone, as [json, payload], in its place in the
+    stream.  When the deque is full, the oldest messages are dropped.
+
+    With a spool, messages are moved from the deque to disk while the
+    connector is down, and once connected, replayed from there at up to
+    spool_rate records/s; new messages are sent directly meanwhile, so
+    the backlog does not hold them up (or grow with them).
+    """
+
+    def __init__(self, worker, batch_max=BATCH_MAX, spool=None,
+            spool_rate=DEFAULT_SPOOL_RATE):
+        threading.Thread.__init__(self)
+        self.stoprequest = threading.Event()
+        self.wake = threading.Event()
+
+        self.worker = worker
+        self.batch_max = batch_max
+
+        self.auth = False  # batch authentication, for this drain
+        self.lists = False  # and json batches
+        self.key = derive_key(worker.station_pass, worker.stationid)
+        self.epoch = int(time.time())
+        self.seq = 0
+        self.datq = deque(maxlen=QUEUE_MAX)
+        self.spool = spool
+        self.spool_rate = spool_rate
+
+        self.datsock = None
+        self.generation = None  # of the connection datsock was opened on
+
+        self.batches = 0
+        self.dropped = 0
+        self.lost = 0  # sockets failed or replaced, maybe losing sends
+        self.sent = 0
+
+    def put(self, item):
+        if len(self.datq) == QUEUE_MAX:
+            self.dropped += 1
+        self.datq.append(item)
+        if len(self.datq) >= self.batch_max:
+            self.wake.set()
+
+    def losses(self):
+        """Messages dropped, queued or spooled, plus socket losses"""
+
+        spooled = self.spool.dropped if self.spool else 0
+        return self.dropped + self.lost + spooled
+
+    def open_socket(self):
+        if self.datsock:  # no linger: what it still held is gone
+            self.datsock.close()
+            self.lost += 1
+
+        self.datsock = zmq.Context.instance().socket(zmq.PUSH)
+        self.datsock.setsockopt(zmq.LINGER, 0)
+        self.datsock.set_hwm(ZMQ_HWM)
+        self.datsock.connect("tcp://{}:{}"
+                .format(self.worker.server_host, self.worker.dat_port))
+        self.generation = self.worker.generation
+
+    def sign(self, data):
+        if not self.auth:
+            sign_message(data, self.worker.station_pass)
+
+    def send(self, frames):
+        if self.auth:
+            self.seq += 1
+            frames = [auth_frame(self.key, self.worker.stationid,
+                self.epoch, self.seq, time.time(), frames)] + frames
+        self.datsock.send_multipart(frames, zmq.NOBLOCK)
+
+    def flush(self, batch, records):
+        if records:
+            # station and location of the newest record go for them all
+            context = {'dt': int(time.time()), 'rand': '', 'sign': ''}
+            context.update((field, records[-1][field]) for field in
+                    ('lat', 'lng', 'alt', 'epx', 'epy', 'epv'))
+            self.sign(context)
+            try:
+                frame = encode_batch(records, self.worker.stationid,
+                        context)
+            except (KeyError, TypeError, ValueError):  # won't pack
+                for data in records:
+                    self.sign(data)
+                    batch.append(json.dumps(data))
+            else:
+                self.send([frame])
+                self.batches += 1
+                self.sent += len(records)
+
+        if not batch:
+            return
+
+        if self.lists:
+            self.send([('[' + ','.join(batch) + ']').encode('utf-8')])
+            self.batches += 1
+            self.sent += len(batch)
+            return
+
+        for record in batch:  # one (signed) record per frame
+            self.send([record.encode('utf-8')])
+            self.batches += 1
+            self.sent += 1
+
+    def popped(self):
+        while self.datq:
+            yield self.datq.popleft()
+
+    def drain(self, items):
+        wire = self.worker.wire
+        self.auth = self.worker.auth
+        self.lists = self.worker.batch
+        json_max = self.batch_max if self.lists else 1
+        batch, records = [], []  # json, and binary (unencoded)
+        size = 0
+        for data, payload in items:
+            if wire and payload is None and has_layout(data):
+                records.append(data)
+            else:
+                self.sign(data)
+                record = json.dumps(data)
+
+                if payload is not None:
+                    if batch or records:
+                        self.flush(batch, records)
+                        batch, records, size = [], [], 0
+                    self.send([record.encode('utf-8'), payload])
+                    self.sent += 1
+                    continue
+
+                batch.append(record)
+                size += len(record)
+
+            if len(batch) >= json_max\
+                    or len(batch) + len(records) >= self.batch_max\
+                    or size >= BATCH_BYTES:
+                self.flush(batch, records)
+                batch, records, size = [], [], 0
+
+        if batch or records:
+            self.flush(batch, records)
+
+    def spool_queued(self):
+        for data, payload in self.popped():
+            self.spool.append(data, payload)
+
+    def replay(self, elapsed):
+        items = self.spool.read(max(1, int(min(elapsed, 1)
+            * self.spool_rate)))
+        self.drain(items)
+        self.spool.commit()
+
+    def run(self):
+        replayed = time.time()
+        while not self.stoprequest.isSet():
+            self.wake.wait(BATCH_WAIT)
+            self.wake.clear()
+
+            if not self.worker.connected:
+                if self.spool:
+                    self.spool_queued()
+                continue
+
+            try:
+                if self.generation != self.worker.generation:
+                    self.open_socket()
+
+                now = time.time()
+                if self.spool and not self.spool.empty():
+                    self.replay(now - replayed)
+                replayed = now
+
+                if self.datq:
+                    self.drain(self.popped())
+            except Exception as e:
+                # with no hwm, sends only fail with the socket; what was
+                # popped is lost, the rest waits for the next connection
+                if self.spool:
+                    self.spool.rewind()
+                self.lost += 1
+                self.worker.connected = False
+
+        if self.datsock:
+            self.datsock.close()
+        if self.spool:  # what is still queued survives the restart
+            self.spool_queued()
+            self.spool.close()
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(DataSender, self).join(timeout)
+
 
 class ConnectorWorker(threading.Thread):
     def __init__(self, opts, system_mods):
@@ -60,24 +284,40 @@ class ConnectorWorker(threading.Thread):
         self.server_host = opts['server_host']
         self.dat_port = opts['dat_port']
         self.cmd_port = opts['cmd_port']
+        self.encoding = opts['encoding']
 
-        self.datq = queue.Queue(maxsize=QUEUE_MAX)
+        self.connected = False
+        self.wire = False  # server takes the binary wire format
+        self.auth = False  # and batch authentication
+        self.batch = False  # and json lists of records
+        self.generation = 0  # bumped on each (re)connect
+        spool = None
+        if opts['spool_dir']:
+            spool = Spool(opts['spool_dir'], opts['spool_budget'])
+        self.sender = DataSender(self, opts['batch_max'], spool,
+                opts['spool_rate'])
+        self.sender.daemon = True
+
+        self.commands = CommandChannel(self.stationid, "tcp://{}:{}"
+                .format(self.server_host, self.cmd_port))
+        self.commands.daemon = True
+        self.tickets = {}  # ticket: (future, deadline), of sendcmd_submit
+        self.ticket_ids = itertools.count(1)
+        self.tickets_lock = threading.Lock()
 
         self.gps_worker = system_mods['location']
         self.devmod = system_mods['devices']
 
-        self.cmdlock = threading.Lock()
-
     def run(self):
         self.connected = False
         self.connect_message = None
-        self.poller = None
         announce_reconnects = True
         connect_attempted = False
         lost_connection = False
         since_heartbeat = None
 
-        context = zmq.Context()
+        self.sender.start()
+        self.commands.start()
 
         while not self.stoprequest.isSet():
             self.loc = self.gps_worker.get_current()
@@ -109,13 +349,6 @@ class ConnectorWorker(threading.Thread):
                                         "attempting to reconnect to server",
                                         MOD_NAME)
 
-                        try:
-                            self.cmdsock.close()
-                            self.datsock.close()
-                            self.poller.unregister(self.cmdsock)
-                        except:
-                            pass
-
                 else:
                     gammarf_util.console_message("connecting to server",
                             MOD_NAME)
@@ -123,28 +356,7 @@ class ConnectorWorker(threading.Thread):
 
                 if try_connect:
                     connect_attempted = datetime.datetime.utcnow()
-
-                    try:
-                        self.datsock = context.socket(zmq.PUSH)
-                        self.datsock.setsockopt(zmq.LINGER, 0)
-                        self.datsock.set_hwm(ZMQ_HWM)
-                        self.datsock.connect("tcp://{}:{}"
-                                .format(self.server_host, self.dat_port))
-
-                        self.cmdsock = context.socket(zmq.REQ)
-                        self.cmdsock.setsockopt_string(zmq.IDENTITY,
-                                self.stationid)
-                        self.cmdsock.setsockopt(zmq.LINGER, 0)
-                        self.cmdsock.set_hwm(ZMQ_HWM)
-                        self.cmdsock.connect("tcp://{}:{}"
-                                .format(self.server_host, self.cmd_port))
-
-                        self.poller = zmq.Poller()
-                        self.poller.register(self.cmdsock, zmq.POLLIN)
-                    except Exception as e:
-                        self.connect_message = "error connecting: {}".format(e)
-                        self.connected = False
-                        try_connect = False
+                    self.commands.reconnect()
 
             if since_heartbeat:
                 elapsed = datetime.datetime.utcnow() - since_heartbeat
@@ -164,13 +376,14 @@ class ConnectorWorker(threading.Thread):
                         for job in self.devmod.running()\
                                 if job != self.devmod.get_hackrf_job()])
                 data['gpsstat'] = self.gps_worker.get_status()
+                if self.encoding == 'auto':  # offer binary data frames
+                    data['wire'] = WIRE_VERSION
+                data['auth'] = AUTH_VERSION  # offer batch authentication
+                if self.sender.batch_max > 1:  # offer json lists
+                    data['batch'] = BATCH_VERSION
 
                 data['dt'] = int(time.time())
-                data['rand'] = str(uuid4())[:8]
-                m = md5()
-                m.update((self.station_pass + data['rand'] + str(data['dt']))
-                        .encode('utf-8'))
-                data['sign'] = m.hexdigest()[:12]
+                sign_message(data, self.station_pass)
 
                 resp = self.sendcmd(data)
                 try:
@@ -179,7 +392,13 @@ class ConnectorWorker(threading.Thread):
                     self.connected = False
                 else:
                     if reply == 'ok':
+                        if not self.connected:
+                            self.generation += 1
                         self.connected = True
+                        self.wire = self.encoding == 'auto'\
+                                and resp.get('wire') == WIRE_VERSION
+                        self.auth = resp.get('auth') == AUTH_VERSION
+                        self.batch = resp.get('batch') == BATCH_VERSION
                         since_heartbeat = datetime.datetime.utcnow()
 
                         if lost_connection:
@@ -211,82 +430,63 @@ class ConnectorWorker(threading.Thread):
 
             time.sleep(LOOP_SLEEP)
 
-    def senddat(self, data):
+    def senddat(self, data, payload=None):
+        # copied, so callers may reuse data; signed by the sender
+        data = dict(data)
         data['stationid'] = self.stationid
         data['dt'] = int(time.time())
         data.update(self.loc)
-        data['rand'] = str(uuid4())[:8]
-        m = md5()
-        m.update((self.station_pass + data['rand'] + str(data['dt']))
-                .encode('utf-8'))
-        data['sign'] = m.hexdigest()[:12]
 
-        self.datq.put(data)
+        # a binary payload rides as a second frame after the json
+        self.sender.put((data, payload))
 
-        if not self.connected:
-            return
+    def sendcmd(self, data, timeout=CMD_TIMEOUT):
+        return self.sendcmd_async(data, timeout).result()
 
-        while not self.datq.empty():
-            try:
-                self.datsock.send_string(json.dumps(self.datq.get()), zmq.NOBLOCK)
-            except Exception as e:
-                return
-
-    def sendcmd(self, data):
-        with self.cmdlock:
-            if not self.connected and data['request'] != REQ_HEARTBEAT:
-                return {'reply': 'error', 'error': 'not_connected'}
-
-            data['stationid'] = self.stationid
-            data.update(self.loc)
-            data['dt'] = int(time.time())
-            data['rand'] = str(uuid4())[:8]
-            m = md5()
-            m.update((self.station_pass + data['rand'] + str(data['dt']))
-                    .encode('utf-8'))
-            data['sign'] = m.hexdigest()[:12]
-
-            for i in range(CMD_ATTEMPTS):
-                try:
-                    self.cmdsock.send_string(json.dumps(data), zmq.NOBLOCK)
-                    break
+    def sendcmd_async(self, data, timeout=CMD_TIMEOUT):
+        if not self.connected and data['request'] != REQ_HEARTBEAT:
+            return resolved({'reply': 'error', 'error': 'not_connected'})
 
-                except Exception as e:
-                    if i == CMD_ATTEMPTS - 1:
-                        self.connected = False
-                        self.connect_message = "error sending to command socket: "\
-                                "{}".format(e)
+        data = dict(data)
+        data['stationid'] = self.stationid
+        data.update(self.loc)
+        data['dt'] = int(time.time())
+        sign_message(data, self.station_pass)
 
-                        return {'reply': 'error', 'error': 'txerror'}
+        return self.commands.request(data, timeout)
 
-                    time.sleep(CMD_ATTEMPT_FAIL_SLEEP)
-                    continue
+    def sendcmd_submit(self, data, timeout=CMD_TIMEOUT):
+        now = time.time()
+        future = self.sendcmd_async(data, timeout)
 
-            for i in range(CMD_ATTEMPTS):
-                l = dict(self.poller.poll(CMD_POLL_TIMEOUT))
-                if l.get(self.cmdsock) == zmq.POLLIN:
-                    try:
-                        resp = json.loads(self.cmdsock.recv_string())
-                        return resp
+        with self.tickets_lock:  # forget replies nobody came back for
+            for ticket, (done, deadline) in list(self.tickets.items()):
+                if done.done() and deadline + TICKET_TTL <= now:
+                    del self.tickets[ticket]
 
-                    except Exception as e:
-                        if i == CMD_ATTEMPTS - 1:
-                            self.connected = False
-                            self.connect_message = "error receiving from "\
-                                    "command socket: {}".format(e)
+            ticket = next(self.ticket_ids)
+            self.tickets[ticket] = (future, now + timeout)
+        return ticket
 
-                            return {'reply': 'error', 'error': 'rxerror'}
+    def sendcmd_result(self, ticket, timeout=0):
+        with self.tickets_lock:
+            entry = self.tickets.get(ticket)
+        if not entry:
+            return {'reply': 'error', 'error': 'unknown_ticket'}
 
-                else:
-                    if i == CMD_ATTEMPTS - 1:
-                        self.connected = False
-                        return {'reply': 'error', 'error': 'noresp'}
+        try:
+            resp = entry[0].result(timeout)
+        except concurrent.futures.TimeoutError:
+            return
 
-                    time.sleep(CMD_ATTEMPT_FAIL_SLEEP)
-                    continue
+        with self.tickets_lock:
+            self.tickets.pop(ticket, None)
+        return resp
 
     def join(self, timeout=None):
         self.stoprequest.set()
+        self.sender.join(timeout)
+        self.commands.join(timeout)
         super(ConnectorWorker, self).join(timeout)
 
 
@@ -327,6 +527,31 @@ class GrfModuleConnector(GrfModuleBase):
                     "defined in config")
         cmd_port = int(cmd_port)
 
+        batch_max = BATCH_MAX
+        if 'batch_max' in config['connector']:
+            batch_max = int(config['connector']['batch_max'])
+            if batch_max < 1:
+                raise Exception("param 'batch_max' must be at least 1")
+
+        encoding = 'auto'
+        if 'encoding' in config['connector']:
+            encoding = config['connector']['encoding']
+            if encoding not in ENCODINGS:
+                raise Exception("param 'encoding' must be one of: {}"
+                        .format(', '.join(ENCODINGS)))
+
+        spool_dir = None
+        if 'spool_dir' in config['connector']:
+            spool_dir = config['connector']['spool_dir']
+
+        spool_budget = DEFAULT_SPOOL_BUDGET
+        if 'spool_budget' in config['connector']:
+            spool_budget = int(config['connector']['spool_budget'])
+
+        spool_rate = DEFAULT_SPOOL_RATE
+        if 'spool_rate' in config['connector']:
+            spool_rate = int(config['connector']['spool_rate'])
+
         try:
             self.server_host = config['connector']['server_host']
         except KeyError:
@@ -359,7 +584,12 @@ class GrfModuleConnector(GrfModuleBase):
                 'station_pass': station_pass,
                 'server_host': server_host,
                 'dat_port': dat_port,
-                'cmd_port': cmd_port}
+                'cmd_port': cmd_port,
+                'batch_max': batch_max,
+                'encoding': encoding,
+                'spool_budget': spool_budget * int(1e6),
+                'spool_dir': spool_dir,
+                'spool_rate': spool_rate}
 
 
         self.worker = ConnectorWorker(opts, system_mods)
@@ -405,11 +635,26 @@ class GrfModuleConnector(GrfModuleBase):
             return True
         return
 
-    def senddat(self, data):
-        self.worker.senddat(data)
+    def senddat(self, data, payload=None):
+        self.worker.senddat(data, payload)
+
+    def losses(self):
+        """Count of data messages (or sockets holding them) lost so far;
+        a change means something senddat took may not have arrived"""
+        return self.worker.sender.losses()
+
+    def sendcmd(self, data, timeout=CMD_TIMEOUT):
+        return self.worker.sendcmd(data, timeout)
+
+    def sendcmd_submit(self, data, timeout=CMD_TIMEOUT):
+        """Send a command without waiting; returns a ticket (an int) to
+        pass to sendcmd_result"""
+        return self.worker.sendcmd_submit(data, timeout)
 
-    def sendcmd(self, data):
-        return self.worker.sendcmd(data)
+    def sendcmd_result(self, ticket, timeout=0):
+        """Reply to a sendcmd_submit, as sendcmd would return it; None
+        if it has not come in within timeout seconds (0 just polls)"""
+        return self.worker.sendcmd_result(ticket, timeout)
 
     def stations_pretty(self):
         url = self.server_url + "/util/locations"
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# per-bin spectrum detectors
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+DEFAULT_AVERAGE_SWEEPS = 10
+DEFAULT_EXP_ALPHA = 0.2
+DEFAULT_HOLD_DECAY = 0.5  # dB per sweep
+DETECTORS = ('peak', 'min', 'average', 'exp')
+RESUM_SWEEPS = 1000  # rebuild the running sum, float error accumulates
+
+
+class SweepDetectors():
+    """Spectrum analyzer style detectors over successive sweeps
+
+    peak: max hold, falling hold_decay dB per sweep toward new sweeps
+    min: min hold, rising hold_decay dB per sweep
+    average: mean linear power over the last average_sweeps sweeps
+    exp: exponentially weighted linear power, exp_alpha for the newest
+
+    Only the configured detectors are kept.  Every update is a handful
+    of in-place array operations over the whole sweep.  Averages are
+    kept in linear power (mW) and converted to dB when read.
+    """
+
+    def __init__(self, bins, modes, hold_decay=DEFAULT_HOLD_DECAY,
+            average_sweeps=DEFAULT_AVERAGE_SWEEPS,
+            exp_alpha=DEFAULT_EXP_ALPHA):
+        for mode in modes:
+            if mode not in DETECTORS:
+                raise Exception("unknown spectrum detector: {}"
+                        .format(mode))
+
+        self.modes = tuple(modes)
+        self.hold_decay = np.float32(hold_decay)
+        self.exp_alpha = np.float32(exp_alpha)
+        self.n = 0
+
+        self.lin = None
+        if 'average' in modes or 'exp' in modes:
+            self.lin = np.empty(bins, dtype=np.float32)
+
+        # NaN until the first sweep
+        if 'peak' in modes:
+            self.peak = np.full(bins, np.nan, dtype=np.float32)
+
+        if 'min' in modes:
+            self.min = np.full(bins, np.nan, dtype=np.float32)
+
+        if 'average' in modes:  # ring of the last sweeps and their sum
+            self.ring = np.empty((average_sweeps, bins), dtype=np.float32)
+            self.sum = np.zeros(bins, dtype=np.float64)
+            self.head = 0
+
+        if 'exp' in modes:
+            self.exp = np.full(bins, np.nan, dtype=np.float32)
+
+    def update(self, pwrs):
+        self.n += 1
+
+        if self.lin is not None:
+            np.multiply(pwrs, np.float32(0.1), out=self.lin)
+            np.power(np.float32(10), self.lin, out=self.lin)
+
+        if self.n == 1:  # every detector starts on the first sweep
+            if 'peak' in self.modes:
+                self.peak[:] = pwrs
+            if 'min' in self.modes:
+                self.min[:] = pwrs
+            if 'average' in self.modes:
+                self.ring[0] = self.lin
+                self.sum[:] = self.lin
+                self.head = 1
+            if 'exp' in self.modes:
+                self.exp[:] = self.lin
+            return
+
+        if 'peak' in self.modes:
+            self.peak -= self.hold_decay
+            np.maximum(self.peak, pwrs, out=self.peak)
+
+        if 'min' in self.modes:
+            self.min += self.hold_decay
+            np.minimum(self.min, pwrs, out=self.min)
+
+        if 'average' in self.modes:
+            slot = self.head % len(self.ring)
+            if self.head >= len(self.ring):
+                self.sum -= self.ring[slot]
+            self.ring[slot] = self.lin
+            self.sum += self.lin
+            self.head += 1
+
+            if self.head % RESUM_SWEEPS == 0:
+                self.ring[:min(self.head, len(self.ring))].sum(axis=0,
+                        dtype=np.float64, out=self.sum)
+
+        if 'exp' in self.modes:
+            # exp += alpha * (lin - exp)
+            self.lin -= self.exp
+            self.lin *= self.exp_alpha
+            self.exp += self.lin
+
+    def read(self, mode, index):
+        """Detector output in dB for freqmap bins (an index or slice)"""
+
+        if mode not in self.modes:
+            raise Exception("spectrum detector not enabled: {}".format(mode))
+
+        if mode == 'peak':
+            return self.peak[index].copy()
+        if mode == 'min':
+            return self.min[index].copy()
+
+        if mode == 'average':
+            lin = self.sum[index] / min(self.head, len(self.ring))\
+                    if self.head else np.full_like(self.sum[index], np.nan)
+        else:
+            lin = self.exp[index]
+        return (10 * np.log10(np.maximum(lin, 1e-30))).astype(np.float32)
@@ -42,6 +42,8 @@ HACKRF_DEVNUM = 0
 RTLSDR_DEFAULT_GAIN = 23
 RTLSDR_DEFAULT_MAXFREQ = int(1600e6)
 RTLSDR_DEFAULT_MINFREQ = int(50e6)
+RTLSDR_SPECTRUM_JOB = "*** Spectrum provider"
+RTLSDR_SPECTRUM_STEP = 5000  # Hz
 
 MOD_NAME = "devices"
 
@@ -49,6 +51,30 @@ MOD_NAME = "devices"
 def start(config):
     return GrfModuleDevices(config)
 
+def rtlsdr_serial(rtl_devid):
+    buffer1 = (c_ubyte * 256)()
+    buffer2 = (c_ubyte * 256)()
+    serial = (c_ubyte * 256)()
+    rtlsdr.librtlsdr.rtlsdr_get_device_usb_strings(rtl_devid,
+            buffer1, buffer2, serial)
+    return string_at(serial)
+
+def spectrum_serials(config, serials):
+    """Serials of the dongles that sweep the spectrum without a hackrf
+
+    [rtldevs] spectrum_devices is a list of serials, or auto for every
+    dongle that has no startup job.
+    """
+
+    wanted = config['rtldevs']['spectrum_devices'].strip()
+    if wanted == 'auto':
+        startup = config['startup'] if 'startup' in config else {}
+        return [serial for serial in serials
+                if 'startup_{}'.format(serial) not in startup]
+
+    wanted = [serial.strip() for serial in wanted.split(',')]
+    return [serial for serial in serials if serial in wanted]
+
 
 class HackRfDev():
     def __init__(self):
@@ -118,22 +144,71 @@ class GrfModuleDevices(GrfModuleBase):
         devs = OrderedDict()
         devidx = 0
 
+        replay_file = None
+        if 'hackrfdevs' in config:
+            replay_file = config['hackrfdevs'].get('replay_file')
+
         hackrf = pylibhackrf.HackRf()
         r = hackrf.setup()
-        if r != pylibhackrf.HackRfError.HACKRF_SUCCESS:
-            self.have_hackrf = False
+        if r == pylibhackrf.HackRfError.HACKRF_SUCCESS:
+            hackrf.set_amp_enable(False)
+        hackrf.close()
+
+        # every hackrf sweeps a share of the spectrum
+        self.hackrf_serials = []
+        if r == pylibhackrf.HackRfError.HACKRF_SUCCESS and not replay_file:
+            self.hackrf_serials = hackrf.device_serials()
+
+        rtlsdr_devcount = rtlsdr.librtlsdr.rtlsdr_get_device_count()
+        serials = [rtlsdr_serial(rtl_devid).decode('utf-8')
+                for rtl_devid in range(rtlsdr_devcount)]
+
+        # without a hackrf, rtl-sdr dongles can feed the spectrum instead
+        rtl_spectrum = []
+        if r != pylibhackrf.HackRfError.HACKRF_SUCCESS and not replay_file\
+                and 'rtldevs' in config\
+                and 'spectrum_devices' in config['rtldevs']:
+            rtl_spectrum = spectrum_serials(config, serials)
+            if not rtl_spectrum:
+                gammarf_util.console_message("no rtl-sdr free to sweep "\
+                        "the spectrum", MOD_NAME)
+        self.spectrum_rtldevs = []
+
+        # a spectrum provider (device 0) is fed by a hackrf, a recording
+        # or rtl-sdr dongles; hackrf() only answers for a real hackrf
+        self.have_hackrf = r == pylibhackrf.HackRfError.HACKRF_SUCCESS
+        if replay_file:  # spectrum is fed from a recording, not the radio
+            self.have_spectrum = True
+            name = "{} HackRF (replay)".format(HACKRF_DEVNUM)
+            gammarf_util.console_message("replaying sweeps from {}"
+                    .format(replay_file), MOD_NAME)
+
+        elif rtl_spectrum:
+            self.have_spectrum = True
+            name = "{} RTL-SDR spectrum ({})".format(HACKRF_DEVNUM,
+                    ", ".join(rtl_spectrum))
+            gammarf_util.console_message("sweeping the spectrum with "\
+                    "rtl-sdr {}".format(", ".join(rtl_spectrum)), MOD_NAME)
+
+        elif r != pylibhackrf.HackRfError.HACKRF_SUCCESS:
+            self.have_spectrum = False
             gammarf_util.console_message("no hackrf found", MOD_NAME)
 
         else:
-            self.have_hackrf = True
-            hackrf.set_amp_enable(False)
-
+            self.have_spectrum = True
+            name = "{} HackRF".format(HACKRF_DEVNUM)
+            if len(self.hackrf_serials) > 1:
+                name = "{} HackRF x{} ({})".format(HACKRF_DEVNUM,
+                        len(self.hackrf_serials), ", ".join(serial[-8:]
+                            for serial in self.hackrf_serials))
+
+        if self.have_spectrum:
             hrfdev = HackRfDev()
             hrfdev.devid = HACKRF_DEVNUM
-            hrfdev.name = "{} HackRF".format(hrfdev.devid, hrfdev.devid)
+            hrfdev.name = name
             hrfdev.job = "Virtual Provider"
 
-            if 'hackrfdevs' in config:
+            if 'hackrfdevs' in config and not rtl_spectrum:
                 if 'lna_gain' in config['hackrfdevs']:
                     hrfdev.lna_gain = int(config['hackrfdevs']['lna_gain'])
 
@@ -151,9 +226,7 @@ class GrfModuleDevices(GrfModuleBase):
 
             devs[HACKRF_DEVNUM] = hrfdev
             devidx += 1
-        hackrf.close()
 
-        rtlsdr_devcount = rtlsdr.librtlsdr.rtlsdr_get_device_count()
         if not rtlsdr_devcount and not hackrf:
             gammarf_util.console_message("found no usable devices", MOD_NAME)
             exit()
@@ -162,12 +235,7 @@ class GrfModuleDevices(GrfModuleBase):
             rtldev = RtlSdrDev()
             rtldev.devid = rtl_devid
 
-            buffer1 = (c_ubyte * 256)()
-            buffer2 = (c_ubyte * 256)()
-            serial = (c_ubyte * 256)()
-            rtlsdr.librtlsdr.rtlsdr_get_device_usb_strings(rtl_devid,
-                    buffer1, buffer2, serial)
-            serial = string_at(serial)
+            serial = rtlsdr_serial(rtl_devid)
             tmp = rtlsdr.librtlsdr.rtlsdr_get_device_name(rtl_devid)
             devname = "{} {} {}".format(devidx,
                     tmp.decode('utf-8'),
@@ -224,9 +292,31 @@ class GrfModuleDevices(GrfModuleBase):
                 else:
                     rtldev.offset = int(stickoffset)
 
+            if serial.decode('utf-8') in rtl_spectrum:
+                rtldev.reserved = True
+                rtldev.job = RTLSDR_SPECTRUM_JOB
+                self.spectrum_rtldevs.append({'devid': devidx,
+                    'sysdevid': rtl_devid,
+                    'serial': serial.decode('utf-8'),
+                    'gain': rtldev.gain,
+                    'ppm': rtldev.ppm,
+                    'offset': rtldev.offset,
+                    'minfreq': rtldev.minfreq,
+                    'maxfreq': rtldev.maxfreq})
+
             devs[devidx] = rtldev
             devidx += 1
 
+        if self.spectrum_rtldevs:  # the provider covers all their ranges
+            hrfdev = devs[HACKRF_DEVNUM]
+            hrfdev.minfreq = min(dev['minfreq']
+                    for dev in self.spectrum_rtldevs) // int(1e6)
+            hrfdev.maxfreq = -(-max(dev['maxfreq']
+                for dev in self.spectrum_rtldevs) // int(1e6))
+            hrfdev.step = RTLSDR_SPECTRUM_STEP
+            if 'spectrum_width' in config['rtldevs']:
+                hrfdev.step = int(config['rtldevs']['spectrum_width'])
+
         self.devs = devs
         self.numdevs = devidx
 
@@ -264,37 +354,41 @@ class GrfModuleDevices(GrfModuleBase):
         return dev.devtype
 
     def get_hackrf_devnum(self):
-        if not self.have_hackrf:
+        if not self.have_spectrum:
             return
         return HACKRF_DEVNUM
 
     def get_hackrf_job(self):
-        if not self.have_hackrf:
+        if not self.have_spectrum:
             return
         return self.devs[HACKRF_DEVNUM].job
 
     def get_hackrf_lnagain(self):
-        if not self.have_hackrf:
+        if not self.have_spectrum:
             return
         return self.devs[HACKRF_DEVNUM].lna_gain
 
     def get_hackrf_maxfreq(self):
-        if not self.have_hackrf:
+        if not self.have_spectrum:
             return
         return self.devs[HACKRF_DEVNUM].maxfreq
 
     def get_hackrf_minfreq(self):
-        if not self.have_hackrf:
+        if not self.have_spectrum:
             return
         return self.devs[HACKRF_DEVNUM].minfreq
 
+    def get_hackrf_serials(self):
+        """Serials of the hackrfs sharing the spectrum sweep"""
+        return self.hackrf_serials
+
     def get_hackrf_step(self):
-        if not self.have_hackrf:
+        if not self.have_spectrum:
             return
         return self.devs[HACKRF_DEVNUM].step
 
     def get_hackrf_vgagain(self):
-        if not self.have_hackrf:
+        if not self.have_spectrum:
             return
         return self.devs[HACKRF_DEVNUM].vga_gain
 
@@ -343,6 +437,10 @@ class GrfModuleDevices(GrfModuleBase):
             return dev.ppm
         return
 
+    def get_spectrum_rtldevs(self):
+        """Dongles sweeping the spectrum in place of a hackrf"""
+        return self.spectrum_rtldevs
+
     def get_sysdevid(self, devid):
         dev = self.devs[devid]
         return dev.devid
@@ -350,13 +448,18 @@ class GrfModuleDevices(GrfModuleBase):
     def hackrf(self):
         return self.have_hackrf
 
+    def spectrum(self):
+        """True with a spectrum provider: a hackrf, a replay, or rtl-sdr
+        dongles sweeping in its place"""
+        return self.have_spectrum
+
     def isdev(self, devid):
         if devid in self.devs:
             return True
         return False
 
     def ishackrf(self, devid):
-        if not self.have_hackrf:
+        if not self.have_spectrum:
             return False
         return devid == HACKRF_DEVNUM
 
@@ -425,7 +528,7 @@ class GrfModuleDevices(GrfModuleBase):
         return
 
     def reserved(self, devid):
-        if self.have_hackrf:
+        if self.have_spectrum:
             if self.ishackrf(devid):
                 return False
 
@@ -445,7 +548,7 @@ class GrfModuleDevices(GrfModuleBase):
         return jobs
 
     def set_hackrf_step(self, step):
-        if not self.have_hackrf:
+        if not self.have_spectrum:
             return
 
         dev = self.devs[HACKRF_DEVNUM]
@@ -483,7 +586,7 @@ class GrfModuleDevices(GrfModuleBase):
             "command takes a device number as its argument")
             return
 
-        if devmod.hackrf():
+        if devmod.spectrum():
             if devmod.ishackrf(devid):
                 gammarf_util.console_message("invalid device: {}"
                         .format(HACKRF_DEVNUM))
@@ -524,7 +627,7 @@ class GrfModuleDevices(GrfModuleBase):
             devid = args.strip()
             virtual = True
 
-        if devmod.hackrf():
+        if devmod.spectrum():
             if devmod.ishackrf(devid):
                 gammarf_util.console_message("invalid device: {}"
                         .format(HACKRF_DEVNUM))
@@ -558,7 +661,7 @@ class GrfModuleDevices(GrfModuleBase):
                     "number as its argument")
             return
 
-        if devmod.hackrf():
+        if devmod.spectrum():
             if devmod.ishackrf(devid):
                 gammarf_util.console_message("invalid device: {}"
                         .format(HACKRF_DEVNUM))
@@ -571,6 +674,11 @@ class GrfModuleDevices(GrfModuleBase):
         if not devmod.reserved(devid):
             return
 
+        if devid in [dev['devid'] for dev in devmod.get_spectrum_rtldevs()]:
+            gammarf_util.console_message("device {} sweeps the spectrum"
+                    .format(devid))
+            return
+
         devmod.unreserve(devid)
         return
 
@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# in-process hackrf sweep engine
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+from collections import deque
+import numpy as np
+
+try:
+    import pyfftw
+except ImportError:  # numpy's FFT does the job, just slower
+    pyfftw = None
+
+sys.path.insert(0, '3rdparty')
+try:
+    import pylibhackrf
+except (ImportError, OSError):  # no libhackrf: hackrf_sweep or replay only
+    pylibhackrf = None
+
+import gammarf_util
+from gammarf_sweepplan import HACKRF_MAX_RANGES, TUNE_STEP, tuned_max
+
+BASEBAND_FILTER_BW = 15000000  # Hz
+BLOCK_MAGIC = 0x7f
+BLOCKS_PER_TRANSFER = 16
+BYTES_PER_BLOCK = 16384
+DEFAULT_DWELL = 1  # blocks per tuning
+DEFAULT_FRAMES = 1  # FFT frames per block
+HEADER_BYTES = 10  # 0x7f 0x7f, then the tuned frequency (uint64 LE)
+MAX_FFT_SIZE = (BYTES_PER_BLOCK - HEADER_BYTES) // 2 // 8 * 8
+MAX_QUEUED = 4096  # tunings (or hops) waiting for the spectrum worker
+MIN_FFT_SIZE = 8
+MOD_NAME = "directsweep"
+OFFSET = 7500000  # Hz, tuned above each tuning's first record
+SAMPLE_RATE = 20000000  # Hz
+TUNE_STEP_HZ = TUNE_STEP * 1000000
+
+
+def fft_size(width):
+    """FFT length for a bin width: a multiple of 8, so the two
+    quarter-band records split evenly"""
+
+    size = -(-SAMPLE_RATE // width)
+    size = -(-size // 8) * 8
+    if not MIN_FFT_SIZE <= size <= MAX_FFT_SIZE:
+        raise Exception("bin width {} Hz out of range for the direct "\
+                "sweep engine".format(width))
+    return size
+
+def record_dtype(pwr_entries):
+    return np.dtype([('reclen', np.int32), ('start', np.int64),
+        ('end', np.int64), ('pwr', np.float32, (pwr_entries,))])
+
+
+class FftPlan():
+    """Window, scratch buffers and transform for one FFT size
+
+    Built once per size and reused for every block: samples are scaled
+    and windowed straight from int8 into the complex64 input, and only
+    the two quarter bands the records keep are squared.
+    """
+
+    def __init__(self, size, frames):
+        self.size = size
+        self.frames = frames
+        rows = BLOCKS_PER_TRANSFER * frames
+
+        # hackrf_sweep's scaling: 1/128 per sample, 1/N for the FFT
+        window = np.hanning(size) / (128.0 * size)
+        self.window = np.repeat(window, 2).astype(np.float32)  # I and Q
+
+        if pyfftw:
+            self.fft = pyfftw.builders.fft(
+                    pyfftw.empty_aligned((rows, size), dtype=np.complex64),
+                    axis=1, overwrite_input=True, avoid_copy=True)
+            self.iq = self.fft.input_array
+        else:
+            self.fft = None
+            self.iq = np.empty((rows, size), dtype=np.complex64)
+
+        # record bins: -7.5..-2.5 MHz then +2.5..+7.5 MHz from the center
+        quarter = size // 4
+        self.bins = np.concatenate((
+            np.arange(5 * size // 8, 5 * size // 8 + quarter),
+            np.arange(size // 8, size // 8 + quarter)))
+
+    def power(self, blocks):
+        """Mean linear power of each block's record bins"""
+
+        samples = blocks[:, -2 * self.size * self.frames:]\
+                .reshape(-1, 2 * self.size)
+        iq = self.iq[:len(samples)]
+        np.multiply(samples, self.window, out=iq.view(np.float32),
+                dtype=np.float32)
+
+        if self.fft:
+            spectra = self.fft()[:len(samples)]
+        else:
+            spectra = np.fft.fft(iq, axis=1)
+
+        picked = spectra[:, self.bins]
+        lin = np.square(picked.real) + np.square(picked.imag)
+        return lin.reshape(len(blocks), self.frames, -1).mean(axis=1)
+
+
+class RecordSource():
+    """Queue of -B style records, read like a SweepReader
+
+    Sources that compute spectra in-process queue one record array per
+    tuning; the spectrum worker reads them with the calls it uses on a
+    hackrf_sweep stream, so layout, caching and recording are shared.
+    """
+
+    def __init__(self, timeout=None):
+        self.queue = deque()  # record arrays, one per tuning
+        self.pos = 0  # next record in queue[0]
+        self.cond = threading.Condition()
+        self.timeout = timeout or None
+        self.bytes_read = 0
+        self.dropped = 0
+        self.error = None
+        self.tee = None
+
+    def put(self, recs):
+        if len(self.queue) >= MAX_QUEUED:  # the worker is not keeping up
+            self.dropped += 1
+            return
+
+        with self.cond:
+            self.queue.append(recs)
+            self.cond.notify_all()
+
+    def fail(self, error):
+        with self.cond:
+            self.error = error
+            self.cond.notify_all()
+
+    def peek(self):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.queue or self.error,
+                    self.timeout):
+                raise TimeoutError("no sweep data for {}s"
+                        .format(self.timeout))
+
+            if self.error:
+                raise OSError(self.error)
+
+        return self.queue[0]
+
+    def record(self, recs):
+        if self.tee:
+            self.tee.write(recs.tobytes())
+
+    # SweepReader interface
+    def header(self):
+        """Peek at the next record header: (reclen, start, end)"""
+        rec = self.peek()[self.pos]
+        return int(rec['reclen']), int(rec['start']), int(rec['end'])
+
+    def skip(self, nbytes):
+        recs = self.peek()
+        self.record(recs[self.pos:self.pos + 1])
+
+        self.pos += 1
+        if self.pos == len(recs):
+            self.queue.popleft()
+            self.pos = 0
+
+    def records(self, rec_dtype):
+        """Return the queued run of records of this size"""
+
+        recs = self.peek()
+        if recs.dtype.itemsize != rec_dtype.itemsize:
+            return recs[:0]
+
+        batch = [recs[self.pos:]]
+        self.queue.popleft()
+        self.pos = 0
+        while self.queue and self.queue[0].dtype.itemsize\
+                == rec_dtype.itemsize:
+            batch.append(self.queue.popleft())
+
+        recs = np.concatenate(batch)
+        self.record(recs)
+        return recs
+
+
+class DirectSweep(RecordSource):
+    """Sweep the plan on the HackRF in-process, without hackrf_sweep
+
+    The firmware's sweep mode retunes across the ranges and tags every
+    block of samples with its frequency.  Each tuning becomes the same
+    pair of 5 MHz records hackrf_sweep -B would write.
+
+    dwell is the blocks captured per tuning and frames the FFTs taken
+    from the end of each block; all of them are averaged.  The FFT size
+    follows each segment's bin width.
+    """
+
+    def __init__(self, plan, runs, lna_gain, vga_gain, dwell=DEFAULT_DWELL,
+            frames=DEFAULT_FRAMES, timeout=None, serial=None):
+        RecordSource.__init__(self, timeout)
+
+        self.ranges = [rng for width, ranges in runs for rng in ranges]
+        if len(self.ranges) > HACKRF_MAX_RANGES:
+            raise Exception("sweep plan needs more than {} ranges, too many "\
+                    "for the direct sweep engine".format(HACKRF_MAX_RANGES))
+
+        segments = sorted(plan, key=lambda segment: segment.minfreq)
+        self.seg_lo = np.array([segment.minfreq * 1000000
+            for segment in segments], dtype=np.int64)
+        self.seg_hi = np.array([tuned_max(segment.minfreq, segment.maxfreq)
+            * 1000000 for segment in segments], dtype=np.int64)
+        self.seg_fft = np.array([fft_size(segment.width)
+            for segment in segments], dtype=np.int64)
+
+        self.lna_gain = lna_gain
+        self.vga_gain = vga_gain
+        self.dwell = dwell
+        self.serial = serial  # None for the first hackrf found
+
+        self.plans = {}
+        self.rec_dtypes = {}
+        for size in set(self.seg_fft.tolist()):
+            self.plans[size] = FftPlan(size,
+                    max(1, min(frames, MAX_FFT_SIZE // size)))
+            self.rec_dtypes[size] = record_dtype(size // 4)
+
+        self.acc = None  # power summed over the current tuning
+        self.acc_freq = None
+        self.acc_count = 0
+
+        self.hackrf = None
+        self.closed = False
+        self.open()
+
+    def open(self):
+        """Start the firmware sweep; failures surface on the next read"""
+
+        if not pylibhackrf:
+            self.error = "libhackrf not available"
+            return
+
+        success = pylibhackrf.HackRfError.HACKRF_SUCCESS
+        self.hackrf = pylibhackrf.HackRf()
+        if self.hackrf.setup(self.serial) != success:
+            self.error = "could not open hackrf {}".format(self.serial or '')
+            return
+
+        ranges = [(lo, tuned_max(lo, hi)) for lo, hi in self.ranges]
+        steps = [(self.hackrf.set_sample_rate, (SAMPLE_RATE,)),
+                (self.hackrf.set_baseband_filter_bandwidth,
+                    (BASEBAND_FILTER_BW,)),
+                (self.hackrf.set_lna_gain, (self.lna_gain,)),
+                (self.hackrf.set_vga_gain, (self.vga_gain,)),
+                (self.hackrf.set_amp_enable, (True,)),
+                (self.hackrf.init_sweep, (ranges,
+                    BYTES_PER_BLOCK * self.dwell, TUNE_STEP_HZ, OFFSET)),
+                (self.hackrf.start_rx_mode, (self.rx_callback,))]
+        for step, args in steps:  # stop at the first failing call
+            if step(*args) != success:
+                self.error = "could not start the hackrf sweep ({})"\
+                        .format(step.__name__)
+                return
+
+    def rx_callback(self, transfer):
+        if self.closed:
+            return -1
+
+        transfer = transfer.contents
+        try:
+            self.process(np.ctypeslib.as_array(transfer.buffer,
+                shape=(transfer.valid_length,)))
+        except Exception as e:
+            self.fail("sweep processing failed: {}".format(e))
+            return -1
+
+        return 0
+
+    def process(self, data):
+        """Turn one transfer of tagged sample blocks into records"""
+
+        self.bytes_read += len(data)
+        nblocks = len(data) // BYTES_PER_BLOCK
+        blocks = data[:nblocks * BYTES_PER_BLOCK]\
+                .reshape(nblocks, BYTES_PER_BLOCK)
+
+        head = blocks[:, :HEADER_BYTES].view(np.uint8)
+        freqs = head[:, 2:].copy().view('<u8')[:, 0].astype(np.int64)
+        segment = np.searchsorted(self.seg_lo, freqs, 'right') - 1
+        sizes = self.seg_fft[np.maximum(segment, 0)]
+        valid = (head[:, 0] == BLOCK_MAGIC) & (head[:, 1] == BLOCK_MAGIC)\
+                & (segment >= 0)\
+                & (freqs < self.seg_hi[np.maximum(segment, 0)])
+
+        pwrs = [None] * nblocks
+        for size in set(sizes[valid].tolist()):
+            rows = np.flatnonzero(valid & (sizes == size))
+            for row, lin in zip(rows.tolist(),
+                    self.plans[size].power(blocks[rows])):
+                pwrs[row] = lin
+
+        for row in np.flatnonzero(valid).tolist():
+            self.accumulate(int(freqs[row]), int(sizes[row]), pwrs[row])
+
+    def accumulate(self, freq, size, lin):
+        if freq != self.acc_freq:
+            self.flush()
+            self.acc_freq = freq
+            self.acc_size = size
+            self.acc = lin
+            self.acc_count = 1
+        else:
+            self.acc += lin
+            self.acc_count += 1
+
+        if self.acc_count == self.dwell:
+            self.flush()
+
+    def flush(self):
+        """Queue the finished tuning as hackrf_sweep's two records"""
+
+        if self.acc_freq is None:
+            return
+
+        freq, size = self.acc_freq, self.acc_size
+        self.acc_freq = None
+
+        recs = np.empty(2, dtype=self.rec_dtypes[size])
+        recs['reclen'] = recs.dtype.itemsize - 4
+        recs['start'] = (freq, freq + SAMPLE_RATE // 2)
+        recs['end'] = recs['start'] + SAMPLE_RATE // 4
+        recs['pwr'] = (10 * np.log10(np.maximum(self.acc / self.acc_count,
+            1e-20))).reshape(2, -1)
+        self.put(recs)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+
+        if self.hackrf and self.hackrf.is_open:
+            try:
+                self.hackrf.stop_rx_mode()
+                self.hackrf.exit()
+            except Exception as e:
+                gammarf_util.console_message("error closing hackrf: {}"
+                        .format(e), MOD_NAME)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# emitter module
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+import gammarf_util
+from gammarf_base import GrfModuleBase
+
+DEFAULT_MIN_SNR = 0.0
+LOOP_SLEEP = 2
+MOD_NAME = "emitter"
+MODULE_EMITTER = 10
+PROTOCOL_VERSION = 1
+
+
+def start(config):
+    return GrfModuleEmitter(config)
+
+
+class Emitter(threading.Thread):
+    def __init__(self, system_mods, settings):
+        threading.Thread.__init__(self)
+        self.stoprequest = threading.Event()
+
+        self.connector = system_mods['connector']
+        self.spectrum = system_mods['spectrum']
+
+        self.settings = settings
+
+    def run(self):
+        data = {}
+        data['module'] = MODULE_EMITTER
+        data['protocol'] = PROTOCOL_VERSION
+
+        sweep_seq = 0
+
+        while not self.stoprequest.isSet():
+            latest = self.spectrum.wait_sweep(sweep_seq, LOOP_SLEEP)
+            if latest == sweep_seq:
+                continue
+            sweep_seq = latest
+
+            detected = self.spectrum.emitters()
+            if not detected:
+                continue
+
+            seq, ts, emitters = detected
+            emitters = emitters[emitters['snr'] >= self.settings['min_snr']]
+            if not len(emitters):
+                continue
+
+            if self.settings['print_hits']:
+                for emitter in emitters.tolist():
+                    gammarf_util.console_message(
+                            "emitter at {} ({} Hz wide): {:.2f} dB, "\
+                            "snr {:.2f}".format(*emitter), MOD_NAME)
+
+            # one event per sweep: [freq, bw, pwr, snr] for each emitter
+            data['sweep_ts'] = ts
+            data['emitters'] = [[freq, bw, round(pwr, 1), round(snr, 1)]
+                    for freq, bw, pwr, snr in emitters.tolist()]
+
+            try:
+                self.connector.senddat(data)
+            except Exception as e:
+                pass
+
+        return
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(Emitter, self).join(timeout)
+
+
+class GrfModuleEmitter(GrfModuleBase):
+    """ Emitter: Report emitters the spectrum's CFAR stage finds each sweep
+
+        Usage: run emitter hackrf_devid
+
+        Example: run emitter 0
+
+        Settings:
+            print_hits: Print emitters as they are reported
+            min_snr: Only report emitters this far above the floor (dB)
+    """
+
+    def __init__(self, config):
+        try:
+            min_snr = config['emitter']['min_snr']
+        except KeyError:
+            min_snr = DEFAULT_MIN_SNR
+        min_snr = float(min_snr)
+
+        self.device_list = ["hackrf", "virtual"]
+        self.description = "emitter module"
+        self.settings = {'print_hits': False, 'min_snr': min_snr}
+        self.worker = None
+
+        self.thread_timeout = 3
+
+        gammarf_util.console_message("loaded", MOD_NAME)
+
+    # overridden
+    def run(self, grfstate, devid, cmdline, remotetask=False):
+        self.remotetask = remotetask
+        system_mods = grfstate.system_mods
+
+        if self.worker:
+            gammarf_util.console_message("module already running",
+                    MOD_NAME)
+            return
+
+        self.worker = Emitter(system_mods, self.settings)
+        self.worker.daemon = True
+        self.worker.start()
+
+        gammarf_util.console_message("{} added on device {}"
+                .format(self.description, devid))
+        return True
@@ -18,6 +18,7 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import math
 import threading
 import time
 
@@ -105,9 +106,9 @@ class Freqwatch(threading.Thread):
                 since_interesting_refresh = datetime.datetime.utcnow()
                 check_interesting = False
 
-            for freq in self.freqlist:
-                pwr = self.spectrum.pwr(freq)
-                if pwr:
+            pwrs = self.spectrum.pwr_many(self.freqlist)
+            for freq, pwr in zip(self.freqlist, pwrs.tolist()):
+                if not math.isnan(pwr):
                     if self.settings['print_all']:
                         gammarf_util.console_message("freq: {}, Pwr: {:.2f}"
                                 .format(freq, pwr), MOD_NAME)
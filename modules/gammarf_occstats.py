@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# per-bin occupancy counters
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+CHANNEL_DTYPE = np.dtype([('freq', np.int64), ('width', np.int64),
+    ('occupancy', np.float32)])
+DEFAULT_OCCUPANCY_MARGIN = 10.0  # dB above the cfar noise floor
+DEFAULT_OCCUPANCY_SLICES = 10
+DEFAULT_OCCUPANCY_WINDOW = 300  # s
+MAX_SLICE_SWEEPS = np.iinfo(np.uint16).max
+
+
+def channel_groups(segments, width):
+    """First bin of each channel of about width Hz, and the channels
+
+    Channels never straddle a segment boundary; a segment's last
+    channel may be narrower.
+    """
+
+    starts, channels = [], []
+    for segment in segments:
+        factor = max(1, int(round(width / segment['step'])))
+        first = np.arange(segment['offset'],
+                segment['offset'] + segment['bins'], factor)
+        starts.append(first)
+
+        chans = np.zeros(len(first), dtype=CHANNEL_DTYPE)
+        chans['freq'] = segment['minfreq']\
+                + (first - segment['offset']) * segment['step']
+        chans['width'] = np.minimum(factor, segment['offset']
+                + segment['bins'] - first) * segment['step']
+        channels.append(chans)
+
+    return np.concatenate(starts), np.concatenate(channels)
+
+
+class OccupancyCounters():
+    """How often each bin is busy, over a rolling window of sweeps
+
+    A bin is busy in a sweep if it is above threshold (dB), or, with no
+    threshold, margin dB above the noise floor passed in.  Counts are
+    uint16 per bin in a ring of slices, each covering window / slices
+    seconds, with the number of sweeps each holds; the oldest slice is
+    cleared and reused as time passes (or before its counts could
+    overflow), so the window slides a slice at a time.
+    """
+
+    def __init__(self, bins, window=DEFAULT_OCCUPANCY_WINDOW,
+            slices=DEFAULT_OCCUPANCY_SLICES, threshold=None,
+            margin=DEFAULT_OCCUPANCY_MARGIN):
+        self.threshold = threshold
+        self.margin = margin
+        self.slice_secs = window / slices
+
+        self.counts = np.zeros((slices, bins), dtype=np.uint16)
+        self.sweeps = np.zeros(slices, dtype=np.int64)
+        self.started = np.zeros(slices, dtype=np.float64)
+        self.cur = 0
+
+        self.hits = np.empty(bins, dtype=bool)
+        self.level = np.empty(bins, dtype=np.float64)
+
+    def update(self, pwrs, floor, now):
+        if not self.started[self.cur]:
+            self.started[self.cur] = now
+        elif now - self.started[self.cur] >= self.slice_secs\
+                or self.sweeps[self.cur] == MAX_SLICE_SWEEPS:
+            self.cur = (self.cur + 1) % len(self.counts)
+            self.counts[self.cur] = 0
+            self.sweeps[self.cur] = 0
+            self.started[self.cur] = now
+
+        if self.threshold is not None:
+            np.greater(pwrs, self.threshold, out=self.hits)
+        else:
+            np.add(floor, self.margin, out=self.level)
+            np.greater(pwrs, self.level, out=self.hits)
+
+        np.add(self.counts[self.cur], self.hits, out=self.counts[self.cur],
+                casting='unsafe')
+        self.sweeps[self.cur] += 1
+
+    def window(self, now):
+        """(sweeps, seconds) the counts cover"""
+
+        used = self.sweeps > 0
+        if not used.any():
+            return 0, 0.0
+        return int(self.sweeps.sum()), now - float(self.started[used].min())
+
+    def fractions(self, index):
+        """Busy fraction of freqmap bins (an index or slice)"""
+
+        sweeps = self.sweeps.sum()
+        counts = self.counts[:, index].sum(axis=0, dtype=np.uint32)
+        return (counts / max(sweeps, 1)).astype(np.float32)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# occupancy module
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+import gammarf_util
+from gammarf_base import GrfModuleBase
+
+DEFAULT_CHANNEL_WIDTH = 25000  # Hz
+DEFAULT_MIN_OCCUPANCY = 0.01
+DEFAULT_REPORT_INT = 300  # s
+MOD_NAME = "occupancy"
+MODULE_OCCUPANCY = 11
+PROTOCOL_VERSION = 1
+
+
+def start(config):
+    return GrfModuleOccupancy(config)
+
+
+class Occupancy(threading.Thread):
+    def __init__(self, system_mods, settings):
+        threading.Thread.__init__(self)
+        self.stoprequest = threading.Event()
+
+        self.connector = system_mods['connector']
+        self.spectrum = system_mods['spectrum']
+
+        self.settings = settings
+
+    def run(self):
+        data = {}
+        data['module'] = MODULE_OCCUPANCY
+        data['protocol'] = PROTOCOL_VERSION
+
+        while not self.stoprequest.wait(self.settings['report_int']):
+            summary = self.spectrum.occupancy_summary(
+                    self.settings['channel_width'],
+                    self.settings['min_occupancy'])
+            if not summary or not summary[0]:
+                continue
+
+            sweeps, seconds, channels = summary
+            if self.settings['print_reports']:
+                gammarf_util.console_message("{} busy {} Hz channels "\
+                        "over {} sweeps ({:.0f}s)".format(len(channels),
+                            self.settings['channel_width'], sweeps, seconds),
+                        MOD_NAME)
+
+            # one report per interval: [freq, width, busy fraction] each
+            data['report_ts'] = time.time()
+            data['sweeps'] = sweeps
+            data['seconds'] = round(seconds, 1)
+            data['channels'] = [[freq, width, round(occupancy, 3)]
+                    for freq, width, occupancy in channels.tolist()]
+
+            try:
+                self.connector.senddat(data)
+            except Exception as e:
+                pass
+
+        return
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(Occupancy, self).join(timeout)
+
+
+class GrfModuleOccupancy(GrfModuleBase):
+    """ Occupancy: Report how busy each channel is, from the spectrum's
+        per-bin occupancy counters, in place of raw power samples
+
+        Usage: run occupancy hackrf_devid
+
+        Example: run occupancy 0
+
+        Settings:
+            print_reports: Print a line per report sent
+            channel_width: Bins are grouped into channels this wide (Hz)
+            min_occupancy: Only report channels busy this fraction of
+                           the time
+            report_int: Seconds between reports
+    """
+
+    def __init__(self, config):
+        settings = {'print_reports': False,
+                'channel_width': DEFAULT_CHANNEL_WIDTH,
+                'min_occupancy': DEFAULT_MIN_OCCUPANCY,
+                'report_int': DEFAULT_REPORT_INT}
+
+        if 'occupancy' in config:
+            if 'channel_width' in config['occupancy']:
+                settings['channel_width'] = int(
+                        config['occupancy']['channel_width'])
+
+            if 'min_occupancy' in config['occupancy']:
+                settings['min_occupancy'] = float(
+                        config['occupancy']['min_occupancy'])
+
+            if 'report_int' in config['occupancy']:
+                settings['report_int'] = int(
+                        config['occupancy']['report_int'])
+
+        self.device_list = ["hackrf", "virtual"]
+        self.description = "occupancy module"
+        self.settings = settings
+        self.worker = None
+
+        self.thread_timeout = 3
+
+        gammarf_util.console_message("loaded", MOD_NAME)
+
+    # overridden
+    def run(self, grfstate, devid, cmdline, remotetask=False):
+        self.remotetask = remotetask
+        system_mods = grfstate.system_mods
+
+        if self.worker:
+            gammarf_util.console_message("module already running",
+                    MOD_NAME)
+            return
+
+        if not system_mods['spectrum'].occupancy_window():
+            gammarf_util.console_message("occupancy counters are not "\
+                    "enabled in [spectrum] occupancy_window", MOD_NAME)
+            return
+
+        self.worker = Occupancy(system_mods, self.settings)
+        self.worker.daemon = True
+        self.worker.start()
+
+        gammarf_util.console_message("{} added on device {}"
+                .format(self.description, devid))
+        return True
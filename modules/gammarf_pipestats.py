@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# spectrum pipeline instrumentation
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import numpy as np
+
+BUCKETS_PER_DECADE = 4
+QUANTILES = (0.5, 0.9, 0.99)
+
+
+class Histogram():
+    """Fixed log-spaced histogram of values in [low, high]
+
+    Meant for a single writer (the spectrum worker's thread) and any
+    number of readers: observe() only bumps plain ints, so it takes no
+    lock and costs a bisect.  Readers may see a count from an update in
+    progress, which is fine for the rates and percentiles reported.
+    """
+
+    def __init__(self, low, high, unit=''):
+        decades = int(np.ceil(np.log10(high / low)))
+        self.bounds = np.logspace(np.log10(low), np.log10(low) + decades,
+                decades * BUCKETS_PER_DECADE + 1).tolist()
+        self.unit = unit
+
+        # counts[i] holds values up to bounds[i]; the last, anything above
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value, count=1):
+        self.counts[bisect.bisect_left(self.bounds, value)] += count
+        self.n += count
+        self.total += value * count
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q, counts=None):
+        """The q quantile, interpolated within its bucket, at most max"""
+
+        counts = counts or self.counts
+        rank = q * sum(counts)
+        seen = 0
+        lower = 0.0
+        for bound, count in zip(self.bounds + [self.max], counts):
+            if count and seen + count >= rank:
+                value = lower + (bound - lower) * (rank - seen) / count
+                return min(max(value, lower), self.max)
+            seen += count
+            lower = bound
+        return 0.0
+
+    def summary(self):
+        counts = list(self.counts)
+        n = sum(counts)
+        summary = {'n': n,
+                'mean': self.total / n if n else 0.0,
+                'max': self.max,
+                'unit': self.unit}
+        for q in QUANTILES:
+            summary['p{:g}'.format(q * 100)] = self.quantile(q, counts)
+        return summary
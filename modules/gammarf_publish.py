@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# local sweep feed over zmq pub
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import sys
+import threading
+import numpy as np
+import zmq
+
+import gammarf_util
+from gammarf_waterfall import INT8_OFFSET, INT8_SCALE, quantize_int8
+
+DEFAULT_PUBLISH_DECIMATE = 1
+DEFAULT_PUBLISH_FORMAT = 'float32'
+DEFAULT_PUBLISH_HWM = 4  # sweeps queued per subscriber, then dropped
+MOD_NAME = "publish"
+PUB_FORMATS = {'float16': np.float16, 'float32': np.float32, 'int8': np.int8}
+PUB_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('seq', np.int64),
+    ('ts', np.float64), ('bins', np.int64), ('segments', np.int64),
+    ('fmt', 'S8'), ('offset', np.float32), ('scale', np.float32)])
+PUB_MAGIC = b'GRFPUB1'
+PUB_SEGMENT_DTYPE = np.dtype([('minfreq', np.int64), ('step', np.int64),
+    ('offset', np.int64), ('bins', np.int64)])
+PUB_TOPIC = b'sweep'
+WAIT_INT = 1  # s between checks for a stop request
+
+# usage: gammarf_publish.py addr
+USAGE = "usage: {} addr (e.g. tcp://127.0.0.1:5557)"
+
+
+def decimate_plan(segments, factor):
+    """Group starts for np.maximum.reduceat, and the decimated segments
+
+    Groups never straddle a segment boundary; a segment's last group
+    may be short.
+    """
+
+    starts = np.concatenate([np.arange(segment['offset'],
+        segment['offset'] + segment['bins'], factor)
+        for segment in segments])
+
+    out = np.zeros(len(segments), dtype=PUB_SEGMENT_DTYPE)
+    out['minfreq'] = segments['minfreq']
+    out['step'] = segments['step'] * factor
+    out['bins'] = -(-segments['bins'] // factor)
+    out['offset'] = np.cumsum(out['bins']) - out['bins']
+    return starts, out
+
+def decode_sweep(frames):
+    """(seq, ts, segments, pwrs) from a published sweep's frames"""
+
+    topic, head, payload = frames
+    header = np.frombuffer(head, dtype=PUB_HEADER_DTYPE, count=1)[0]
+    if header['magic'] != PUB_MAGIC:
+        raise Exception("not a gammarf sweep")
+
+    segments = np.frombuffer(head, dtype=PUB_SEGMENT_DTYPE,
+            count=int(header['segments']), offset=PUB_HEADER_DTYPE.itemsize)
+    fmt = header['fmt'].decode()
+    pwrs = np.frombuffer(payload, dtype=PUB_FORMATS[fmt]).astype(np.float32)
+    if fmt == 'int8':
+        pwrs /= header['scale']
+        pwrs += header['offset']
+
+    return int(header['seq']), float(header['ts']), segments, pwrs
+
+
+class SweepPublisher(threading.Thread):
+    """Publish every completed sweep on a zmq PUB socket
+
+    Runs beside the spectrum worker and copies each sweep out of the
+    freqmap ring as a reader would, so acquisition never waits on it.
+    Frames are [topic, header + segment table, powers]; powers may be
+    decimated (max of each group of bins, so peaks survive) and sent as
+    float32, float16 or int8 dB.  zmq drops sweeps for a subscriber
+    that falls hwm sweeps behind.
+    """
+
+    def __init__(self, worker, addr, fmt=DEFAULT_PUBLISH_FORMAT,
+            decimate=DEFAULT_PUBLISH_DECIMATE, hwm=DEFAULT_PUBLISH_HWM):
+        threading.Thread.__init__(self)
+        self.stoprequest = threading.Event()
+
+        if fmt not in PUB_FORMATS:
+            raise Exception("invalid publish format: {}".format(fmt))
+        if decimate < 1:
+            raise Exception("invalid publish decimation: {}"
+                    .format(decimate))
+
+        self.worker = worker
+        self.addr = addr
+        self.fmt = fmt
+        self.decimate = decimate
+        self.hwm = hwm
+
+        self.segments = None  # layout the plan below was made for
+        self.starts = None
+        self.header = None
+        self.table = None
+        self.sent = 0
+
+    def plan(self, segments):
+        self.segments = segments
+
+        if self.decimate > 1:
+            self.starts, pub_segments = decimate_plan(segments,
+                    self.decimate)
+        else:
+            self.starts = None
+            pub_segments = segments.astype(PUB_SEGMENT_DTYPE)
+
+        header = np.zeros(1, dtype=PUB_HEADER_DTYPE)
+        header['magic'] = PUB_MAGIC
+        header['bins'] = pub_segments['bins'].sum()
+        header['segments'] = len(pub_segments)
+        header['fmt'] = self.fmt.encode()
+        header['offset'] = INT8_OFFSET
+        header['scale'] = INT8_SCALE
+        self.header = header
+        self.table = pub_segments.tobytes()
+
+    def frame(self, pwrs):
+        if self.starts is not None:
+            pwrs = np.maximum.reduceat(pwrs, self.starts)
+
+        if self.fmt == 'int8':
+            quantize_int8(pwrs, pwrs)
+        return pwrs.astype(PUB_FORMATS[self.fmt])
+
+    def run(self):
+        context = zmq.Context.instance()
+        sock = context.socket(zmq.PUB)
+        sock.setsockopt(zmq.SNDHWM, self.hwm)
+        sock.setsockopt(zmq.LINGER, 0)
+        try:
+            sock.bind(self.addr)
+        except zmq.ZMQError as e:
+            gammarf_util.console_message("could not publish on {}: {}"
+                    .format(self.addr, e), MOD_NAME)
+            sock.close()
+            return
+
+        gammarf_util.console_message("publishing sweeps on {}"
+                .format(self.addr), MOD_NAME)
+
+        seq = 0
+        while not self.stoprequest.isSet():
+            latest = self.worker.wait_sweep(seq, WAIT_INT)
+            if latest == seq:
+                continue
+
+            if self.worker.segments is not self.segments:  # new layout
+                self.plan(self.worker.segments)
+
+            seq, ts, pwrs = self.worker.read_sweep(slice(None))
+            self.header['seq'] = seq
+            self.header['ts'] = ts
+
+            try:
+                sock.send_multipart([PUB_TOPIC,
+                    self.header.tobytes() + self.table, self.frame(pwrs)],
+                    zmq.NOBLOCK, copy=False)
+                self.sent += 1
+            except zmq.ZMQError:
+                pass
+
+        sock.close()
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(SweepPublisher, self).join(timeout)
+
+
+def main(argv):
+    """Print a line per published sweep: seq, bins, peak"""
+
+    if len(argv) != 2:
+        print(USAGE.format(argv[0]))
+        return 1
+
+    from gammarf_spectrum import segment_binfreqs
+
+    sock = zmq.Context.instance().socket(zmq.SUB)
+    sock.setsockopt(zmq.SUBSCRIBE, PUB_TOPIC)
+    sock.connect(argv[1])
+
+    while True:
+        seq, ts, segments, pwrs = decode_sweep(sock.recv_multipart())
+        peak = int(pwrs.argmax())
+        gammarf_util.console_message("sweep {} of {} bins, max {:.2f} at {}"
+                .format(seq, len(pwrs), pwrs[peak],
+                    segment_binfreqs(segments)[peak]), MOD_NAME)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# multi-resolution max/mean spectrum pyramid
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+DB_TO_LN = np.float32(np.log(10) / 10)  # 10^(dB/10) == e^(dB * this)
+FACTOR = 4  # bins per node of the next level up
+
+
+class SpectrumPyramid():
+    """Max and summed linear power of a sweep at 4x, 16x, 64x... coarser
+
+    Level 0 is the sweep itself; each node above covers FACTOR nodes
+    below, up to a level of at most FACTOR nodes.  A range of bins is
+    answered from its unaligned ends at each level and the aligned
+    middle one level up, so a query touches O(log n) nodes.
+
+    Two pyramids are kept.  Each sweep is built into the one readers
+    are not using, then swapped in, so a query sees one whole sweep.
+    """
+
+    def __init__(self, bins):
+        self.bins = bins
+        self.sizes = [bins]
+        while self.sizes[-1] > FACTOR:
+            self.sizes.append(-(-self.sizes[-1] // FACTOR))
+
+        self.buffers = [self.allocate(), self.allocate()]
+        self.current = None  # (maxes, sums) readers use
+
+    def allocate(self):
+        """Levels padded to whole nodes; padding never wins or adds"""
+
+        maxes, sums = [], []
+        for size in self.sizes:
+            padded = -(-size // FACTOR) * FACTOR
+            maxes.append(np.full(padded, -np.inf, dtype=np.float32))
+            sums.append(np.zeros(padded, dtype=np.float32))
+        return maxes, sums
+
+    def update(self, pwrs):
+        building = self.buffers[0] if self.current is not self.buffers[0]\
+                else self.buffers[1]
+        maxes, sums = building
+
+        maxes[0][:self.bins] = pwrs
+        lin = sums[0][:self.bins]
+        np.multiply(pwrs, DB_TO_LN, out=lin)
+        np.exp(lin, out=lin)
+
+        # strided elementwise passes beat reducing over a short axis
+        for level in range(1, len(self.sizes)):
+            size = self.sizes[level]
+            for below, above, combine in ((maxes[level - 1],
+                maxes[level][:size], np.maximum), (sums[level - 1],
+                    sums[level][:size], np.add)):
+                combine(below[0::FACTOR], below[1::FACTOR], out=above)
+                for i in range(2, FACTOR):
+                    combine(above, below[i::FACTOR], out=above)
+
+        self.current = building
+
+    def query(self, lowbin, highbin):
+        """(max dB, mean dB of linear power) over bins lowbin..highbin"""
+
+        maxes, sums = self.current
+        peak = -np.inf
+        total = 0.0
+
+        lo, hi = lowbin, highbin + 1  # half open, in nodes of this level
+        for level in range(len(self.sizes)):
+            up_lo = -(-lo // FACTOR)
+            up_hi = hi // FACTOR
+            if level == len(self.sizes) - 1 or up_lo >= up_hi:
+                parts = [(lo, hi)]  # nothing whole to hand up
+            else:
+                parts = [(lo, up_lo * FACTOR), (up_hi * FACTOR, hi)]
+
+            for a, b in parts:  # under 2 * FACTOR nodes, cheaper as lists
+                if a < b:
+                    peak = max(peak, max(maxes[level][a:b].tolist()))
+                    total += sum(sums[level][a:b].tolist())
+
+            if len(parts) == 1:
+                break
+            lo, hi = up_lo, up_hi
+
+        mean = total / (highbin - lowbin + 1)
+        return peak, float(10 * np.log10(mean)) if mean > 0 else -np.inf
+
+    def level_for(self, nbins, points):
+        """Coarsest level still giving at least points nodes over nbins"""
+
+        level = 0
+        while level + 1 < len(self.sizes)\
+                and nbins // FACTOR ** (level + 1) >= points:
+            level += 1
+        return level
+
+    def overview(self, lowbin, highbin, level):
+        """(first bin, max dB, mean dB) of each level node in the range
+
+        Nodes at the ends may reach past lowbin/highbin.
+        """
+
+        maxes, sums = self.current
+        scale = FACTOR ** level
+        first, last = lowbin // scale, highbin // scale
+        counts = np.full(last - first + 1, scale, dtype=np.float32)
+        if last == self.sizes[level] - 1:  # the top node may be short
+            counts[-1] = self.bins - last * scale
+
+        means = sums[level][first:last + 1] / counts
+        return np.arange(first, last + 1) * scale,\
+                maxes[level][first:last + 1].copy(),\
+                (10 * np.log10(np.maximum(means, 1e-30))).astype(np.float32)
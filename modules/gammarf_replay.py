@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# hackrf_sweep stream recording and replay
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import sys
+import time
+import numpy as np
+
+import gammarf_util
+
+MOD_NAME = "replay"
+RECORD_META_INT = 10  # s
+REPLAY_CHUNK = 64 * 1024  # bytes per read, sets pacing granularity
+SYNTH_CARRIERS = 8
+SYNTH_NOISE_DB = -90.0
+SYNTH_RECORD_BW = int(5e6)  # Hz per record, as hackrf_sweep emits
+SYNTH_SWEEP_RATE = 1.0  # nominal sweeps/s written to the sidecar
+
+# usage: gammarf_replay.py synth outfile [minMHz maxMHz widthHz sweeps]
+#        gammarf_replay.py bench infile [seconds]
+USAGE = "usage: {} synth outfile [minMHz maxMHz widthHz sweeps] | "\
+        "bench infile [seconds]"
+
+
+def meta_path(path):
+    return path + '.json'
+
+def read_meta(path):
+    try:
+        with open(meta_path(path)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_meta(path, nbytes, seconds):
+    with open(meta_path(path), 'w') as f:
+        json.dump({'bytes': nbytes, 'seconds': seconds}, f)
+
+
+class RecordingTee():
+    """Pass a sweep stream through, copying every byte to a file
+
+    A sidecar (path + '.json') records how many bytes took how long, so
+    the recording can later be replayed in real time.
+    """
+
+    def __init__(self, stream, path):
+        self.stream = stream
+        self.path = path
+        self.out = open(path, 'wb')
+        self.started = time.time()
+        self.meta_written = self.started
+        self.nbytes = 0
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def readinto(self, buf):
+        nread = self.stream.readinto(buf)
+        if nread:
+            self.out.write(buf[:nread])
+            self.nbytes += nread
+
+        self.sync(nread == 0)
+        return nread
+
+    def write(self, data):
+        """Record data from a source that is not read through the tee"""
+
+        self.out.write(data)
+        self.nbytes += len(data)
+        self.sync()
+
+    def sync(self, force=False):
+        now = time.time()
+        if force or now - self.meta_written >= RECORD_META_INT:
+            self.out.flush()
+            write_meta(self.path, self.nbytes, now - self.started)
+            self.meta_written = now
+
+    def close(self):
+        self.out.close()
+        write_meta(self.path, self.nbytes, time.time() - self.started)
+        self.stream.close()
+
+
+class ReplaySource():
+    """Feed a recorded (or synthetic) hackrf_sweep -B stream
+
+    speed is relative to the recording's own data rate (1.0 is real
+    time); 0 replays as fast as the consumer reads.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False):
+        self.f = open(path, 'rb', buffering=0)
+        self.loop = loop
+
+        # only replay whole records, recordings may end mid-record
+        header = self.f.read(4)
+        if len(header) < 4:
+            raise Exception("replay file too short: {}".format(path))
+        recsize = 4 + int(np.frombuffer(header, dtype=np.int32)[0])
+        size = os.path.getsize(path)
+        self.end = size - size % recsize
+        self.f.seek(0)
+
+        self.rate = None
+        meta = read_meta(path)
+        if speed and meta and meta['seconds'] > 0:
+            self.rate = meta['bytes'] / meta['seconds'] * speed
+        elif speed:
+            gammarf_util.console_message(
+                    "no timing sidecar for {}, replaying at max speed"
+                    .format(path), MOD_NAME)
+
+        self.started = time.time()
+        self.sent = 0
+
+    def readinto(self, buf):
+        remain = self.end - self.f.tell()
+        if remain <= 0:
+            if not self.loop:
+                return 0
+            self.f.seek(0)
+            remain = self.end
+
+        nread = self.f.readinto(buf[:min(len(buf), remain, REPLAY_CHUNK)])
+
+        if self.rate and nread:
+            self.sent += nread
+            delay = self.started + self.sent / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+        return nread
+
+    def close(self):
+        self.f.close()
+
+
+def synth_sweeps(path, minfreq, maxfreq, width, sweeps, seed=0):
+    """Write a synthetic hackrf_sweep -B stream with a few carriers"""
+
+    pwr_entries = SYNTH_RECORD_BW // width
+    starts = np.arange(minfreq, maxfreq, SYNTH_RECORD_BW, dtype=np.int64)
+    bins = len(starts) * pwr_entries
+
+    rng = np.random.RandomState(seed)
+    carriers = rng.randint(0, bins, SYNTH_CARRIERS)
+    levels = rng.uniform(20, 60, SYNTH_CARRIERS).astype(np.float32)
+
+    rec_dtype = np.dtype([('reclen', np.int32), ('start', np.int64),
+        ('end', np.int64), ('pwr', np.float32, (pwr_entries,))])
+    recs = np.zeros(len(starts), dtype=rec_dtype)
+    recs['reclen'] = rec_dtype.itemsize - 4
+    recs['start'] = starts
+    recs['end'] = starts + SYNTH_RECORD_BW
+
+    with open(path, 'wb') as f:
+        for sweep in range(sweeps):
+            pwrs = rng.normal(SYNTH_NOISE_DB, 2.0, bins).astype(np.float32)
+            bursting = rng.rand(SYNTH_CARRIERS) < 0.5
+            pwrs[carriers[bursting]] += levels[bursting]
+            recs['pwr'] = pwrs.reshape(len(starts), pwr_entries)
+            f.write(recs.tobytes())
+
+    write_meta(path, os.path.getsize(path), sweeps / SYNTH_SWEEP_RATE)
+    return bins
+
+def bench(path, seconds):
+    """Run the spectrum pipeline over a replay at max speed"""
+
+    import configparser
+    import gammarf_spectrum
+
+    opts = gammarf_spectrum.parse_opts(configparser.ConfigParser())
+    opts.update({'replay_file': path, 'replay_speed': 0, 'replay_loop': True})
+
+    worker = gammarf_spectrum.SpectrumWorker(None, opts)
+    worker.daemon = True
+    started = time.time()
+    worker.start()
+
+    time.sleep(seconds)
+    elapsed = time.time() - started
+    sweeps = worker.sweeps
+    nbytes = worker.reader.bytes_read
+    worker.join(1)
+    worker.release()
+
+    gammarf_util.console_message("{} sweeps of {} bins in {:.1f}s: "\
+            "{:.2f} sweeps/s, {:.1f} MB/s"
+            .format(sweeps, worker.bins, elapsed, sweeps / elapsed,
+                nbytes / elapsed / 1e6), MOD_NAME)
+
+def main(argv):
+    if len(argv) < 3:
+        print(USAGE.format(argv[0]))
+        return 1
+
+    if argv[1] == 'synth':
+        minfreq, maxfreq, width, sweeps = 50, 5000, 5000, 20
+        if len(argv) == 7:
+            minfreq, maxfreq = float(argv[3]), float(argv[4])
+            width, sweeps = int(argv[5]), int(argv[6])
+        bins = synth_sweeps(argv[2], int(minfreq * 1e6), int(maxfreq * 1e6),
+                width, sweeps)
+        gammarf_util.console_message("wrote {} sweeps of {} bins to {}"
+                .format(sweeps, bins, argv[2]), MOD_NAME)
+
+    elif argv[1] == 'bench':
+        bench(argv[2], float(argv[3]) if len(argv) > 3 else 10)
+
+    else:
+        print(USAGE.format(argv[0]))
+        return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
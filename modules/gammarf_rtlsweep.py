@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# rtl-sdr spectrum sweeps
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import numpy as np
+
+try:
+    from rtlsdr import RtlSdr
+except ImportError:  # no pyrtlsdr / librtlsdr
+    RtlSdr = None
+
+import gammarf_util
+from gammarf_directsweep import RecordSource, record_dtype
+
+DEFAULT_FRAMES = 16  # FFTs averaged per hop
+DEFAULT_WIDTH = 5000  # Hz per bin
+MOD_NAME = "rtlsweep"
+READ_ALIGN = 512  # librtlsdr reads in multiples of this many bytes
+RTL_MAX_RATE = 2400000  # highest sample rate that runs without drops
+RTL_MIN_RATE = 900001
+SETTLE_BYTES = 32768  # discarded after each retune, still in flight
+TRIM = 8  # 1/TRIM of the bins dropped at each edge (filter rolloff)
+
+
+def hop_size(width):
+    """FFT length and sample rate for a bin width
+
+    The rate is a whole number of bins so every record's frequencies
+    fall on the width grid, and the FFT length is a multiple of 2 * TRIM
+    so the trimmed edges and the overlap split evenly.
+    """
+
+    size = RTL_MAX_RATE // width // (2 * TRIM) * (2 * TRIM)
+    rate = size * width
+    if rate < RTL_MIN_RATE:
+        raise Exception("bin width {} Hz too wide for rtl-sdr sweeps"
+                .format(width))
+    return size, rate
+
+def plan_hops(devs, span):
+    """Split the devices' ranges into hops of span Hz, sharing them out
+
+    Hops are laid end to end over the union of the ranges.  Each goes
+    to the least loaded device whose range covers its center, so
+    devices with overlapping ranges sweep their overlap in parallel.
+    Returns the record start frequencies for each device.
+    """
+
+    merged = []
+    for lo, hi in sorted((dev['minfreq'], dev['maxfreq']) for dev in devs):
+        if merged and lo <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], hi)
+        else:
+            merged.append([lo, hi])
+
+    hops = [[] for dev in devs]
+    for lo, hi in merged:
+        for start in range(lo, hi, span):
+            center = start + span // 2
+            covering = [i for i, dev in enumerate(devs)
+                    if dev['minfreq'] <= center < dev['maxfreq']]
+            if covering:
+                hops[min(covering, key=lambda i: len(hops[i]))].append(start)
+
+    return hops
+
+
+class RtlHopper(threading.Thread):
+    """Hop one dongle across its share of the range, queueing records"""
+
+    def __init__(self, source, dev, starts, width, frames):
+        threading.Thread.__init__(self)
+        self.stoprequest = threading.Event()
+
+        self.source = source
+        self.dev = dev
+        self.starts = starts
+        self.width = width
+
+        self.size, self.rate = hop_size(width)
+        half = self.size // 2
+        self.keep = self.size - 2 * (self.size // TRIM)
+
+        # frames overlap by half; read whole USB blocks
+        nbytes = 2 * half * (frames + 1)
+        self.nbytes = -(-nbytes // READ_ALIGN) * READ_ALIGN
+        self.frames = (self.nbytes // 2 - self.size) // half + 1
+
+        # 0..255 to +/-1, and 1/N for the FFT, folded into the window
+        window = np.hanning(self.size) / (127.5 * self.size)
+        self.window = np.repeat(window, 2).astype(np.float32)
+        self.iq = np.empty(self.nbytes // 2, dtype=np.complex64)
+        self.frame_iq = np.empty((self.frames, self.size),
+                dtype=np.complex64)
+        self.rec_dtype = record_dtype(self.keep)
+
+    def run(self):
+        try:
+            sdr = RtlSdr(self.dev['sysdevid'])
+            sdr.sample_rate = self.rate
+            sdr.gain = self.dev['gain']
+            if self.dev['ppm']:
+                sdr.freq_correction = self.dev['ppm']
+        except Exception as e:
+            self.source.fail("could not open rtl-sdr {}: {}"
+                    .format(self.dev['serial'], e))
+            return
+
+        span = self.keep * self.width
+        try:
+            while not self.stoprequest.isSet():
+                for start in self.starts:
+                    if self.stoprequest.isSet():
+                        break
+
+                    sdr.center_freq = start + span // 2 + self.dev['offset']
+                    sdr.read_bytes(SETTLE_BYTES)
+                    raw = np.ctypeslib.as_array(sdr.read_bytes(self.nbytes))
+                    self.source.bytes_read += len(raw)
+                    self.source.put(self.hop_records(start, raw))
+
+        except Exception as e:
+            self.source.fail("rtl-sdr {} failed: {}"
+                    .format(self.dev['serial'], e))
+
+        finally:
+            try:
+                sdr.close()
+            except Exception:
+                pass
+
+    def hop_records(self, start, raw):
+        """One record from a hop: overlapped FFTs, edges trimmed"""
+
+        size, half = self.size, self.size // 2
+        samples = self.iq.view(np.float32)
+        np.subtract(raw, np.float32(127.5), out=samples, dtype=np.float32)
+
+        frames = np.lib.stride_tricks.as_strided(samples,
+                shape=(self.frames, 2 * size),
+                strides=(half * samples.strides[0] * 2, samples.strides[0]))
+        np.multiply(frames, self.window, out=self.frame_iq.view(np.float32),
+                dtype=np.float32)
+
+        spectra = np.fft.fftshift(np.fft.fft(self.frame_iq, axis=1), axes=1)
+        lin = (np.square(spectra.real) + np.square(spectra.imag)).mean(axis=0)
+        # the DC spike, spread over +/-1 bin by the Hann window
+        lin[half - 1:half + 2] = (lin[half - 2] + lin[half + 2]) / 2
+
+        trim = size // TRIM
+        recs = np.empty(1, dtype=self.rec_dtype)
+        recs['reclen'] = self.rec_dtype.itemsize - 4
+        recs['start'] = start
+        recs['end'] = start + self.keep * self.width
+        recs['pwr'] = 10 * np.log10(np.maximum(lin[trim:size - trim], 1e-20))
+        return recs
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(RtlHopper, self).join(timeout)
+
+
+class RtlSweep(RecordSource):
+    """Sweep with one or more RTL-SDR dongles in parallel
+
+    Each dongle hops across its share of the configured ranges,
+    averaging half-overlapped FFTs per hop and keeping the middle of
+    the band; records go out in hackrf_sweep -B form.
+    """
+
+    def __init__(self, devs, width=DEFAULT_WIDTH, frames=DEFAULT_FRAMES,
+            timeout=None):
+        RecordSource.__init__(self, timeout)
+
+        self.hoppers = []
+        if not RtlSdr:
+            self.error = "pyrtlsdr not available"
+            return
+
+        size, rate = hop_size(width)
+        span = (size - 2 * (size // TRIM)) * width
+        for dev, starts in zip(devs, plan_hops(devs, span)):
+            if not starts:
+                continue
+
+            hopper = RtlHopper(self, dev, starts, width, frames)
+            hopper.daemon = True
+            self.hoppers.append(hopper)
+
+            gammarf_util.console_message("rtl-sdr {} sweeping {} hops "\
+                    "from {} Hz".format(dev['serial'], len(starts),
+                        starts[0]), MOD_NAME)
+
+        for hopper in self.hoppers:
+            hopper.start()
+
+    def close(self):
+        for hopper in self.hoppers:
+            hopper.join(1)
+        self.hoppers = []
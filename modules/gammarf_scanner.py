@@ -25,7 +25,7 @@ import time
 import gammarf_util
 from gammarf_base import GrfModuleBase
 
-AVG_SAMPLES = 200
+AVG_SAMPLES = 200  # sweeps in the spectrum baseline before reporting hits
 DEFAULT_HIT_DB = 12.0
 INTERESTING_REFRESH_INT = 10  # s
 LOOP_SLEEP = 2
@@ -39,7 +39,7 @@ def start(config):
 
 
 class Scanner(threading.Thread):
-    def __init__(self, system_mods, settings):
+    def __init__(self, system_mods, settings, detector=None):
         threading.Thread.__init__(self)
         self.stoprequest = threading.Event()
 
@@ -51,6 +51,7 @@ class Scanner(threading.Thread):
         self.minfreq = int(self.devmod.get_hackrf_minfreq()*1e6)
 
         self.settings = settings
+        self.detector = detector
         self.freqlist = []
 
     def run(self):
@@ -58,13 +59,11 @@ class Scanner(threading.Thread):
         data['module'] = MODULE_SCANNER
         data['protocol'] = PROTOCOL_VERSION
 
-        freqmap = {}
+        notified_means = False
         notified_nofreqs = False
         since_interesting_refresh = None
-
-        gammarf_util.console_message(
-                "note: it takes time to form an average for new freqs",
-                MOD_NAME)
+        sweep_seq = 0
+        last_pass = 0
 
         while not self.stoprequest.isSet():
             if since_interesting_refresh:
@@ -114,45 +113,47 @@ class Scanner(threading.Thread):
                 since_interesting_refresh = datetime.datetime.utcnow()
                 check_interesting = False
 
-            for freq in self.freqlist:
-                pwr = self.spectrum.pwr(freq)
-
-                try:
-                    fent = freqmap[freq]
-                except KeyError:
-                    fent = {'mean': 0, 'stdev': 0, 'n': 0, 'S': 0}
-
-                prev_mean = fent['mean']
-                fent['n'] = fent['n'] + 1
-                fent['mean'] = fent['mean'] + (pwr - fent['mean']) / fent['n']
-                fent['S'] = fent['S'] + (pwr - fent['mean']) * (pwr - prev_mean)
-                fent['stdev'] = math.sqrt(fent['S']/fent['n'])
-
-                if fent['n'] >= AVG_SAMPLES:
-                    if fent['n'] == AVG_SAMPLES:
+            # a pass on the newest sweep, at most every LOOP_SLEEP
+            latest = self.spectrum.wait_sweep(sweep_seq, LOOP_SLEEP)
+            if latest == sweep_seq:
+                continue
+            sweep_seq = latest
+
+            now = time.time()
+            if now - last_pass < LOOP_SLEEP:
+                continue
+            last_pass = now
+
+            base = self.spectrum.baseline_many(self.freqlist)
+            if base['n'] < AVG_SAMPLES:
+                continue
+
+            if not notified_means:
+                gammarf_util.console_message("spectrum means formulated",
+                        MOD_NAME)
+                notified_means = True
+
+            pwrs = self.spectrum.pwr_many(self.freqlist, self.detector)
+            for freq, pwr, mean, stdev in zip(self.freqlist, pwrs.tolist(),
+                    base['mean'].tolist(), base['stdev'].tolist()):
+                if math.isnan(pwr):
+                    continue
+
+                squelch = mean + self.settings['hit_db']
+                if pwr > squelch:
+                    if self.settings['print_hits']:
                         gammarf_util.console_message(
-                                "initial means formulated for {}".format(freq),
-                                MOD_NAME)
-
-                    squelch = fent['mean'] + self.settings['hit_db']
-                    if pwr > squelch:
-                        if self.settings['print_hits']:
-                            gammarf_util.console_message(
-                            "hit on {} ({:.2f} > {}), stdev: {}"
-                            .format(freq, pwr, squelch, fent['stdev']),
-                            MOD_NAME)
-
-                        data['freq'] = freq
-                        data['pwr'] = pwr
+                        "hit on {} ({:.2f} > {:.2f}), stdev: {:.2f}"
+                        .format(freq, pwr, squelch, stdev),
+                        MOD_NAME)
 
-                        try:
-                            self.connector.senddat(data)
-                        except Exception as e:
-                            pass
+                    data['freq'] = freq
+                    data['pwr'] = pwr
 
-                freqmap[freq] = fent
-
-            time.sleep(LOOP_SLEEP)
+                    try:
+                        self.connector.senddat(data)
+                    except Exception as e:
+                        pass
 
         return
 
@@ -171,6 +172,9 @@ class GrfModuleScanner(GrfModuleBase):
         Settings:
             print_hits: Print hits as they occur
             hit_db: Hits are this high above the power average (dB)
+
+        Config [scanner] detector = peak (etc.) tests a spectrum detector
+        instead of the last sweep, so short bursts between passes count
     """
 
     def __init__(self, config):
@@ -180,6 +184,11 @@ class GrfModuleScanner(GrfModuleBase):
             hit_db = DEFAULT_HIT_DB
         hit_db = float(hit_db)
 
+        try:
+            self.detector = config['scanner']['detector']
+        except KeyError:
+            self.detector = None
+
         self.device_list = ["hackrf", "virtual"]
         self.description = "scanner module"
         self.settings = {'print_hits': False, 'hit_db': hit_db}
@@ -199,7 +208,14 @@ class GrfModuleScanner(GrfModuleBase):
                     MOD_NAME)
             return
 
-        self.worker = Scanner(system_mods, self.settings)
+        if self.detector and self.detector\
+                not in system_mods['spectrum'].detector_modes():
+            gammarf_util.console_message("spectrum detector {} is not "\
+                    "enabled in [spectrum] detectors".format(self.detector),
+                    MOD_NAME)
+            return
+
+        self.worker = Scanner(system_mods, self.settings, self.detector)
         self.worker.daemon = True
         self.worker.start()
 
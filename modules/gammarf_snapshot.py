@@ -38,7 +38,7 @@ def start(config):
 
 class Snapshot(threading.Thread):
     def __init__(self, lowfreq, highfreq, devid,
-            system_mods, settings, remotetask):
+            system_mods, settings, remotetask, detector=None):
 
         threading.Thread.__init__(self)
 
@@ -50,6 +50,7 @@ class Snapshot(threading.Thread):
         self.highfreq = highfreq
         self.devid = devid
         self.remotetask = remotetask
+        self.detector = detector
 
     def run(self):
         data = {}
@@ -58,21 +59,16 @@ class Snapshot(threading.Thread):
         data['module'] = MODULE_SNAPSHOT
         data['protocol'] = PROTOCOL_VERSION
 
-        freq = self.lowfreq
-        step = self.devmod.get_hackrf_step()
-        while freq <= self.highfreq:
-            pwr = str(self.spectrum.pwr(freq))
-            if not pwr:
-                continue
-
+        freqs, pwrs = self.spectrum.pwr_range(self.lowfreq, self.highfreq,
+                self.detector)
+        for freq, pwr in zip(freqs.tolist(), pwrs.tolist()):
             data['freq'] = freq
-            data['pwr'] = pwr
+            data['pwr'] = str(pwr)
             try:
                 self.connector.senddat(data)
             except:  # shutting down
                 pass
 
-            freq += step
             time.sleep(SEND_SLEEP)
 
         data['freq'] = 0  # inform server this is final
@@ -95,10 +91,18 @@ class GrfModuleSnapshot(GrfModuleBase):
 
         Example: > run snapshot 0 100M 200M
 
+        Config [snapshot] detector = peak (etc.) sends a spectrum detector's
+        output instead of the last sweep
+
         Settings:
     """
 
     def __init__(self, config):
+        try:
+            self.detector = config['snapshot']['detector']
+        except KeyError:
+            self.detector = None
+
         self.device_list = ["hackrf", "virtual"]
         self.description = "snapshot module"
         self.settings = {}
@@ -139,14 +143,28 @@ class GrfModuleSnapshot(GrfModuleBase):
             return
 
 
+        if system_mods['spectrum'].is_stale():
+            gammarf_util.console_message(
+                    "spectrum feed is down, not sending a stale snapshot",
+                    MOD_NAME)
+            return
+
         if highfreq - lowfreq > MAX_BW:
             gammarf_util.console_message(
                     "range exceeds maximum bandwidth of {}".format(MAX_BW),
                     MOD_NAME)
             return
 
+        if self.detector and self.detector\
+                not in system_mods['spectrum'].detector_modes():
+            gammarf_util.console_message("spectrum detector {} is not "\
+                    "enabled in [spectrum] detectors".format(self.detector),
+                    MOD_NAME)
+            return
+
         self.worker = Snapshot(int(lowfreq), int(highfreq),
-                devid, system_mods, self.settings, self.remotetask)
+                devid, system_mods, self.settings, self.remotetask,
+                self.detector)
         self.worker.daemon = True
         self.worker.start()
 
@@ -17,161 +17,1544 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
-import math
+import bisect
 import os
-import struct
+import select
 import subprocess
+import tempfile
 import threading
 import time
 import numpy as np
-from sys import builtin_module_names
+from collections import deque
+from hashlib import md5
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:  # python < 3.8, the freqmap goes in a mapped file
+    resource_tracker = shared_memory = None
 
 import gammarf_util
 from gammarf_base import GrfModuleBase
+from gammarf_cfar import CfarDetector, DEFAULT_CFAR_GUARD,\
+        DEFAULT_CFAR_METHOD, DEFAULT_CFAR_MIN_BINS, DEFAULT_CFAR_THRESHOLD,\
+        DEFAULT_CFAR_TRAIN
+from gammarf_detectors import DEFAULT_AVERAGE_SWEEPS, DEFAULT_EXP_ALPHA,\
+        DEFAULT_HOLD_DECAY, SweepDetectors
+from gammarf_directsweep import DEFAULT_DWELL, DEFAULT_FRAMES, DirectSweep,\
+        RecordSource
+from gammarf_occstats import DEFAULT_OCCUPANCY_MARGIN,\
+        DEFAULT_OCCUPANCY_SLICES, DEFAULT_OCCUPANCY_WINDOW,\
+        OccupancyCounters, channel_groups
+from gammarf_pipestats import Histogram
+from gammarf_pyramid import SpectrumPyramid
+from gammarf_publish import DEFAULT_PUBLISH_DECIMATE,\
+        DEFAULT_PUBLISH_FORMAT, DEFAULT_PUBLISH_HWM, SweepPublisher
+from gammarf_replay import RecordingTee, ReplaySource
+from gammarf_rtlsweep import DEFAULT_FRAMES as DEFAULT_RTL_FRAMES, RtlSweep
+from gammarf_sweepplan import PlanStream, build_runs, parse_plan,\
+        split_plan, sweep_command, sweep_process
+from gammarf_sweepstats import DEFAULT_EWMA_ALPHA, SweepStats
+from gammarf_waterfall import Waterfall
 
 
+BLOCK_DTYPE = np.dtype([('start', np.int64), ('end', np.int64),
+    ('reclen', np.int64), ('offset', np.int64)])
+DEFAULT_CACHE_INTERVAL = 300  # s
+DEFAULT_ENGINE = 'hackrf_sweep'
+DEFAULT_HISTORY_DEPTH = 600  # sweeps
+DEFAULT_HISTORY_FORMAT = 'int8'
+DEFAULT_HISTORY_INTERVAL = 1.0  # s
+DEFAULT_HISTORY_MB = 256
+DEFAULT_REPLAY_SPEED = 1.0  # relative to the recording, 0 is max speed
+DEFAULT_STALL_TIMEOUT = 10  # s without sweep data before a restart
 HRF_FREQ_BYTES = 8
+HRF_HEADER_DTYPE = np.dtype([('reclen', np.int32), ('start', np.int64),
+    ('end', np.int64)])
 HRF_PWR_BYTES = 4
+ENGINES = ('hackrf_sweep', 'direct')
 MOD_NAME = "spectrum"
+RATE_SWEEPS = 16  # sweeps averaged for the sweep rate
+READ_CHUNK = 256 * 1024  # bytes
+RECLEN_KEYS = 1 << 20  # record keys are start * RECLEN_KEYS + reclen
+RESTART_BACKOFF_MAX = 60  # s
+RESTART_BACKOFF_MIN = 1  # s
+RESTART_HEALTHY = 60  # s of feed before the backoff resets
+USB_RESET_TIMEOUT = 30  # s
+SHM_DIR = '/dev/shm'  # for mapped files, without shared_memory
+SHM_HEADER_DTYPE = np.dtype([('minfreq', np.int64), ('step', np.int64),
+    ('bins', np.int64), ('segments', np.int64), ('slots', np.int64),
+    ('seq', np.int64), ('cur', np.int64), ('ts', np.float64),
+    ('stale', np.int64), ('reads', np.int64), ('moved', np.int64)])
+SHM_SEGMENT_DTYPE = np.dtype([('minfreq', np.int64), ('step', np.int64),
+    ('offset', np.int64), ('bins', np.int64)])
+SHM_SLOT_DTYPE = np.dtype([('seq', np.int64), ('ts', np.float64)])
+SWEEP_SLOTS = 3  # freqmap ring depth
 
 
 def start(config, devmod):
     return GrfModuleSpectrum(config, devmod)
 
+def parse_opts(config, devmod=None):
+    """Spectrum worker options from [spectrum], [hackrfdevs] and [rtldevs]"""
+
+    opts = {'average_sweeps': DEFAULT_AVERAGE_SWEEPS,
+            'cache_dir': None,
+            'cache_interval': DEFAULT_CACHE_INTERVAL,
+            'cfar_guard': DEFAULT_CFAR_GUARD,
+            'cfar_method': DEFAULT_CFAR_METHOD,
+            'cfar_min_bins': DEFAULT_CFAR_MIN_BINS,
+            'cfar_threshold': DEFAULT_CFAR_THRESHOLD,
+            'cfar_train': DEFAULT_CFAR_TRAIN,
+            'detectors': (),
+            'direct_dwell': DEFAULT_DWELL,
+            'direct_frames': DEFAULT_FRAMES,
+            'engine': DEFAULT_ENGINE,
+            'ewma_alpha': DEFAULT_EWMA_ALPHA,
+            'exp_alpha': DEFAULT_EXP_ALPHA,
+            'hackrf_cmd': None,
+            'hackrf_serials': [],
+            'history_depth': DEFAULT_HISTORY_DEPTH,
+            'history_file': None,
+            'history_format': DEFAULT_HISTORY_FORMAT,
+            'history_interval': DEFAULT_HISTORY_INTERVAL,
+            'history_mb': DEFAULT_HISTORY_MB,
+            'hold_decay': DEFAULT_HOLD_DECAY,
+            'lna_gain': None,
+            'maxfreq': None,
+            'minfreq': None,
+            'occupancy_margin': DEFAULT_OCCUPANCY_MARGIN,
+            'occupancy_threshold': None,
+            'occupancy_window': DEFAULT_OCCUPANCY_WINDOW,
+            'plan': None,
+            'publish_addr': None,
+            'publish_decimate': DEFAULT_PUBLISH_DECIMATE,
+            'publish_format': DEFAULT_PUBLISH_FORMAT,
+            'publish_hwm': DEFAULT_PUBLISH_HWM,
+            'pyramid': True,
+            'record_file': None,
+            'replay_file': None,
+            'replay_loop': False,
+            'replay_speed': DEFAULT_REPLAY_SPEED,
+            'rtl_devs': None,
+            'rtl_frames': DEFAULT_RTL_FRAMES,
+            'stall_timeout': DEFAULT_STALL_TIMEOUT,
+            'usb_reset': None,
+            'vga_gain': None,
+            'width': None}
+
+    if devmod:
+        opts['minfreq'] = devmod.get_hackrf_minfreq()
+        opts['maxfreq'] = devmod.get_hackrf_maxfreq()
+        opts['width'] = devmod.get_hackrf_step()
+        opts['lna_gain'] = devmod.get_hackrf_lnagain()
+        opts['vga_gain'] = devmod.get_hackrf_vgagain()
+        opts['hackrf_serials'] = devmod.get_hackrf_serials()
+
+        opts['rtl_devs'] = devmod.get_spectrum_rtldevs()
+
+    opts['plan'] = parse_plan(config['hackrfdevs'] if 'hackrfdevs' in config
+            else None, opts['minfreq'], opts['maxfreq'], opts['width'])
+
+    if 'hackrfdevs' in config:
+        if 'direct_dwell' in config['hackrfdevs']:
+            opts['direct_dwell'] = int(config['hackrfdevs']['direct_dwell'])
+
+        if 'direct_frames' in config['hackrfdevs']:
+            opts['direct_frames'] = int(
+                    config['hackrfdevs']['direct_frames'])
+
+        if 'engine' in config['hackrfdevs']:
+            opts['engine'] = config['hackrfdevs']['engine']
+            if opts['engine'] not in ENGINES:
+                raise Exception("invalid sweep engine: {}"
+                        .format(opts['engine']))
+
+        if 'hackrf_path' in config['hackrfdevs']:
+            opts['hackrf_cmd'] = config['hackrfdevs']['hackrf_path']\
+                    + '/' + 'hackrf_sweep'
+
+        if 'record_file' in config['hackrfdevs']:
+            opts['record_file'] = config['hackrfdevs']['record_file']
+
+        if 'replay_file' in config['hackrfdevs']:
+            opts['replay_file'] = config['hackrfdevs']['replay_file']
+
+        if 'replay_loop' in config['hackrfdevs']:
+            opts['replay_loop'] = config['hackrfdevs'].getboolean(
+                    'replay_loop')
+
+        if 'replay_speed' in config['hackrfdevs']:
+            opts['replay_speed'] = float(
+                    config['hackrfdevs']['replay_speed'])
+
+        if 'stall_timeout' in config['hackrfdevs']:
+            opts['stall_timeout'] = float(
+                    config['hackrfdevs']['stall_timeout'])
+
+        if 'usb_reset' in config['hackrfdevs']:
+            opts['usb_reset'] = config['hackrfdevs']['usb_reset']
+
+    if opts['rtl_devs']:  # no hackrf, dongles stand in for it
+        opts['engine'] = 'rtlsdr'
+
+    if 'rtldevs' in config:
+        if 'spectrum_frames' in config['rtldevs']:
+            opts['rtl_frames'] = int(config['rtldevs']['spectrum_frames'])
+
+    if 'spectrum' in config:
+        if 'average_sweeps' in config['spectrum']:
+            opts['average_sweeps'] = int(config['spectrum']['average_sweeps'])
+
+        if 'cache_dir' in config['spectrum']:
+            opts['cache_dir'] = config['spectrum']['cache_dir']
+            os.makedirs(opts['cache_dir'], exist_ok=True)
+
+        if 'cache_interval' in config['spectrum']:
+            opts['cache_interval'] = int(config['spectrum']['cache_interval'])
+
+        if 'cfar_guard' in config['spectrum']:
+            opts['cfar_guard'] = int(config['spectrum']['cfar_guard'])
+
+        if 'cfar_method' in config['spectrum']:
+            opts['cfar_method'] = config['spectrum']['cfar_method']
+
+        if 'cfar_min_bins' in config['spectrum']:
+            opts['cfar_min_bins'] = int(config['spectrum']['cfar_min_bins'])
+
+        if 'cfar_threshold' in config['spectrum']:
+            opts['cfar_threshold'] = float(
+                    config['spectrum']['cfar_threshold'])
+
+        if 'cfar_train' in config['spectrum']:
+            opts['cfar_train'] = int(config['spectrum']['cfar_train'])
+
+        if 'detectors' in config['spectrum']:
+            opts['detectors'] = tuple(mode.strip() for mode
+                    in config['spectrum']['detectors'].split(',')
+                    if mode.strip())
+
+        if 'ewma_alpha' in config['spectrum']:
+            opts['ewma_alpha'] = float(config['spectrum']['ewma_alpha'])
+
+        if 'exp_alpha' in config['spectrum']:
+            opts['exp_alpha'] = float(config['spectrum']['exp_alpha'])
+
+        if 'history_file' in config['spectrum']:
+            opts['history_file'] = config['spectrum']['history_file']
+
+        if 'history_depth' in config['spectrum']:
+            opts['history_depth'] = int(config['spectrum']['history_depth'])
+
+        if 'history_format' in config['spectrum']:
+            opts['history_format'] = config['spectrum']['history_format']
+
+        if 'history_interval' in config['spectrum']:
+            opts['history_interval'] = float(
+                    config['spectrum']['history_interval'])
+
+        if 'history_mb' in config['spectrum']:
+            opts['history_mb'] = int(config['spectrum']['history_mb'])
+
+        if 'hold_decay' in config['spectrum']:
+            opts['hold_decay'] = float(config['spectrum']['hold_decay'])
+
+        if 'occupancy_margin' in config['spectrum']:
+            opts['occupancy_margin'] = float(
+                    config['spectrum']['occupancy_margin'])
+
+        if 'occupancy_threshold' in config['spectrum']:
+            opts['occupancy_threshold'] = float(
+                    config['spectrum']['occupancy_threshold'])
+
+        if 'occupancy_window' in config['spectrum']:
+            opts['occupancy_window'] = float(
+                    config['spectrum']['occupancy_window'])
+
+        if 'publish_addr' in config['spectrum']:
+            opts['publish_addr'] = config['spectrum']['publish_addr']
+
+        if 'publish_decimate' in config['spectrum']:
+            opts['publish_decimate'] = int(
+                    config['spectrum']['publish_decimate'])
+
+        if 'publish_format' in config['spectrum']:
+            opts['publish_format'] = config['spectrum']['publish_format']
+
+        if 'publish_hwm' in config['spectrum']:
+            opts['publish_hwm'] = int(config['spectrum']['publish_hwm'])
+
+        if 'pyramid' in config['spectrum']:
+            opts['pyramid'] = config['spectrum'].getboolean('pyramid')
+
+    if opts['occupancy_window'] and opts['occupancy_threshold'] is None\
+            and opts['cfar_method'] == 'none':
+        raise Exception("occupancy needs cfar for its noise floor, or an "\
+                "occupancy_threshold")
+
+    return opts
+
+def segment_binfreqs(segments):
+    """Frequency of every freqmap bin, from the segment table"""
+
+    index = np.repeat(np.arange(len(segments)), segments['bins'])
+    segment = segments[index]
+    return segment['minfreq'] + (np.arange(len(index), dtype=np.int64)
+            - segment['offset']) * segment['step']
+
+def record_dtype(pwr_entries):
+    return np.dtype(HRF_HEADER_DTYPE.descr
+            + [('pwr', np.float32, (pwr_entries,))])
+
+def record_keys(starts, reclens):
+    return np.asarray(starts, dtype=np.int64) * RECLEN_KEYS + reclens
+
+
+class SweepFeedError(Exception):
+    """The sweep stream stalled or produced something unparseable"""
+    pass
+
+
+class SweepReader():
+    """Chunked reader for the hackrf_sweep binary (-B) record stream"""
+
+    def __init__(self, stream, chunk=READ_CHUNK, timeout=None):
+        self.stream = stream
+        self.timeout = timeout
+        self.buf = bytearray(chunk)
+        self.view = memoryview(self.buf)
+        self.head = 0  # first unparsed byte
+        self.tail = 0  # end of valid data
+        self.bytes_read = 0
+
+    def fill(self):
+        if self.head:  # move the partial record to the front
+            remain = self.tail - self.head
+            self.view[:remain] = self.view[self.head:self.tail]
+            self.head = 0
+            self.tail = remain
+
+        if self.tail == len(self.buf):
+            raise SweepFeedError("record larger than read buffer")
+
+        while True:
+            if self.timeout:
+                ready, _, _ = select.select([self.stream], [], [],
+                        self.timeout)
+                if not ready:
+                    raise SweepFeedError("no sweep data for {}s"
+                            .format(self.timeout))
+
+            nread = self.stream.readinto(self.view[self.tail:])
+            if nread is not None:  # None: the source moved to a new run
+                break
+
+        if not nread:
+            raise EOFError("end of sweep stream")
+
+        self.tail += nread
+        self.bytes_read += nread
+        return nread
+
+    def need(self, nbytes):
+        while self.tail - self.head < nbytes:
+            self.fill()
+
+    def header(self):
+        """Peek at the next record header: (reclen, start, end)"""
+        self.need(HRF_HEADER_DTYPE.itemsize)
+        hdr = np.frombuffer(self.buf, dtype=HRF_HEADER_DTYPE, count=1,
+                offset=self.head)[0]
+        return int(hdr['reclen']), int(hdr['start']), int(hdr['end'])
+
+    def skip(self, nbytes):
+        self.need(nbytes)
+        self.head += nbytes
+
+    def records(self, rec_dtype):
+        """Return the buffered run of complete records of this size as a
+        view into the buffer.
+
+        The view is only valid until the next call into the reader.
+        """
+        if self.tail - self.head < rec_dtype.itemsize:
+            self.fill()
+
+        count = (self.tail - self.head) // rec_dtype.itemsize
+        recs = np.frombuffer(self.buf, dtype=rec_dtype, count=count,
+                offset=self.head)
+
+        # runs of another width follow at a different stride
+        other = np.flatnonzero(recs['reclen'] != rec_dtype.itemsize - 4)
+        if len(other):
+            recs = recs[:other[0]]
+
+        self.head += len(recs) * rec_dtype.itemsize
+        return recs
+
+
+class MergedSweep(RecordSource):
+    """Merge the record streams of several HackRFs into one
+
+    A thread per device drains its stream (a hackrf_sweep -B stream or
+    a RecordSource) and queues the records as they come, so the devices
+    sweep their shares of the plan in parallel.  origin maps each record
+    start to the index of the device sweeping it.  If any device fails
+    the merged stream fails, and the worker restarts them all.
+    """
+
+    def __init__(self, devices, timeout=None):
+        RecordSource.__init__(self, timeout)
+        self.devices = devices  # (serial, source)
+        self.origin = {}
+        self.closed = False
+
+        self.feeders = []
+        for index, (serial, source) in enumerate(devices):
+            feeder = threading.Thread(target=self.drain,
+                    args=(index, serial, source))
+            feeder.daemon = True
+            self.feeders.append(feeder)
+
+        for feeder in self.feeders:
+            feeder.start()
+
+    def drain(self, index, serial, source):
+        if isinstance(source, RecordSource):
+            reader = source
+        else:
+            reader = SweepReader(source, timeout=self.timeout)
+
+        rec_dtypes = {}
+        try:
+            while not self.closed:
+                reclen = reader.header()[0]
+                entries = (reclen - HRF_FREQ_BYTES * 2) // HRF_PWR_BYTES
+                if entries <= 0:
+                    raise SweepFeedError("malformed record header")
+                if reclen not in rec_dtypes:
+                    rec_dtypes[reclen] = record_dtype(entries)
+
+                recs = reader.records(rec_dtypes[reclen]).copy()
+                for start in np.unique(recs['start']).tolist():
+                    if start not in self.origin:
+                        self.origin[start] = index
+
+                self.bytes_read += recs.nbytes
+                self.put(recs)
+
+        except Exception as e:
+            if not self.closed:
+                self.fail("hackrf {}: {}".format(serial,
+                    e or type(e).__name__))
+
+    def close(self):
+        self.closed = True
+        for serial, source in self.devices:
+            try:
+                source.close()
+            except Exception:
+                pass
+
+        for feeder in self.feeders:
+            feeder.join(1)
+
 
-class SpectrumWorker(threading.Thread):
-    def __init__(self, devmod, hackrf_cmd):
+class MappedFile():
+    """A file in SHM_DIR mapped with np.memmap, standing in for a
+    shared_memory block where there is none (python < 3.8)
+
+    Named by its path; only buf, name, close() and unlink() are offered.
+    """
+
+    def __init__(self, name=None, create=False, size=0):
+        if create:
+            fd, name = tempfile.mkstemp(prefix='gammarf-', dir=SHM_DIR
+                    if os.path.isdir(SHM_DIR) else None)
+            os.close(fd)
+            self.buf = np.memmap(name, dtype=np.uint8, mode='w+',
+                    shape=(size,))
+        else:
+            self.buf = np.memmap(name, dtype=np.uint8, mode='r+')
+        self.name = name
+
+    def close(self):
+        self.buf = None  # unmapped once the last view of it is freed
+
+    def unlink(self):
+        try:
+            os.remove(self.name)
+        except FileNotFoundError:
+            pass
+
+
+class FreqmapReader():
+    """Freqmap lookups shared by the spectrum worker and its view
+
+    Sweeps land in a ring of buffers.  Readers copy out of the newest
+    completed one and retry if the writer reclaimed it mid-read.
+    """
+
+    def map_freqmap(self, buf):
+        self.header = np.ndarray(1, dtype=SHM_HEADER_DTYPE, buffer=buf)
+        self.firstfreq = int(self.header['minfreq'][0])
+        self.step = int(self.header['step'][0])
+        self.bins = int(self.header['bins'][0])
+
+        nsegments = int(self.header['segments'][0])
+        offset = SHM_HEADER_DTYPE.itemsize
+        self.segments = np.ndarray(nsegments, dtype=SHM_SEGMENT_DTYPE,
+                buffer=buf, offset=offset)
+        offset += nsegments * SHM_SEGMENT_DTYPE.itemsize
+
+        nslots = int(self.header['slots'][0])
+        self.slottab = np.ndarray(nslots, dtype=SHM_SLOT_DTYPE, buffer=buf,
+                offset=offset)
+        offset += nslots * SHM_SLOT_DTYPE.itemsize
+        self.slots = np.ndarray((nslots, self.bins), dtype=np.float32,
+                buffer=buf, offset=offset)
+
+        self.binfreqs = segment_binfreqs(self.segments)
+
+    def follow(self):
+        """Catch up with a freqmap the worker has moved (relaid out)"""
+        pass
+
+    def read(self, index):
+        """Copy freqmap[index] out of the newest completed sweep"""
+        return self.read_sweep(index)[2]
+
+    def read_sweep(self, index):
+        """(seq, ts, freqmap[index]) of the newest completed sweep"""
+
+        # unlocked: readers in different processes may rarely lose a count
+        self.follow()
+        self.header['reads'] += 1
+        while True:
+            cur = int(self.header['cur'][0])
+            seq = int(self.slottab['seq'][cur])
+            if seq < 0:  # reclaimed by the writer since we looked
+                continue
+
+            ts = float(self.slottab['ts'][cur])
+            pwrs = self.slots[cur][index].copy()
+            if self.slottab['seq'][cur] == seq:
+                return seq, ts, pwrs
+
+    def sweep_info(self):
+        """Sequence number and capture time of the newest sweep"""
+        self.follow()
+        return int(self.header['seq'][0]), float(self.header['ts'][0])
+
+    def segment_table(self):
+        """Copy of the (minfreq, step, offset, bins) segment table"""
+        self.follow()
+        return self.segments.copy()
+
+    def is_stale(self):
+        """True while the sweep feed is down and the freqmap is frozen"""
+        self.follow()
+        return bool(self.header['stale'][0])
+
+    def freqbin(self, freq):
+        freqbins, valid = self.freqbins([freq])
+        if not valid[0]:
+            return -1
+        return int(freqbins[0])
+
+    def pwr(self, freq):
+        freqbin = self.freqbin(freq)
+        if freqbin < 0 or freqbin >= self.bins:
+            return
+
+        return float(self.read(freqbin))
+
+    def freqbins(self, freqs):
+        """Return bins for a list of frequencies and which are in range"""
+
+        self.follow()
+        freqs = np.asarray(freqs, dtype=np.int64)
+        segments = self.segments
+
+        index = np.searchsorted(segments['minfreq'], freqs, 'right') - 1
+        segment = segments[np.maximum(index, 0)]
+        freqbins = (freqs - segment['minfreq']) // segment['step']
+        valid = (index >= 0) & (freqbins < segment['bins'])
+        return freqbins + segment['offset'], valid
+
+    def bin_range(self, lowfreq, highfreq):
+        """First and last bins holding frequencies in [lowfreq, highfreq]"""
+
+        self.follow()
+        lowbin = self.freqbin(lowfreq)
+        if lowbin < 0:  # in a gap between segments
+            lowbin = int(np.searchsorted(self.binfreqs, lowfreq))
+        highbin = int(np.searchsorted(self.binfreqs, highfreq, 'right')) - 1
+        return lowbin, highbin
+
+    def pwr_many(self, freqs, detector=None):
+        if detector:  # held or averaged, from the worker
+            return self.detector_many(freqs, detector)
+
+        freqbins, valid = self.freqbins(freqs)
+
+        pwrs = np.full(len(freqbins), np.nan, dtype=np.float32)
+        pwrs[valid] = self.read(freqbins[valid])
+        return pwrs
+
+    def pwr_range(self, lowfreq, highfreq, detector=None):
+        if detector:
+            return self.detector_range(lowfreq, highfreq, detector)
+
+        lowbin, highbin = self.bin_range(lowfreq, highfreq)
+        if highbin < lowbin:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        return self.binfreqs[lowbin:highbin + 1].copy(),\
+                self.read(slice(lowbin, highbin + 1))
+
+
+class SpectrumWorker(FreqmapReader, threading.Thread):
+    def __init__(self, devmod, opts):
         self.stoprequest = threading.Event()
         threading.Thread.__init__(self)
 
         self.devmod = devmod
+        self.opts = opts
+        self.detector = None
+        self.detectors = None  # peak/min hold and averages, if configured
+        self.pyramid = None  # coarse max/mean levels for band queries
+        self.occupancy = None
+        self.channels = None  # (segments, width, groups, channels)
+        self.emitters = None
+        self.stats = None
+        self.waterfall = None
 
-        self.freqmap = None
         self.freqmap_ready = False
+        self.header = None
+        self.shm = None
+        self.retired = []  # blocks of earlier layouts, views may map them
+        self.back = None  # slot being filled
+        self.sweep_cond = threading.Condition()
 
-        self.maxfreq = int(devmod.get_hackrf_maxfreq()*1e6)
-        self.minfreq = int(devmod.get_hackrf_minfreq()*1e6)
+        self.firstfreq = None
         self.step = None
+        self.wrapfreq = None  # start of the record that begins each sweep
+        self.blocks = None
+        self.block_ts = None  # capture time of each block's newest record
+        self.fresh = None  # blocks stored since the last complete pass
+        self.rec_dtypes = None
+        self.known_recs = None  # sorted keys of every record calibrated
+
+        self.sweeps = 0
+        self.sweeps_fed = 0  # sweeps read this session, not restored
+        self.sweep_times = deque(maxlen=RATE_SWEEPS)
 
-        fstr = "{}:{}".format(devmod.get_hackrf_minfreq(),
-                devmod.get_hackrf_maxfreq())
-        width = devmod.get_hackrf_step()
-        lna_gain = devmod.get_hackrf_lnagain()
-        vga_gain = devmod.get_hackrf_vgagain()
-
-        ON_POSIX = 'posix' in builtin_module_names
-        self.cmdpipe = subprocess.Popen([
-            hackrf_cmd,
-            "-f {}".format(fstr),
-            "-w {}".format(width),
-            "-l {}".format(lna_gain),
-            "-g {}".format(vga_gain),
-            "-B",
-            "-a 1"],
-            stdout=subprocess.PIPE,
-            stderr=open(os.devnull, 'w'),
-            close_fds=ON_POSIX)
+        # instrumentation, cheap enough to leave on
+        self.bytes_prior = 0  # read by streams since closed
+        self.records_ingested = 0
+        self.read_samples = deque(maxlen=RATE_SWEEPS)  # (ts, reads)
+        self.sweep_hist = Histogram(1e-3, 1e3, 's')
+        self.parse_hist = Histogram(1e-7, 1e-1, 's')  # per record
+        self.publish_hist = Histogram(1e-5, 1e1, 's')
+        self.age_hist = Histogram(1e-2, 1e4, 's')
+        self.publish_time = 0.0  # spent in sweep_complete by this ingest
+
+        # feed health
+        self.started = time.time()
+        self.feed_started = None
+        self.outage_started = None
+        self.outages = 0
+        self.restarts = 0
+        self.downtime = 0.0
+        self.last_error = None
+
+        if opts['replay_file']:
+            source = "replay {}".format(opts['replay_file'])
+        elif opts['engine'] == 'rtlsdr':
+            source = "rtl {} w{} f{}".format([(dev['serial'], dev['minfreq'],
+                dev['maxfreq']) for dev in opts['rtl_devs']], opts['width'],
+                opts['rtl_frames'])
+        elif len(opts['hackrf_serials']) > 1:  # a share of the plan each
+            self.devices = [(serial, share, build_runs(share))
+                    for serial, share in zip(opts['hackrf_serials'],
+                        split_plan(opts['plan'], len(opts['hackrf_serials'])))]
+            source = "{} {}".format(opts['engine'],
+                    [(serial, runs) for serial, share, runs in self.devices])
+            if opts['engine'] == 'direct':
+                source += " dwell {} frames {}".format(opts['direct_dwell'],
+                        opts['direct_frames'])
+        elif opts['engine'] == 'direct':
+            self.runs = build_runs(opts['plan'])
+            source = "direct {} dwell {} frames {}".format(self.runs,
+                    opts['direct_dwell'], opts['direct_frames'])
+        else:
+            runs = build_runs(opts['plan'])
+            self.cmds = [sweep_command(opts['hackrf_cmd'], width, ranges,
+                opts['lna_gain'], opts['vga_gain'], oneshot=len(runs) > 1)
+                for width, ranges in runs]
+            source = "p{}".format(runs)
+
+        self.cmdpipe = None
+        self.tee = None
+        self.open_stream()
+
+        # cached layout, freqmap and baselines, keyed by the sweep params
+        self.cache_path = None
+        self.cache_key = "{} l{} g{}".format(source, opts['lna_gain'],
+                opts['vga_gain'])
+        self.cache_saved = time.time()
+        if opts['cache_dir']:
+            self.cache_path = os.path.join(opts['cache_dir'],
+                    "spectrum_{}.npz".format(md5(self.cache_key
+                        .encode('utf-8')).hexdigest()[:12]))
+            self.warm_start()
+
+        # local subscribers get every sweep, off the acquisition thread
+        self.publisher = None
+        if opts['publish_addr']:
+            self.publisher = SweepPublisher(self, opts['publish_addr'],
+                    opts['publish_format'], opts['publish_decimate'],
+                    opts['publish_hwm'])
+            self.publisher.daemon = True
+            self.publisher.start()
 
     def run(self):
-        firstfreq = None
-        total_freqs = 0
-        while True:
+        backoff = RESTART_BACKOFF_MIN
+        while not self.stoprequest.isSet():
+            self.feed_started = time.time()
             try:
-                reclen, start, end = struct.unpack('=iqq',
-                        self.cmdpipe.stdout.read(20))
-            except:
-                raise Exception("Problem communicating with HACKRF - exit and restart")
+                self.feed()
+            except EOFError:
+                if self.opts['replay_file']:
+                    gammarf_util.console_message("replay finished", MOD_NAME)
+                    return
+                error = "hackrf_sweep exited"
+            except (OSError, SweepFeedError) as e:
+                error = str(e)
+            except Exception as e:  # a bug, say; restart rather than die
+                error = "{}: {}".format(type(e).__name__, e)
+            else:
+                return
+
+            if self.stoprequest.isSet():  # shutting down
+                return
+
+            if time.time() - self.feed_started >= RESTART_HEALTHY:
+                backoff = RESTART_BACKOFF_MIN
+
+            self.feed_down(error, backoff)
+            if self.stoprequest.wait(backoff):
+                return
+            backoff = min(backoff * 2, RESTART_BACKOFF_MAX)
+
+            self.close_stream()
+            if self.opts['usb_reset']:
+                self.usb_reset()
+            self.open_stream()
+            self.restarts += 1
+
+        return
+
+    def feed(self):
+        """Read sweeps until asked to stop"""
+
+        if not self.freqmap_ready:
+            self.setup(self.calibrate())
+        else:  # cached or earlier layout; check it against the stream
+            self.recalibrate()
+
+        self.pending = 0  # records stored since the last completed sweep
+        while not self.stoprequest.isSet():
+            reclen = self.reader.header()[0]
+            if reclen not in self.rec_dtypes:
+                if reclen <= HRF_FREQ_BYTES * 2\
+                        or (reclen - HRF_FREQ_BYTES * 2) % HRF_PWR_BYTES:
+                    raise SweepFeedError("malformed record header")
+                self.recalibrate()  # records of a size we have not seen
+                continue
+
+            recs = self.reader.records(self.rec_dtypes[reclen])
+            started = time.perf_counter()
+            self.publish_time = 0.0
+            if not self.ingest(recs):
+                self.recalibrate()
+                continue
+            if len(recs):
+                self.records_ingested += len(recs)
+                self.parse_hist.observe((time.perf_counter() - started
+                    - self.publish_time) / len(recs), len(recs))
+
+    def open_stream(self):
+        opts = self.opts
+
+        if opts['replay_file']:
+            source = ReplaySource(opts['replay_file'], opts['replay_speed'],
+                    opts['replay_loop'])
+            gammarf_util.console_message("replaying {} at speed {}"
+                    .format(opts['replay_file'], opts['replay_speed']),
+                    MOD_NAME)
 
-            if not firstfreq:
-                firstfreq = start
+        elif opts['engine'] == 'rtlsdr':
+            source = RtlSweep(opts['rtl_devs'], opts['width'],
+                    opts['rtl_frames'], opts['stall_timeout'])
+
+        elif len(opts['hackrf_serials']) > 1:
+            devices = []
+            for serial, share, runs in self.devices:
+                if opts['engine'] == 'direct':
+                    device = DirectSweep(share, runs, opts['lna_gain'],
+                            opts['vga_gain'], opts['direct_dwell'],
+                            opts['direct_frames'], opts['stall_timeout'],
+                            serial)
+                else:
+                    device = PlanStream([sweep_command(opts['hackrf_cmd'],
+                        width, ranges, opts['lna_gain'], opts['vga_gain'],
+                        oneshot=len(runs) > 1, serial=serial)
+                        for width, ranges in runs])
+                devices.append((serial, device))
+
+            source = MergedSweep(devices, opts['stall_timeout'])
+            gammarf_util.console_message("sweeping with {} hackrfs"
+                    .format(len(devices)), MOD_NAME)
+
+        elif opts['engine'] == 'direct':
+            source = DirectSweep(opts['plan'], self.runs, opts['lna_gain'],
+                    opts['vga_gain'], opts['direct_dwell'],
+                    opts['direct_frames'], opts['stall_timeout'])
+
+        elif len(self.cmds) == 1:
+            self.cmdpipe = sweep_process(self.cmds[0])
+            source = self.cmdpipe.stdout
+
+        else:  # widths differ, or too many ranges for one hackrf_sweep
+            source = PlanStream(self.cmds)
+
+        self.source = source
+        if opts['record_file']:
+            if not self.tee:
+                self.tee = RecordingTee(source, opts['record_file'])
+                gammarf_util.console_message("recording sweeps to {}"
+                        .format(opts['record_file']), MOD_NAME)
+            self.tee.stream = source  # restarts keep one recording
+
+            if isinstance(source, RecordSource):  # records, not a byte stream
+                source.tee = self.tee
             else:
-                if start == firstfreq:
+                source = self.tee
+
+        self.stream = source
+        if isinstance(source, RecordSource):  # reads like a SweepReader
+            self.reader = source
+            return
+
+        timeout = None if opts['replay_file'] else opts['stall_timeout']
+        self.reader = SweepReader(source, timeout=timeout)
+
+    def close_stream(self):
+        self.bytes_prior += self.reader.bytes_read
+
+        if self.cmdpipe:
+            self.cmdpipe.kill()
+            self.cmdpipe.wait()
+            self.cmdpipe = None
+
+        try:
+            self.source.close()
+        except Exception:
+            pass
+
+    def usb_reset(self):
+        try:
+            subprocess.call(self.opts['usb_reset'], shell=True,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    timeout=USB_RESET_TIMEOUT)
+        except Exception as e:
+            gammarf_util.console_message("usb reset failed: {}".format(e),
+                    MOD_NAME)
+
+    def feed_down(self, error, backoff):
+        if not self.outage_started:
+            self.outage_started = self.sweep_times[-1] if self.sweep_times\
+                    else self.feed_started
+            self.outages += 1
+            if self.header is not None:
+                self.header['stale'] = 1
+
+        self.last_error = error
+        gammarf_util.console_message("sweep feed down ({}), restarting in {}s"
+                .format(error, backoff), MOD_NAME)
+
+    def feed_status(self):
+        now = time.time()
+        downtime = self.downtime
+        if self.outage_started:
+            downtime += now - self.outage_started
+
+        return {'stale': bool(self.outage_started),
+                'outages': self.outages,
+                'restarts': self.restarts,
+                'downtime': downtime,
+                'uptime': 1.0 - downtime / max(now - self.started, 1e-9),
+                'last_error': self.last_error,
+                'devices': self.opts['hackrf_serials']}
+
+    def setup(self, segments):
+        """Allocate the freqmap and everything sized by it"""
+
+        total_freqs = int(segments['bins'].sum())
+        self.share_freqmap(segments)
+        self.stats = SweepStats(total_freqs, self.opts['ewma_alpha'])
+
+        if self.opts['pyramid']:
+            self.pyramid = SpectrumPyramid(total_freqs)
+
+        if self.opts['occupancy_window']:
+            self.occupancy = OccupancyCounters(total_freqs,
+                    self.opts['occupancy_window'], DEFAULT_OCCUPANCY_SLICES,
+                    self.opts['occupancy_threshold'],
+                    self.opts['occupancy_margin'])
+
+        if self.opts['detectors']:
+            self.detectors = SweepDetectors(total_freqs,
+                    self.opts['detectors'], self.opts['hold_decay'],
+                    self.opts['average_sweeps'], self.opts['exp_alpha'])
+
+        if self.opts['cfar_method'] != 'none':
+            self.detector = CfarDetector(self.segments,
+                    self.opts['cfar_method'],
+                    self.opts['cfar_guard'], self.opts['cfar_train'],
+                    self.opts['cfar_threshold'], self.opts['cfar_min_bins'])
+
+        if self.opts['history_file']:
+            self.waterfall = Waterfall(self.opts['history_file'],
+                    self.firstfreq, self.step, total_freqs,
+                    self.opts['history_depth'],
+                    self.opts['history_format'],
+                    self.opts['history_mb'] * 1e6,
+                    self.opts['history_interval'])
+
+    def warm_start(self):
+        """Serve the cached layout, freqmap and baselines straight away"""
+
+        if not os.path.isfile(self.cache_path):
+            return
+
+        try:
+            with np.load(self.cache_path) as cache:
+                if str(cache['key']) != self.cache_key:
+                    return
+
+                wrapfreq = int(cache['wrapfreq'])
+                starts = cache['block_start']
+                ends = cache['block_end']
+                reclens = cache['block_reclen']
+                ts = float(cache['ts'])
+                freqmap = cache['freqmap']
+                stats = {key: cache[key] for key in cache.files
+                        if key.startswith('stats_')}
+        except Exception as e:
+            gammarf_util.console_message("ignoring unreadable cache: {}"
+                    .format(e), MOD_NAME)
+            return
+
+        self.wrapfreq = wrapfreq
+        self.setup(self.layout(starts, ends, reclens))
+        self.stats.restore(stats)
+        self.slots[self.back] = freqmap
+        self.publish(ts)
+
+        gammarf_util.console_message("warm start from cached sweep ({:.0f}s old)"
+                .format(time.time() - ts), MOD_NAME)
+
+    def save_cache(self):
+        front = int(self.header['cur'][0])
+        tmp = self.cache_path + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, key=self.cache_key, wrapfreq=self.wrapfreq,
+                    block_start=self.blocks['start'],
+                    block_end=self.blocks['end'],
+                    block_reclen=self.blocks['reclen'],
+                    ts=self.slottab['ts'][front],
+                    freqmap=self.slots[front], **self.stats.state())
+        os.replace(tmp, self.cache_path)
+        self.cache_saved = time.time()
+
+    def calibrate(self):
+        """Learn the sweep layout, reading sweeps until one adds nothing
+
+        Each distinct record start becomes a block of the freqmap; where
+        records overlap, the first seen (the heaviest segment) wins.
+        """
+
+        starts, ends, reclens = [], [], []
+        seen = set()
+        added = True
+        self.wrapfreq = None
+        while True:
+            reclen, start, end = self.reader.header()
+
+            if self.wrapfreq is None:
+                self.wrapfreq = start
+            elif start == self.wrapfreq:
+                if not added:
                     break
+                added = False
 
-            pwr_entries = int((reclen - (HRF_FREQ_BYTES * 2))
-                    / HRF_PWR_BYTES)
+            i = bisect.bisect(starts, start)
+            if not (i and ends[i - 1] > start)\
+                    and not (i < len(starts) and starts[i] < end):
+                starts.insert(i, start)
+                ends.insert(i, end)
+                reclens.insert(i, reclen)
+                added = True
 
-            if not self.step:
-                self.step = int((end - start) / pwr_entries)
-                self.devmod.set_hackrf_step(self.step)
+            seen.add(int(record_keys(start, reclen)))
+            self.reader.skip(4 + reclen)
 
-            try:
-                self.cmdpipe.stdout.read(HRF_PWR_BYTES * pwr_entries)
-            except:
-                raise Exception("Problem communicating with HACKRF - exit and restart")
+        self.known_recs = np.array(sorted(seen), dtype=np.int64)
+        return self.layout(starts, ends, reclens)
 
-            total_freqs += pwr_entries
+    def recalibrate(self):
+        """Check the layout against the stream; if it has changed, drop
+        the cache and lay out a new freqmap in place"""
 
-        self.freqmap = np.empty(total_freqs)
-        while not self.stoprequest.isSet():
+        blocks, block_ts = self.blocks, self.block_ts
+        segments = self.calibrate()
+        self.pending = 0
+        if np.array_equal(blocks, self.blocks):
+            self.block_ts = block_ts
+            return
+
+        gammarf_util.console_message("sweep layout changed, recalibrated",
+                MOD_NAME)
+        if self.cache_path and os.path.isfile(self.cache_path):
+            os.remove(self.cache_path)
+        if self.waterfall:
+            self.waterfall.flush()
+
+        self.freqmap_ready = False
+        self.emitters = None
+        self.setup(segments)
+
+    def layout(self, starts, ends, reclens):
+        """Place blocks in the freqmap; return the segment table"""
+
+        blocks = np.zeros(len(starts), dtype=BLOCK_DTYPE)
+        blocks['start'] = starts
+        blocks['end'] = ends
+        blocks['reclen'] = reclens
+
+        entries = (blocks['reclen'] - HRF_FREQ_BYTES * 2) // HRF_PWR_BYTES
+        steps = (blocks['end'] - blocks['start']) // entries
+        blocks['offset'] = np.cumsum(entries) - entries
+        self.blocks = blocks
+        self.block_ts = np.zeros(len(blocks), dtype=np.float64)
+        self.fresh = np.zeros(len(blocks), dtype=bool)  # since last pass
+        self.rec_dtypes = {int(reclen): record_dtype(int(count))
+                for reclen, count in zip(blocks['reclen'], entries)}
+
+        # contiguous blocks of one width make a segment
+        newseg = np.ones(len(blocks), dtype=bool)
+        newseg[1:] = (blocks['start'][1:] != blocks['start'][:-1]
+                + entries[:-1] * steps[:-1]) | (steps[1:] != steps[:-1])
+        first = np.flatnonzero(newseg)
+
+        segments = np.zeros(len(first), dtype=SHM_SEGMENT_DTYPE)
+        segments['minfreq'] = blocks['start'][first]
+        segments['step'] = steps[first]
+        segments['offset'] = blocks['offset'][first]
+        segments['bins'] = np.diff(np.append(segments['offset'],
+            entries.sum()))
+
+        if self.devmod:
+            lead = np.searchsorted(blocks['start'], self.wrapfreq)
+            self.devmod.set_hackrf_step(int(steps[lead]))
+
+        return segments
+
+    def share_freqmap(self, segments):
+        """Place the header, segment table and freqmap ring in a shared
+        memory block"""
+
+        total_freqs = int(segments['bins'].sum())
+        size = SHM_HEADER_DTYPE.itemsize\
+                + len(segments) * SHM_SEGMENT_DTYPE.itemsize\
+                + SWEEP_SLOTS * SHM_SLOT_DTYPE.itemsize\
+                + SWEEP_SLOTS * total_freqs * np.dtype(np.float32).itemsize
+
+        moved = self.header
+        if self.shm:  # relaid out: views follow once the old one is moved
+            self.retired.append(self.shm)
+            self.shm.unlink()
+
+        if shared_memory:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = MappedFile(create=True, size=size)
+        buf = self.shm.buf
+
+        header = np.ndarray(1, dtype=SHM_HEADER_DTYPE, buffer=buf)
+        header['minfreq'] = segments['minfreq'][0]
+        header['step'] = segments['step'][0]
+        header['bins'] = total_freqs
+        header['segments'] = len(segments)
+        header['slots'] = SWEEP_SLOTS
+        header['seq'] = 0
+        header['cur'] = 0
+        header['ts'] = 0
+        header['stale'] = 1 if self.outage_started else 0
+        header['reads'] = 0
+        header['moved'] = 0
+        np.ndarray(len(segments), dtype=SHM_SEGMENT_DTYPE, buffer=buf,
+                offset=SHM_HEADER_DTYPE.itemsize)[:] = segments
+
+        self.map_freqmap(buf)
+        self.slottab[:] = 0
+        self.slots[:] = 0
+
+        self.back = 1
+        self.slottab['seq'][self.back] = -1
+
+        if moved is not None:
+            moved['moved'] = 1
+
+    def shm_name(self):
+        if not self.shm:
+            return
+        return self.shm.name
+
+    def release(self):
+        if self.cache_path and self.freqmap_ready:
             try:
-                pwrs = self.cmdpipe.stdout.read(HRF_PWR_BYTES * pwr_entries)
-            except:
-                raise Exception("Problem communicating with HACKRF - exit and restart")
+                self.save_cache()
+            except Exception:
+                pass
+
+        if self.waterfall:
+            self.waterfall.flush()
+
+        self.close_stream()
+        if self.tee:  # finish the recording's timing sidecar
+            self.tee.close()
+
+        if self.shm:
+            self.shm.unlink()
+
+    def ingest(self, recs):
+        """Store a batch of records, completing sweeps at each wraparound
+
+        Returns False, storing nothing, if a record was never seen while
+        calibrating: the layout has changed under us.
+        """
+
+        starts = recs['start']
+        blocks = self.blocks
+        index = np.minimum(np.searchsorted(blocks['start'], starts),
+                len(blocks) - 1)
+        block = blocks[index]
+        matched = (block['start'] == starts)\
+                & (block['reclen'] == recs['reclen'])
+        if not matched.all():  # overlapped, so seen, unless the layout moved
+            keys = record_keys(starts[~matched], recs['reclen'][~matched])
+            known = self.known_recs[np.minimum(np.searchsorted(
+                self.known_recs, keys), len(self.known_recs) - 1)]
+            if (known != keys).any():
+                return False
+
+        bins = np.where(matched, block['offset'], -1)
+        index = np.where(matched, index, -1)
+        self.block_ts[index[matched]] = time.time()
+        wraps = np.flatnonzero(starts == self.wrapfreq)
+
+        prev = 0
+        for wrap in wraps:
+            self.store(bins[prev:wrap], index[prev:wrap],
+                    recs['pwr'][prev:wrap])
+            if self.pending:
+                self.sweep_complete()
+            prev = wrap
+        self.store(bins[prev:], index[prev:], recs['pwr'][prev:])
+        return True
+
+    def store(self, bins, index, pwrs):
+        self.fresh[index[index >= 0]] = True
+        freqmap = self.slots[self.back]
+        entries = pwrs.shape[1]
+        for substart, pwr in zip(bins.tolist(), pwrs):
+            if substart < 0:  # not in the layout (overlapped, or unknown)
+                continue
+            freqmap[substart:substart + entries] = pwr
+        self.pending += len(bins)
+
+    def publish(self, ts):
+        """Hand the filled back slot to readers; return its index"""
+
+        self.sweeps += 1
+
+        # stamp the filled slot, then reclaim the oldest as the next back
+        front = self.back
+        self.slottab[front] = (self.sweeps, ts)
+        self.header['ts'] = ts
+        self.header['cur'] = front
+        self.header['seq'] = self.sweeps
+
+        self.back = (front + 1) % SWEEP_SLOTS
+        self.slottab['seq'][self.back] = -1
+        self.slots[self.back] = self.slots[front]
+
+        if self.pyramid:
+            self.pyramid.update(self.slots[front])
+
+        if not self.freqmap_ready:
+            self.freqmap_ready = True
+
+        return front
+
+    def sweep_complete(self):
+        started = time.perf_counter()
+        now = time.time()
+        self.pending = 0
+        if self.sweeps_fed and not self.outage_started:
+            self.sweep_hist.observe(now - self.sweep_times[-1])
+        self.sweep_times.append(now)
+        self.sweeps_fed += 1
+
+        if self.outage_started:
+            self.downtime += now - self.outage_started
+            gammarf_util.console_message("sweep feed restored after {:.1f}s"
+                    .format(now - self.outage_started), MOD_NAME)
+            self.outage_started = None
+            self.header['stale'] = 0
 
-            unpacked = list(struct.unpack('{}f'.format(pwr_entries), pwrs))
+        front = self.publish(now)
 
-            substart = int((start - firstfreq)/self.step)
-            substop = substart + pwr_entries
-            self.freqmap[substart:substop] = list(unpacked)
+        # a weighted plan wraps once per round, refreshing only some
+        # blocks; per-sweep statistics wait for the pass, so lighter
+        # segments' stale bins are not counted again each round
+        if self.fresh.all():
+            self.fresh[:] = False
+            self.pass_complete(front, now)
 
+        if self.cache_path\
+                and now - self.cache_saved >= self.opts['cache_interval']:
             try:
-                reclen, start, end = struct.unpack('=iqq',
-                        self.cmdpipe.stdout.read(20))
-            except:
-                raise Exception("Problem communicating with HACKRF - exit and restart")
+                self.save_cache()
+            except Exception as e:
+                gammarf_util.console_message("could not save cache: {}"
+                        .format(e), MOD_NAME)
+                self.cache_saved = now
 
-            if start == firstfreq:
-                if not self.freqmap_ready:
-                    self.freqmap_ready = True
+        oldest = self.block_ts.min()
+        if oldest:  # every block stored since the layout was made
+            self.age_hist.observe(now - oldest)
+        self.read_samples.append((now, int(self.header['reads'][0])))
 
-        return
+        with self.sweep_cond:
+            self.sweep_cond.notify_all()
+
+        elapsed = time.perf_counter() - started
+        self.publish_hist.observe(elapsed)
+        self.publish_time += elapsed
+
+    def pass_complete(self, front, now):
+        """Feed a sweep with every block fresh to the statistics"""
+
+        self.stats.update(self.slots[front])
+        if self.detectors:
+            self.detectors.update(self.slots[front])
+
+        if self.detector:
+            self.emitters = (self.sweeps, now,
+                    self.detector.detect(self.slots[front]))
+
+        if self.occupancy:  # after cfar, which leaves its floor behind
+            self.occupancy.update(self.slots[front],
+                    self.detector.floor if self.detector else None, now)
+
+        if self.waterfall:
+            self.waterfall.append(self.slots[front], now)
 
     def is_freqmap_ready(self):
         return self.freqmap_ready
 
-    def freqbin(self, freq):
-        return math.floor((freq - self.minfreq) / self.step)
+    def is_stale(self):
+        return bool(self.outage_started)
 
-    def pwr(self, freq):
-        if freq > self.maxfreq or freq < self.minfreq:
+    def sweep_rate(self):
+        if len(self.sweep_times) < 2:
+            return 0.0
+
+        elapsed = self.sweep_times[-1] - self.sweep_times[0]
+        if not elapsed:
+            return 0.0
+
+        return (len(self.sweep_times) - 1) / elapsed
+
+    def read_rate(self):
+        """Freqmap reads per second by all consumers"""
+
+        if len(self.read_samples) < 2:
+            return 0.0
+
+        (first, first_reads), (last, last_reads) = self.read_samples[0],\
+                self.read_samples[-1]
+        if last == first:
+            return 0.0
+
+        return (last_reads - first_reads) / (last - first)
+
+    def pipeline_stats(self):
+        now = time.time()
+        bytes_read = self.bytes_prior + self.reader.bytes_read
+
+        return {'sweeps': self.sweeps,
+                'sweep_rate': self.sweep_rate(),
+                'bytes_read': bytes_read,
+                'byte_rate': bytes_read / max(now - self.started, 1e-9),
+                'records': self.records_ingested,
+                'dropped': getattr(self.reader, 'dropped', 0),
+                'reads': int(self.header['reads'][0])
+                    if self.header is not None else 0,
+                'read_rate': self.read_rate(),
+                'sweep_time': self.sweep_hist.summary(),
+                'parse_time': self.parse_hist.summary(),
+                'publish_time': self.publish_hist.summary(),
+                'stale_age': self.age_hist.summary()}
+
+    def baseline_many(self, freqs):
+        freqbins, valid = self.freqbins(freqs)
+        base = self.stats.baseline(freqbins[valid])
+
+        for key in ('mean', 'stdev', 'min', 'max', 'ewma'):
+            full = np.full(len(freqbins), np.nan, dtype=np.float32)
+            full[valid] = base[key]
+            base[key] = full
+
+        return base
+
+    def zscore_many(self, freqs):
+        freqbins, valid = self.freqbins(freqs)
+
+        zscores = np.full(len(freqbins), np.nan, dtype=np.float32)
+        zscores[valid] = self.stats.zscore(freqbins[valid],
+                self.read(freqbins[valid]))
+        return zscores
+
+    def get_emitters(self):
+        return self.emitters
+
+    def band_power(self, lowfreq, highfreq):
+        """(max dB, mean dB) over [lowfreq, highfreq], None if no bins"""
+
+        if not self.opts['pyramid']:
+            raise Exception("spectrum pyramid disabled")
+
+        lowbin, highbin = self.bin_range(lowfreq, highfreq)
+        if highbin < lowbin or not self.freqmap_ready:
             return
 
-        freqbin = self.freqbin(freq)
-        if not freqbin:
+        return self.pyramid.query(lowbin, highbin)
+
+    def pwr_overview(self, lowfreq, highfreq, points):
+        """(freqs, max dB, mean dB) in at least points coarse steps"""
+
+        if not self.opts['pyramid']:
+            raise Exception("spectrum pyramid disabled")
+
+        lowbin, highbin = self.bin_range(lowfreq, highfreq)
+        if highbin < lowbin or not self.freqmap_ready:
+            return np.empty(0, dtype=np.int64),\
+                    np.empty(0, dtype=np.float32),\
+                    np.empty(0, dtype=np.float32)
+
+        level = self.pyramid.level_for(highbin - lowbin + 1, points)
+        firstbins, maxes, means = self.pyramid.overview(lowbin, highbin,
+                level)
+        return self.binfreqs[firstbins], maxes, means
+
+    def detector_modes(self):
+        return self.opts['detectors']
+
+    def occupancy_window(self):
+        return self.opts['occupancy_window']
+
+    def occupancy_range(self, lowfreq, highfreq):
+        """(freqs, busy fraction, sweeps, seconds) over a freq range"""
+
+        if not self.opts['occupancy_window'] or not self.freqmap_ready:
+            return
+
+        sweeps, seconds = self.occupancy.window(time.time())
+        lowbin, highbin = self.bin_range(lowfreq, highfreq)
+        if highbin < lowbin:
+            return np.empty(0, dtype=np.int64),\
+                    np.empty(0, dtype=np.float32), sweeps, seconds
+
+        return self.binfreqs[lowbin:highbin + 1].copy(),\
+                self.occupancy.fractions(slice(lowbin, highbin + 1)),\
+                sweeps, seconds
+
+    def occupancy_summary(self, width, min_occupancy=0.0):
+        """(sweeps, seconds, channels) for channels of about width Hz
+        busy at least min_occupancy of the time; a channel is as busy as
+        its busiest bin"""
+
+        if not self.opts['occupancy_window'] or not self.freqmap_ready:
+            return
+
+        segments = self.segments
+        if not self.channels or self.channels[0] is not segments\
+                or self.channels[1] != width:
+            self.channels = (segments, width) + channel_groups(segments,
+                    width)
+        groups, channels = self.channels[2], self.channels[3].copy()
+
+        sweeps, seconds = self.occupancy.window(time.time())
+        channels['occupancy'] = np.maximum.reduceat(
+                self.occupancy.fractions(slice(None)), groups)
+        return sweeps, seconds,\
+                channels[channels['occupancy'] >= min_occupancy]
+
+    def detector_many(self, freqs, mode):
+        if not self.detectors:
+            raise Exception("no spectrum detectors configured")
+
+        freqbins, valid = self.freqbins(freqs)
+        pwrs = np.full(len(freqbins), np.nan, dtype=np.float32)
+        pwrs[valid] = self.detectors.read(mode, freqbins[valid])
+        return pwrs
+
+    def detector_range(self, lowfreq, highfreq, mode):
+        if not self.detectors:
+            raise Exception("no spectrum detectors configured")
+
+        lowbin, highbin = self.bin_range(lowfreq, highfreq)
+        if highbin < lowbin:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        return self.binfreqs[lowbin:highbin + 1].copy(),\
+                self.detectors.read(mode, slice(lowbin, highbin + 1))
+
+    def bin_info(self, lowfreq, highfreq):
+        """Bin freqs in [lowfreq, highfreq], with the index of the device
+        that swept each (-1 if unknown) and when it was captured"""
+
+        lowbin, highbin = self.bin_range(lowfreq, highfreq)
+        if highbin < lowbin:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int16),\
+                    np.empty(0, dtype=np.float64)
+
+        bins = np.arange(lowbin, highbin + 1)
+        block = np.searchsorted(self.blocks['offset'], bins, 'right') - 1
+
+        if isinstance(self.source, MergedSweep):
+            origin = self.source.origin
+            sources = np.array([origin.get(start, -1)
+                for start in self.blocks['start'].tolist()], dtype=np.int16)
+        else:  # one device sweeps everything
+            sources = np.zeros(len(self.blocks), dtype=np.int16)
+
+        return self.binfreqs[lowbin:highbin + 1].copy(), sources[block],\
+                self.block_ts[block]
+
+    def history(self, lowfreq, highfreq, seconds):
+        if not self.waterfall:
+            return
+
+        lowbin, highbin = self.bin_range(lowfreq, highfreq)
+        if highbin < lowbin:
             return
 
-        return self.freqmap[freqbin]
+        times, pwrs = self.waterfall.window(lowbin, highbin,
+                time.time() - seconds)
+        return times, self.binfreqs[lowbin:highbin + 1].copy(), pwrs
+
+    def wait_sweep(self, seq, timeout=None):
+        with self.sweep_cond:
+            self.sweep_cond.wait_for(lambda: self.sweeps > seq, timeout)
+        return self.sweeps
 
     def join(self, timeout=None):
         self.stoprequest.set()
+        if self.publisher:
+            self.publisher.join(timeout)
         super(SpectrumWorker, self).join(timeout)
 
 
+class SpectrumView(FreqmapReader):
+    """Read the spectrum worker's shared freqmap from the main process
+
+    Reads are served straight from shared memory; anything else falls
+    through to the manager proxy it wraps.
+    """
+
+    def __init__(self, proxy, shm_name):
+        self.proxy = proxy
+        self.shm = None
+        self.attach(shm_name)
+
+    def attach(self, shm_name):
+        if not shared_memory:
+            shm = MappedFile(shm_name)
+        else:
+            shm = shared_memory.SharedMemory(name=shm_name)
+            try:  # the spectrum worker owns (and unlinks) the block
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except Exception:
+                pass
+
+        self.map_freqmap(shm.buf)
+        if self.shm:
+            try:
+                self.shm.close()
+            except BufferError:  # a read still holds it; closed when freed
+                pass
+        self.shm = shm
+
+    def follow(self):
+        if self.header['moved'][0]:
+            self.attach(self.proxy.shm_name())
+
+    def __getattr__(self, name):
+        return getattr(self.proxy, name)
+
+    def is_freqmap_ready(self):
+        return self.sweep_info()[0] > 0
+
+    def wait_sweep(self, seq, timeout=None):
+        current = self.sweep_info()[0]
+        if current > seq:
+            return current
+
+        return self.proxy.wait_sweep(seq, timeout)
+
+
 class GrfModuleSpectrum(GrfModuleBase):
     def __init__(self, config, devmod):
-        if not devmod.hackrf():
+        if not devmod.spectrum():
             return
 
-        if not 'hackrfdevs' in config:
+        opts = parse_opts(config, devmod)
+
+        # rtl-sdr spectrum stations need no hackrf settings
+        if opts['engine'] != 'rtlsdr' and not 'hackrfdevs' in config:
             raise Exception("No hackrf section defined in config")
 
-        try:
-            hackrf_path = config['hackrfdevs']['hackrf_path']
-        except KeyError:
-            raise Exception("param 'hackrf_path' not appropriately "\
-                    "defined in config")
+        if not opts['replay_file'] and opts['engine'] == 'hackrf_sweep':
+            hackrf_cmd = opts['hackrf_cmd']
+            if not hackrf_cmd:
+                raise Exception("param 'hackrf_path' not appropriately "\
+                        "defined in config")
 
-        hackrf_cmd = hackrf_path + '/' + 'hackrf_sweep'
-        if not os.path.isfile(hackrf_cmd)\
-                or not os.access(hackrf_cmd, os.X_OK):
-            raise Exception("executable hackrf_sweep not found "\
-                    "in specified path")
+            if not os.path.isfile(hackrf_cmd)\
+                    or not os.access(hackrf_cmd, os.X_OK):
+                raise Exception("executable hackrf_sweep not found "\
+                        "in specified path")
 
         self.description = "spectrum module"
         self.settings = {}
 
-        self.worker = SpectrumWorker(devmod, hackrf_cmd)
+        self.worker = SpectrumWorker(devmod, opts)
         self.worker.daemon = True
         self.worker.start()
 
@@ -179,6 +1562,69 @@ class GrfModuleSpectrum(GrfModuleBase):
 
         gammarf_util.console_message("loaded", MOD_NAME)
 
+    def baseline(self, freq):
+        """Get running statistics for the bin holding a frequency"""
+
+        base = self.worker.baseline_many([freq])
+        for key in ('mean', 'stdev', 'min', 'max', 'ewma'):
+            base[key] = float(base[key][0])
+        return base
+
+    def baseline_many(self, freqs):
+        """Get running statistics (dict of arrays) for a list of freqs"""
+        return self.worker.baseline_many(freqs)
+
+    def band_power(self, lowfreq, highfreq):
+        """Get (max, mean) power in dB between two frequencies"""
+        return self.worker.band_power(lowfreq, highfreq)
+
+    def bin_info(self, lowfreq, highfreq):
+        """Get bin freqs with the device index and capture time of each"""
+        return self.worker.bin_info(lowfreq, highfreq)
+
+    def detector_modes(self):
+        """Detectors configured besides the last sweep: peak, min, ..."""
+        return self.worker.detector_modes()
+
+    def detector_many(self, freqs, mode):
+        """Get a detector's output at each of a list of frequencies"""
+        return self.worker.detector_many(freqs, mode)
+
+    def detector_range(self, lowfreq, highfreq, mode):
+        """Get bin frequencies and a detector's output between two freqs"""
+        return self.worker.detector_range(lowfreq, highfreq, mode)
+
+    def dump_history(self, lowfreq, highfreq, seconds, path):
+        """Write a waterfall window to a CSV file; return rows written"""
+
+        window = self.worker.history(lowfreq, highfreq, seconds)
+        if not window:
+            return
+
+        times, freqs, pwrs = window
+        with open(path, 'w') as f:
+            f.write("time," + ",".join(str(freq) for freq in freqs) + "\n")
+            np.savetxt(f, np.column_stack((times, pwrs)), delimiter=',',
+                    fmt='%.2f')
+
+        return len(times)
+
+    def emitters(self):
+        """Get (seq, time, emitters) for the newest sweep's detections"""
+        return self.worker.get_emitters()
+
+    def history(self, lowfreq, highfreq, seconds):
+        """Get (times, freqs, pwrs) for the last seconds of history"""
+        return self.worker.history(lowfreq, highfreq, seconds)
+
+    def feed_status(self):
+        """Sweep feed health: stale, outages, restarts, downtime, uptime"""
+        return self.worker.feed_status()
+
+    def is_stale(self):
+        """Check if the sweep feed is down (freqmap frozen)"""
+        return self.worker.is_stale()
+
     def is_freqmap_ready(self):
         """Check if the freqmap has been populated"""
         return self.worker.is_freqmap_ready()
@@ -187,8 +1633,74 @@ class GrfModuleSpectrum(GrfModuleBase):
         """Return bin in freqmap placed closest to input frequency"""
         return self.worker.freqbin(freq)
 
+    def occupancy_window(self):
+        """Seconds the occupancy counters cover, 0 if disabled"""
+        return self.worker.occupancy_window()
+
+    def occupancy_range(self, lowfreq, highfreq):
+        """Get bin freqs, busy fractions and the sweeps/seconds covered"""
+        return self.worker.occupancy_range(lowfreq, highfreq)
+
+    def occupancy_summary(self, width, min_occupancy=0.0):
+        """Get (sweeps, seconds, channels) busy at least min_occupancy"""
+        return self.worker.occupancy_summary(width, min_occupancy)
+
+    def pipeline_stats(self):
+        """Counters and timing histograms for the sweep pipeline"""
+        return self.worker.pipeline_stats()
+
     def pwr(self, freq):
         """Get power at a frequency according to the freqmap"""
         return self.worker.pwr(freq)
 
-    # overridden 
+    def pwr_many(self, freqs, detector=None):
+        """Get power at each of a list of frequencies (NaN if unmapped),
+        from the last sweep or a configured detector"""
+        return self.worker.pwr_many(freqs, detector)
+
+    def pwr_overview(self, lowfreq, highfreq, points):
+        """Get coarse (freqs, max, mean) between two frequencies"""
+        return self.worker.pwr_overview(lowfreq, highfreq, points)
+
+    def pwr_range(self, lowfreq, highfreq, detector=None):
+        """Get bin frequencies and powers between two frequencies"""
+        return self.worker.pwr_range(lowfreq, highfreq, detector)
+
+    def read_sweep(self, index):
+        """Get (seq, ts, freqmap[index]) of the newest sweep"""
+        return self.worker.read_sweep(index)
+
+    def segment_table(self):
+        """Get the freqmap's (minfreq, step, offset, bins) segments"""
+        return self.worker.segment_table()
+
+    def shm_name(self):
+        """Name of the shared memory block holding the freqmap"""
+        return self.worker.shm_name()
+
+    def sweep_info(self):
+        """Sequence number and capture time of the newest sweep"""
+        return self.worker.sweep_info()
+
+    def sweep_rate(self):
+        """Completed sweeps per second"""
+        return self.worker.sweep_rate()
+
+    def zscore_many(self, freqs):
+        """Get z-scores of current power against each bin's running mean"""
+        return self.worker.zscore_many(freqs)
+
+    def wait_sweep(self, seq, timeout=None):
+        """Block until a sweep newer than seq completes; return newest seq"""
+        return self.worker.wait_sweep(seq, timeout)
+
+    # overridden
+    def shutdown(self):
+        gammarf_util.console_message("shutting down {}"
+                .format(self.description))
+
+        try:
+            self.worker.join(self.thread_timeout)
+            self.worker.release()
+        except AttributeError:  # no hackrf
+            pass
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# disk spool for the connector's data queue
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import mmap
+import os
+import struct
+
+CURSOR_FILE = "cursor"
+DEFAULT_SPOOL_BUDGET = 512  # MB
+RECORD_HEADER = struct.Struct('<II')  # json bytes, payload bytes
+SEGMENT_BYTES = int(16e6)
+SEGMENT_SUFFIX = ".spool"
+
+
+class Spool():
+    """Append-only store-and-forward queue of data messages on disk
+
+    Messages go in memory-mapped segment files, each record its JSON
+    and optional binary payload behind a (json length, payload length)
+    header.  The body is written before the header, and files start
+    zeroed, so a record torn by a crash reads as the end of the data.
+
+    Reading is two-step: read() hands out records past the committed
+    cursor, and commit() makes them consumed, saving the cursor to disk
+    atomically and deleting segments it has passed; rewind() gives the
+    uncommitted records back, so a failed send repeats rather than
+    loses them.  Past budget bytes of segments, the oldest is deleted,
+    read or not.
+    """
+
+    def __init__(self, path, budget=DEFAULT_SPOOL_BUDGET * int(1e6),
+            segment_bytes=SEGMENT_BYTES):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.budget = budget
+        self.segment_bytes = segment_bytes
+
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                for name in os.listdir(path) if name.endswith(SEGMENT_SUFFIX))
+
+        self.dropped = 0  # segments deleted over budget
+        self.rmap = None
+        self.rseg = None
+
+        self.wmap = None
+        if self.segments:  # carry on after what a previous run wrote
+            self.wseg = self.segments[-1]
+            self.wmap = self.map_segment(self.wseg)
+            self.woff = 0
+            while True:
+                length = self.record_length(self.wmap, self.woff)
+                if not length:
+                    break
+                self.woff += length
+        else:
+            self.roll(0)
+
+        self.cursor = self.load_cursor()
+        self.next = self.cursor
+
+    def segment_path(self, seg):
+        return os.path.join(self.path, "{:012d}{}".format(seg,
+            SEGMENT_SUFFIX))
+
+    def map_segment(self, seg, size=None):
+        with open(self.segment_path(seg), 'a+b') as f:
+            if size:
+                f.truncate(size)
+            return mmap.mmap(f.fileno(), 0)
+
+    def load_cursor(self):
+        try:
+            with open(os.path.join(self.path, CURSOR_FILE)) as f:
+                seg, off = (int(field) for field in f.read().split())
+        except (OSError, ValueError):
+            seg, off = 0, 0
+
+        if seg not in self.segments:  # gone over budget, or never saved
+            return max(self.segments[0], min(seg, self.segments[-1])), 0
+        if seg == self.wseg:  # records lost in a crash, say
+            return seg, min(off, self.woff)
+        return seg, off
+
+    def save_cursor(self):
+        tmp = os.path.join(self.path, CURSOR_FILE + ".tmp")
+        with open(tmp, 'w') as f:
+            f.write("{} {}\n".format(*self.cursor))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.path, CURSOR_FILE))
+
+    @staticmethod
+    def record_length(segmap, off):
+        """Bytes in the record at off, or 0 past the last one"""
+
+        if off + RECORD_HEADER.size > len(segmap):
+            return 0
+        jlen, plen = RECORD_HEADER.unpack_from(segmap, off)
+        if not jlen:
+            return 0
+        return RECORD_HEADER.size + jlen + plen
+
+    def roll(self, need):
+        if self.wmap:
+            self.wmap.close()
+
+        self.wseg = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(self.wseg)
+        self.wmap = self.map_segment(self.wseg,
+                max(self.segment_bytes, need + RECORD_HEADER.size))
+        self.woff = 0
+
+        while len(self.segments) > 1\
+                and len(self.segments) * self.segment_bytes > self.budget:
+            self.drop_oldest()
+
+    def remove_oldest(self):
+        seg = self.segments.pop(0)
+        if self.rseg == seg:
+            self.rmap.close()
+            self.rmap, self.rseg = None, None
+        os.remove(self.segment_path(seg))
+        return seg
+
+    def drop_oldest(self):
+        seg = self.remove_oldest()
+        self.dropped += 1
+
+        if self.cursor[0] <= seg:
+            self.cursor = (self.segments[0], 0)
+            self.save_cursor()
+        if self.next[0] <= seg:
+            self.next = (self.segments[0], 0)
+
+    def append(self, data, payload=None):
+        body = json.dumps(data).encode('utf-8')
+        payload = payload or b''
+        length = RECORD_HEADER.size + len(body) + len(payload)
+        if self.woff + length > len(self.wmap):
+            self.roll(length)
+
+        start = self.woff + RECORD_HEADER.size
+        self.wmap[start:start + len(body)] = body
+        self.wmap[start + len(body):start + len(body) + len(payload)]\
+                = payload
+        RECORD_HEADER.pack_into(self.wmap, self.woff, len(body),
+                len(payload))
+        self.woff += length
+
+    def empty(self):
+        return self.next == (self.wseg, self.woff)
+
+    def read(self, limit):
+        """Up to limit (data, payload) records past the last read"""
+
+        out = []
+        while len(out) < limit and not self.empty():
+            seg, off = self.next
+            if self.rseg != seg:
+                if self.rmap:
+                    self.rmap.close()
+                self.rmap, self.rseg = self.map_segment(seg), seg
+
+            length = self.record_length(self.rmap, off)
+            if not length:  # that segment is done, on to the next
+                self.next = (self.segments[self.segments.index(seg) + 1], 0)
+                continue
+
+            jlen, plen = RECORD_HEADER.unpack_from(self.rmap, off)
+            start = off + RECORD_HEADER.size
+            data = json.loads(self.rmap[start:start + jlen].decode('utf-8'))
+            payload = self.rmap[start + jlen:start + jlen + plen]\
+                    if plen else None
+            out.append((data, payload))
+            self.next = (seg, off + length)
+
+        return out
+
+    def commit(self):
+        if self.next == self.cursor:
+            return
+
+        self.cursor = self.next
+        self.save_cursor()
+        while self.segments[0] < self.cursor[0]:
+            self.remove_oldest()
+
+    def rewind(self):
+        self.next = self.cursor
+
+    def close(self):
+        for segmap in (self.rmap, self.wmap):
+            if segmap:
+                segmap.flush()
+                segmap.close()
+        self.rmap = self.wmap = None
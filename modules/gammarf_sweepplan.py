@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+# hackrf sweep plans
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import subprocess
+from collections import namedtuple
+from sys import builtin_module_names
+
+HACKRF_MAX_RANGES = 10  # hackrf_sweep's limit on -f ranges
+TUNE_STEP = 20  # MHz, hackrf_sweep rounds each range up to whole tunings
+
+# minfreq and maxfreq in MHz, width in Hz
+Segment = namedtuple('Segment', 'name minfreq maxfreq width weight')
+
+
+def tuned_max(minfreq, maxfreq):
+    """Where hackrf_sweep actually stops sweeping a range"""
+    return minfreq + -(-(maxfreq - minfreq) // TUNE_STEP) * TUNE_STEP
+
+def parse_plan(section, minfreq, maxfreq, width):
+    """Read segment_<name> = minMHz maxMHz [width_hz [weight]] entries
+
+    Without any segments the plan is the single range minfreq:maxfreq.
+    """
+
+    segments = []
+    for key in section or ():
+        if not key.startswith('segment_'):
+            continue
+
+        fields = section[key].split()
+        try:
+            segment = Segment(key[len('segment_'):], int(fields[0]),
+                    int(fields[1]),
+                    int(fields[2]) if len(fields) > 2 else width,
+                    int(fields[3]) if len(fields) > 3 else 1)
+        except (IndexError, ValueError):
+            raise Exception("Invalid sweep segment: {} = {}"
+                    .format(key, section[key]))
+
+        if segment.minfreq >= segment.maxfreq or segment.weight < 1:
+            raise Exception("Invalid sweep segment: {} = {}"
+                    .format(key, section[key]))
+
+        segments.append(segment)
+
+    if not segments:
+        return [Segment('default', minfreq, maxfreq, width, 1)]
+
+    if len(segments) > HACKRF_MAX_RANGES:
+        raise Exception("Sweep plan has more than {} segments"
+                .format(HACKRF_MAX_RANGES))
+
+    bounds = sorted(segments, key=lambda segment: segment.minfreq)
+    for prev, segment in zip(bounds, bounds[1:]):
+        if segment.minfreq < tuned_max(prev.minfreq, prev.maxfreq):
+            raise Exception("Sweep segments {} and {} overlap (hackrf_sweep "\
+                    "extends ranges to multiples of {} MHz)"
+                    .format(prev.name, segment.name, TUNE_STEP))
+
+    return segments
+
+def chunks(segment, count):
+    """Split a segment into up to count ranges on tuning boundaries"""
+
+    tunings = (tuned_max(segment.minfreq, segment.maxfreq)
+            - segment.minfreq) // TUNE_STEP
+    count = max(1, min(count, tunings))
+
+    ranges = []
+    for i in range(count):
+        lo = segment.minfreq + (tunings * i // count) * TUNE_STEP
+        hi = segment.minfreq + (tunings * (i + 1) // count) * TUNE_STEP
+        ranges.append((lo, min(hi, segment.maxfreq)))
+    return ranges
+
+def spread(pieces, weight, rounds):
+    """Pieces of a segment to sweep in each of rounds rounds, so each is
+    swept weight times; a segment with too few pieces for that gets one
+    a round, so more often than its weight"""
+
+    count = len(pieces)
+    if weight * count < rounds:
+        return [[pieces[r % count]] for r in range(rounds)]
+
+    return [[pieces[i % count] for i in range(r * weight * count // rounds,
+        (r + 1) * weight * count // rounds)] for r in range(rounds)]
+
+def merged(ranges):
+    """Ranges with each joined to the one before it where they meet"""
+
+    out = []
+    for lo, hi in ranges:
+        if out and out[-1][1] == lo:
+            out[-1] = (out[-1][0], hi)
+        else:
+            out.append((lo, hi))
+    return out
+
+def build_runs(segments):
+    """Lay a plan out as hackrf_sweep runs: [(width, [(lo, hi), ...]), ...]
+
+    A pass is as many rounds as the highest weight.  Every round sweeps
+    the heaviest segment first, then a share of each other segment's
+    pieces, spread so a segment of weight w is covered w times per pass
+    (more, if it has fewer 20 MHz tunings than rounds / w).  A single run
+    sweeps continuously; several runs are cycled one-shot.
+    """
+
+    rounds = max(segment.weight for segment in segments)
+    lead = [segment for segment in segments if segment.weight == rounds][0]
+    order = [lead] + [segment for segment in segments if segment != lead]
+    shares = {segment: spread(chunks(segment, rounds), segment.weight,
+        rounds) for segment in order}
+
+    plan = []
+    for r in range(rounds):
+        plan.append([(segment.width, rng) for segment in order
+            for rng in merged(shares[segment][r])])
+
+    widths = set(segment.width for segment in segments)
+    if len(widths) == 1\
+            and sum(len(rnd) for rnd in plan) <= HACKRF_MAX_RANGES:
+        return [(lead.width, [rng for rnd in plan for width, rng in rnd])]
+
+    runs = []
+    for rnd in plan:
+        for width in sorted(set(width for width, rng in rnd),
+                key=[width for width, rng in rnd].index):
+            runs.append((width, [rng for w, rng in rnd if w == width]))
+    return runs
+
+def split_plan(segments, count):
+    """Share a plan out between count devices: [[Segment, ...], ...]
+
+    Segments are cut on tuning boundaries so every device gets about
+    the same work per pass (a tuning costs its segment's weight), each
+    device's share contiguous in frequency.  Devices left without work
+    (more devices than tunings) are not returned.
+    """
+
+    ordered = sorted(segments, key=lambda segment: segment.minfreq)
+    tunings = [(tuned_max(segment.minfreq, segment.maxfreq)
+        - segment.minfreq) // TUNE_STEP for segment in ordered]
+    total = sum(n * segment.weight
+            for n, segment in zip(tunings, ordered))
+
+    shares = [[] for i in range(count)]
+    spent = 0
+    for segment, segment_tunings in zip(ordered, tunings):
+        done = 0
+        while done < segment_tunings:
+            dev = min(count - 1, spent * count // total)
+            room = -(-((dev + 1) * total - spent * count)
+                    // (count * segment.weight))
+            take = max(1, min(segment_tunings - done, room))
+
+            lo = segment.minfreq + done * TUNE_STEP
+            hi = min(lo + take * TUNE_STEP, segment.maxfreq)
+            shares[dev].append(segment._replace(minfreq=lo, maxfreq=hi))
+
+            done += take
+            spent += take * segment.weight
+
+    return [share for share in shares if share]
+
+def sweep_command(hackrf_cmd, width, ranges, lna_gain, vga_gain,
+        oneshot=False, serial=None):
+    cmd = [hackrf_cmd]
+    if serial:
+        cmd += ["-d", serial]  # one argument would keep the space
+    for lo, hi in ranges:
+        cmd.append("-f {}:{}".format(lo, hi))
+    cmd += ["-w {}".format(width),
+            "-l {}".format(lna_gain),
+            "-g {}".format(vga_gain),
+            "-B",
+            "-a 1"]
+    if oneshot:
+        cmd.append("-1")
+    return cmd
+
+def sweep_process(cmd):
+    ON_POSIX = 'posix' in builtin_module_names
+    return subprocess.Popen(cmd,
+            bufsize=0,
+            stdout=subprocess.PIPE,
+            stderr=open(os.devnull, 'w'),
+            close_fds=ON_POSIX)
+
+
+class PlanStream():
+    """One -B stream out of one-shot hackrf_sweep runs, cycled forever"""
+
+    def __init__(self, cmds):
+        self.cmds = cmds
+        self.index = 0
+        self.proc = None
+        self.next_run()
+
+    def next_run(self):
+        self.proc = sweep_process(self.cmds[self.index])
+        self.index = (self.index + 1) % len(self.cmds)
+
+    def fileno(self):
+        return self.proc.stdout.fileno()
+
+    def readinto(self, buf):
+        """Read from the current run; None when it has just been replaced"""
+
+        nread = self.proc.stdout.readinto(buf)
+        if nread:
+            return nread
+
+        if self.proc.wait():  # the run failed, report end of stream
+            return 0
+        self.next_run()
+        return None
+
+    def close(self):
+        self.proc.kill()
+        self.proc.wait()
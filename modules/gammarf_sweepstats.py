@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# per-bin sweep statistics
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import numpy as np
+
+DEFAULT_EWMA_ALPHA = 0.1
+
+
+class SweepStats():
+    """Running mean/variance (Welford), min, max and EWMA for every bin
+
+    Every completed sweep updates every bin, so the sample count is
+    shared across bins.  Updates work in place on preallocated arrays.
+    """
+
+    def __init__(self, bins, alpha=DEFAULT_EWMA_ALPHA):
+        self.alpha = alpha
+        self.n = 0
+
+        self.mean = np.zeros(bins, dtype=np.float64)
+        self.m2 = np.zeros(bins, dtype=np.float64)
+        self.min = np.full(bins, np.inf, dtype=np.float32)
+        self.max = np.full(bins, -np.inf, dtype=np.float32)
+        self.ewma = np.zeros(bins, dtype=np.float32)
+
+        self.delta = np.empty(bins, dtype=np.float64)
+        self.delta2 = np.empty(bins, dtype=np.float64)
+        self.scratch = np.empty(bins, dtype=np.float32)
+
+    def update(self, pwrs):
+        self.n += 1
+
+        # welford: mean += d/n, m2 += d * (x - new mean)
+        np.subtract(pwrs, self.mean, out=self.delta)
+        np.multiply(self.delta, 1.0 / self.n, out=self.delta2)
+        self.mean += self.delta2
+        np.subtract(pwrs, self.mean, out=self.delta2)
+        self.delta *= self.delta2
+        self.m2 += self.delta
+
+        np.minimum(self.min, pwrs, out=self.min)
+        np.maximum(self.max, pwrs, out=self.max)
+
+        if self.n == 1:
+            self.ewma[:] = pwrs
+        else:
+            np.subtract(pwrs, self.ewma, out=self.scratch)
+            self.scratch *= self.alpha
+            self.ewma += self.scratch
+
+    def restore(self, state):
+        self.n = int(state['stats_n'])
+        self.mean[:] = state['stats_mean']
+        self.m2[:] = state['stats_m2']
+        self.min[:] = state['stats_min']
+        self.max[:] = state['stats_max']
+        self.ewma[:] = state['stats_ewma']
+
+    def state(self):
+        return {'stats_n': self.n,
+                'stats_mean': self.mean,
+                'stats_m2': self.m2,
+                'stats_min': self.min,
+                'stats_max': self.max,
+                'stats_ewma': self.ewma}
+
+    def stdev(self, index):
+        if not self.n:
+            return np.zeros_like(self.mean[index])
+        return np.sqrt(self.m2[index] / self.n)
+
+    def baseline(self, index):
+        """Statistics for freqmap[index] (an int, slice or index array)"""
+
+        return {'n': self.n,
+                'mean': self.mean[index].astype(np.float32),
+                'stdev': self.stdev(index).astype(np.float32),
+                'min': self.min[index].copy(),
+                'max': self.max[index].copy(),
+                'ewma': self.ewma[index].copy()}
+
+    def zscore(self, index, pwrs):
+        stdev = self.stdev(index)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return ((pwrs - self.mean[index]) / stdev).astype(np.float32)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# uplink module
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+import zlib
+import numpy as np
+
+try:
+    import lz4.frame
+except ImportError:  # zlib only
+    lz4 = None
+
+import gammarf_util
+from gammarf_base import GrfModuleBase
+from gammarf_waterfall import INT8_OFFSET, INT8_SCALE, quantize_int8
+
+BURST_SECS = 60  # budget that may build up while idle, covers key frames
+CODECS = ('zlib', 'lz4')
+DEFAULT_BUDGET = 20000  # bytes/s, 0 for no limit
+DEFAULT_CODEC = 'zlib'
+DEFAULT_INTERVAL = 10  # s between sweeps sent
+DEFAULT_KEY_INT = 30  # sweeps sent between full (non-delta) sweeps
+LOOP_SLEEP = 2
+MOD_NAME = "uplink"
+MODULE_UPLINK = 12
+PROTOCOL_VERSION = 1
+ZLIB_LEVEL = 6
+
+
+def start(config):
+    return GrfModuleUplink(config)
+
+def compress(body, codec):
+    if codec == 'lz4':
+        return lz4.frame.compress(body)
+    return zlib.compress(body, ZLIB_LEVEL)
+
+
+class Uplink(threading.Thread):
+    """Send whole sweeps as int8 dB, delta coded against the last sweep
+    sent and compressed, within a bandwidth budget
+
+    A key sweep is sent in full every key_int sweeps, and whenever the
+    sweep layout changes; in between, each payload is the bytewise
+    difference (mod 256) from the sweep before, which the server adds
+    back.  A sweep that would overdraw the budget is skipped.  When the
+    connector has lost data since the last send, a delta may have gone
+    missing, so the next sweep is a key sweep too.
+    """
+
+    def __init__(self, system_mods, settings):
+        threading.Thread.__init__(self)
+        self.stoprequest = threading.Event()
+
+        self.connector = system_mods['connector']
+        self.spectrum = system_mods['spectrum']
+
+        self.settings = settings
+
+        self.prev = None  # last sweep sent, quantized
+        self.prev_seq = None
+        self.layout = None
+        self.losses = None  # connector losses at the last send
+        self.since_key = 0
+
+        self.sent = 0
+        self.sent_bytes = 0
+        self.skipped = 0
+
+    def run(self):
+        data = {}
+        data['module'] = MODULE_UPLINK
+        data['protocol'] = PROTOCOL_VERSION
+        data['offset'] = INT8_OFFSET
+        data['scale'] = INT8_SCALE
+
+        sweep_seq = 0
+        last_sent = 0
+        tokens = self.settings['budget'] * BURST_SECS
+        refilled = time.time()
+
+        while not self.stoprequest.isSet():
+            latest = self.spectrum.wait_sweep(sweep_seq, LOOP_SLEEP)
+            if latest == sweep_seq:
+                continue
+            sweep_seq = latest
+
+            now = time.time()
+            if now - last_sent < self.settings['interval']:
+                continue
+
+            budget = self.settings['budget']
+            tokens = min(tokens + (now - refilled) * budget,
+                    budget * BURST_SECS)
+            refilled = now
+
+            seq, ts, pwrs = self.spectrum.read_sweep(slice(None))
+            segments = self.spectrum.segment_table()
+            quantized = quantize_int8(pwrs, pwrs).astype(np.int8)
+
+            layout = segments.tobytes()
+            losses = self.connector.losses()
+            key = layout != self.layout or losses != self.losses\
+                    or self.since_key >= self.settings['key_int']
+            if key:
+                body = quantized
+            else:
+                body = quantized.view(np.uint8) - self.prev.view(np.uint8)
+            payload = compress(body.tobytes(), self.settings['codec'])
+
+            if budget and len(payload) > tokens:
+                self.skipped += 1
+                continue
+            tokens -= len(payload)
+
+            data['seq'] = seq
+            data['sweep_ts'] = ts
+            data['key'] = key
+            data['base_seq'] = None if key else self.prev_seq
+            data['codec'] = self.settings['codec']
+            data['segments'] = [[minfreq, step, bins] for minfreq, step,
+                    offset, bins in segments.tolist()]
+
+            try:
+                self.connector.senddat(data, payload)
+            except Exception as e:
+                continue
+
+            self.prev, self.prev_seq, self.layout = quantized, seq, layout
+            self.losses = losses
+            self.since_key = 1 if key else self.since_key + 1
+            last_sent = now
+
+            self.sent += 1
+            self.sent_bytes += len(payload)
+            if self.settings['print_sends']:
+                gammarf_util.console_message("sent {} sweep {}: {} bins "\
+                        "in {} bytes".format("key" if key else "delta", seq,
+                            len(quantized), len(payload)), MOD_NAME)
+
+        return
+
+    def join(self, timeout=None):
+        self.stoprequest.set()
+        super(Uplink, self).join(timeout)
+
+
+class GrfModuleUplink(GrfModuleBase):
+    """ Uplink: Send whole sweeps to the server, compressed, in place of
+        per-bin snapshots
+
+        Usage: run uplink hackrf_devid
+
+        Example: run uplink 0
+
+        Settings:
+            print_sends: Print a line per sweep sent
+            budget: Average uplink budget (bytes/s, 0 for no limit)
+            interval: Seconds between sweeps sent
+            key_int: Sweeps sent between full (non-delta) sweeps
+            codec: zlib, or lz4 if installed
+    """
+
+    def __init__(self, config):
+        settings = {'print_sends': False,
+                'budget': DEFAULT_BUDGET,
+                'codec': DEFAULT_CODEC,
+                'interval': DEFAULT_INTERVAL,
+                'key_int': DEFAULT_KEY_INT}
+
+        if 'uplink' in config:
+            if 'budget' in config['uplink']:
+                settings['budget'] = int(config['uplink']['budget'])
+
+            if 'codec' in config['uplink']:
+                settings['codec'] = config['uplink']['codec']
+
+            if 'interval' in config['uplink']:
+                settings['interval'] = int(config['uplink']['interval'])
+
+            if 'key_int' in config['uplink']:
+                settings['key_int'] = int(config['uplink']['key_int'])
+
+        if settings['codec'] not in CODECS:
+            raise Exception("invalid uplink codec: {}"
+                    .format(settings['codec']))
+        if settings['codec'] == 'lz4' and not lz4:
+            raise Exception("lz4 uplink codec requires the lz4 package")
+
+        self.device_list = ["hackrf", "virtual"]
+        self.description = "uplink module"
+        self.settings = settings
+        self.worker = None
+
+        self.thread_timeout = 3
+
+        gammarf_util.console_message("loaded", MOD_NAME)
+
+    # overridden
+    def run(self, grfstate, devid, cmdline, remotetask=False):
+        self.remotetask = remotetask
+        system_mods = grfstate.system_mods
+
+        if self.worker:
+            gammarf_util.console_message("module already running",
+                    MOD_NAME)
+            return
+
+        self.worker = Uplink(system_mods, self.settings)
+        self.worker.daemon = True
+        self.worker.start()
+
+        gammarf_util.console_message("{} added on device {}"
+                .format(self.description, devid))
+        return True
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# spectrum waterfall history
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import numpy as np
+
+import gammarf_util
+
+INT8_OFFSET = -60.0  # dB at quantized 0
+INT8_SCALE = 2.0  # steps per dB
+MOD_NAME = "waterfall"
+WF_FORMATS = {'int8': np.int8, 'float16': np.float16}
+WF_HEADER_DTYPE = np.dtype([('magic', 'S8'), ('firstfreq', np.int64),
+    ('step', np.int64), ('bins', np.int64), ('depth', np.int64),
+    ('fmt', 'S8'), ('head', np.int64), ('count', np.int64)])
+WF_MAGIC = b'GRFWF1'
+
+
+def quantize_int8(pwrs, out):
+    """dB to int8 steps (INT8_SCALE per dB above INT8_OFFSET), through
+    the float32 scratch array out, which is left holding them"""
+
+    np.subtract(pwrs, INT8_OFFSET, out=out)
+    np.multiply(out, INT8_SCALE, out=out)
+    np.rint(out, out=out)
+    np.clip(out, -128, 127, out=out)
+    return out
+
+
+class Waterfall():
+    """Fixed-depth ring of recent sweeps in a memory-mapped file
+
+    Row i of the ring holds one sweep, stored as float16 or as int8 dB
+    (INT8_SCALE steps per dB above INT8_OFFSET).  The ring survives
+    restarts as long as the sweep layout is unchanged.
+    """
+
+    def __init__(self, path, firstfreq, step, bins, depth, fmt='int8',
+            budget=None, interval=0):
+
+        if fmt not in WF_FORMATS:
+            raise Exception("invalid history format: {}".format(fmt))
+        dtype = np.dtype(WF_FORMATS[fmt])
+
+        if budget:
+            depth = min(depth, int(budget // (bins * dtype.itemsize)))
+        if depth < 1:
+            raise Exception("history budget too small for one sweep")
+
+        self.bins = bins
+        self.depth = depth
+        self.dtype = dtype
+        self.interval = interval
+        self.last = 0
+
+        times_offset = WF_HEADER_DTYPE.itemsize
+        rows_offset = times_offset + depth * np.dtype(np.float64).itemsize
+        size = rows_offset + depth * bins * dtype.itemsize
+
+        expect = (WF_MAGIC, firstfreq, step, bins, depth, fmt.encode())
+        reuse = False
+        if os.path.isfile(path) and os.path.getsize(path) == size:
+            found = np.fromfile(path, dtype=WF_HEADER_DTYPE, count=1)[0]
+            found = (found['magic'], found['firstfreq'], found['step'],
+                    found['bins'], found['depth'], found['fmt'])
+            reuse = (found == expect)
+
+        if reuse:
+            mm = np.memmap(path, dtype=np.uint8, mode='r+', shape=(size,))
+        else:
+            mm = np.memmap(path, dtype=np.uint8, mode='w+', shape=(size,))
+
+        self.mm = mm
+        self.header = mm[:times_offset].view(WF_HEADER_DTYPE)
+        self.times = mm[times_offset:rows_offset].view(np.float64)
+        self.rows = mm[rows_offset:].view(dtype).reshape(depth, bins)
+
+        if reuse:
+            gammarf_util.console_message("resuming history: {} of {} sweeps"
+                    .format(int(self.header['count'][0]), depth), MOD_NAME)
+        else:
+            self.header[0] = expect + (0, 0)
+            self.times[:] = 0
+            gammarf_util.console_message("new history: {} sweeps, {:.1f} MB"
+                    .format(depth, size / 1e6), MOD_NAME)
+
+        self.scratch = np.empty(bins, dtype=np.float32)
+
+    def append(self, pwrs, ts):
+        if ts - self.last < self.interval:
+            return
+        self.last = ts
+
+        head = int(self.header['head'][0])
+        self.times[head] = 0  # hide the row from readers while it changes
+
+        if self.dtype == np.int8:
+            self.rows[head] = quantize_int8(pwrs, self.scratch)
+        else:
+            self.rows[head] = pwrs
+
+        self.times[head] = ts
+        self.header['head'] = (head + 1) % self.depth
+        self.header['count'] = min(int(self.header['count'][0]) + 1,
+                self.depth)
+
+    def window(self, lowbin, highbin, since, until=None):
+        """Return (times, pwrs) for sweeps in [since, until], oldest first"""
+
+        head = int(self.header['head'][0])
+        count = int(self.header['count'][0])
+        order = (head - count + np.arange(count)) % self.depth
+
+        times = self.times[order]
+        keep = (times > 0) & (times >= since)
+        if until:
+            keep &= (times <= until)
+        order = order[keep]
+
+        pwrs = self.rows[order, lowbin:highbin + 1].astype(np.float32)
+        if self.dtype == np.int8:
+            pwrs /= INT8_SCALE
+            pwrs += INT8_OFFSET
+
+        return self.times[order].copy(), pwrs
+
+    def flush(self):
+        self.mm.flush()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+# binary data-plane encoding
+#
+# Joshua Davis (gammarf -*- covert.codes)
+# http://gammarf.io
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import hmac
+import json
+import sys
+from collections import OrderedDict
+import numpy as np
+import zmq
+
+import gammarf_util
+
+AUTH_HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', 'u1'),
+    ('station_len', 'u1'), ('epoch', '<u4'), ('seq', '<u8'),
+    ('ts', '<f8'), ('mac', 'S32')])
+AUTH_KDF_ROUNDS = 100000
+AUTH_MAGIC = b'GRFA'
+AUTH_VERSION = 1
+LOC_FIELDS = ('lat', 'lng', 'alt', 'epx', 'epy', 'epv')
+MOD_NAME = "wire"
+WIRE_GROUP_DTYPE = np.dtype([('module', '<u2'), ('protocol', '<u2'),
+    ('count', '<u4')])
+WIRE_HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', 'u1'),
+    ('groups', 'u1'), ('station_len', '<u2'), ('dt', '<i8'),
+    ('rand', 'S8'), ('sign', 'S12'), ('lat', '<f8'), ('lng', '<f8'),
+    ('alt', '<f4'), ('epx', '<f4'), ('epy', '<f4'), ('epv', '<f4')])
+WIRE_MAGIC = b'GRFW'
+WIRE_VERSION = 1
+
+# record layouts by (MODULE_*, PROTOCOL_VERSION) of the sending module;
+# modules not listed here (or records that will not pack) go as json
+LAYOUTS = {
+    (1, 1): np.dtype([('dt', '<u4'), ('freq', '<i8'),  # scanner
+        ('pwr', '<f4')]),
+    (5, 1): np.dtype([('dt', '<u4'), ('snapshotid', 'S36'),  # snapshot
+        ('freq', '<i8'), ('pwr', '<f4')]),
+    (6, 1): np.dtype([('dt', '<u4'), ('freq', '<i8'),  # freqwatch
+        ('pwr', '<f4')]),
+    (9, 1): np.dtype([('dt', '<u4'), ('freq', '<i8'),  # single
+        ('thresh', '<f4'), ('pwr', '<f4')]),
+    }
+
+# usage: gammarf_wire.py addr [stationid station_pass]
+USAGE = "usage: {} addr [stationid station_pass] "\
+        "(e.g. tcp://127.0.0.1:9090)"
+
+
+def derive_key(station_pass, stationid):
+    """Batch signing key, derived once per run from the station pass"""
+    return hashlib.pbkdf2_hmac('sha256', station_pass.encode('utf-8'),
+            b'gammarf-data:' + stationid.encode('utf-8'), AUTH_KDF_ROUNDS)
+
+def auth_mac(key, header, station, frames):
+    mac = hmac.new(key, digestmod=hashlib.sha256)
+    header = header.copy()
+    header['mac'] = b''
+    mac.update(header.tobytes())
+    mac.update(station)
+    for frame in frames:
+        mac.update(frame)
+    return mac.digest()
+
+def auth_frame(key, stationid, epoch, seq, ts, frames):
+    """Frame to send ahead of frames, authenticating them
+
+    HMAC-SHA256, under the derived key, of this header (mac zeroed),
+    the station and every frame after it.  (epoch, seq) only ever
+    increases: epoch is the sender's start time and seq counts its
+    batches, so the server can refuse a batch it has seen.
+    """
+
+    station = stationid.encode('utf-8')
+    header = np.zeros(1, dtype=AUTH_HEADER_DTYPE)
+    header['magic'] = AUTH_MAGIC
+    header['version'] = AUTH_VERSION
+    header['station_len'] = len(station)
+    header['epoch'] = epoch
+    header['seq'] = seq
+    header['ts'] = ts
+    header['mac'] = auth_mac(key, header, station, frames)
+    return header.tobytes() + station
+
+def check_auth(frames, keys):
+    """(stationid, epoch, seq, ts) of an authenticated message, whose
+    station's key keys gives; raises if it does not verify"""
+
+    header = np.frombuffer(frames[0], dtype=AUTH_HEADER_DTYPE, count=1)
+    if header[0]['magic'] != AUTH_MAGIC:
+        raise Exception("not an authenticated message")
+
+    station = frames[0][AUTH_HEADER_DTYPE.itemsize:]
+    stationid = station.decode('utf-8')
+    mac = auth_mac(keys[stationid], header, station, frames[1:])
+    offset = AUTH_HEADER_DTYPE.fields['mac'][1]  # as sent: numpy would
+    sent = frames[0][offset:offset + len(mac)]  # strip trailing NULs
+    if not hmac.compare_digest(mac, sent):
+        raise Exception("bad signature from {}".format(stationid))
+
+    return stationid, int(header[0]['epoch']), int(header[0]['seq']),\
+            float(header[0]['ts'])
+
+def has_layout(data):
+    return (data.get('module'), data.get('protocol')) in LAYOUTS
+
+def encode_batch(records, stationid, context):
+    """One binary frame holding records (dicts with a layout)
+
+    The station, signature (dt, rand, sign) and location in context
+    are sent once, then one packed array per (module, protocol).
+    """
+
+    groups = OrderedDict()
+    for data in records:
+        groups.setdefault((data['module'], data['protocol']),
+                []).append(data)
+
+    station = stationid.encode('utf-8')
+    header = np.zeros(1, dtype=WIRE_HEADER_DTYPE)
+    header['magic'] = WIRE_MAGIC
+    header['version'] = WIRE_VERSION
+    header['groups'] = len(groups)
+    header['station_len'] = len(station)
+    header['dt'] = context['dt']
+    header['rand'] = context['rand'].encode('utf-8')
+    header['sign'] = context['sign'].encode('utf-8')
+    for field in LOC_FIELDS:
+        header[field] = float(context[field])
+
+    parts = [header.tobytes(), station]
+    for (module, protocol), group in groups.items():
+        layout = LAYOUTS[(module, protocol)]
+        recs = np.zeros(len(group), dtype=layout)
+        for field in layout.names:
+            recs[field] = [data[field] for data in group]
+
+        info = np.zeros(1, dtype=WIRE_GROUP_DTYPE)
+        info['module'] = module
+        info['protocol'] = protocol
+        info['count'] = len(group)
+        parts.append(info.tobytes())
+        parts.append(recs.tobytes())
+
+    return b''.join(parts)
+
+def decode_batch(frame):
+    """(context, records) from a binary frame, records as the dicts
+    senddat was given, stamped with station and location"""
+
+    header = np.frombuffer(frame, dtype=WIRE_HEADER_DTYPE, count=1)[0]
+    if header['magic'] != WIRE_MAGIC:
+        raise Exception("not a gammarf batch")
+    if header['version'] != WIRE_VERSION:
+        raise Exception("unsupported wire version: {}"
+                .format(header['version']))
+
+    offset = WIRE_HEADER_DTYPE.itemsize
+    station_len = int(header['station_len'])
+    context = {'stationid': frame[offset:offset + station_len]
+            .decode('utf-8'),
+            'dt': int(header['dt']),
+            'rand': header['rand'].decode('utf-8'),
+            'sign': header['sign'].decode('utf-8')}
+    for field in LOC_FIELDS:
+        context[field] = float(header[field])
+    offset += station_len
+
+    records = []
+    for _ in range(int(header['groups'])):
+        info = np.frombuffer(frame, dtype=WIRE_GROUP_DTYPE, count=1,
+                offset=offset)[0]
+        offset += WIRE_GROUP_DTYPE.itemsize
+
+        layout = LAYOUTS[(int(info['module']), int(info['protocol']))]
+        recs = np.frombuffer(frame, dtype=layout, count=int(info['count']),
+                offset=offset)
+        offset += recs.nbytes
+
+        for rec in recs.tolist():
+            data = {'module': int(info['module']),
+                    'protocol': int(info['protocol']),
+                    'stationid': context['stationid']}
+            for field in LOC_FIELDS:
+                data[field] = context[field]
+            for field, value in zip(layout.names, rec):
+                data[field] = value.decode('utf-8')\
+                        if isinstance(value, bytes) else value
+            records.append(data)
+
+    return context, records
+
+def decode_frame(frame):
+    """Records in a data frame, binary or json (one object or a list)"""
+
+    if frame[:len(WIRE_MAGIC)] == WIRE_MAGIC:
+        return decode_batch(frame)[1]
+
+    records = json.loads(frame.decode('utf-8'))
+    return records if isinstance(records, list) else [records]
+
+
+def main(argv):
+    """Stand in for the server's data port: print each record received"""
+
+    if len(argv) not in (2, 4):
+        print(USAGE.format(argv[0]))
+        return 1
+
+    keys = {}
+    if len(argv) == 4:  # check batch signatures
+        keys[argv[2]] = derive_key(argv[3], argv[2])
+
+    sock = zmq.Context.instance().socket(zmq.PULL)
+    sock.bind(argv[1])
+
+    while True:
+        frames = sock.recv_multipart()
+        if frames[0][:len(AUTH_MAGIC)] == AUTH_MAGIC:
+            if keys:
+                try:
+                    stationid, epoch, seq, ts = check_auth(frames, keys)
+                except Exception as e:
+                    gammarf_util.console_message("rejected: {}".format(e),
+                            MOD_NAME)
+                    continue
+            frames = frames[1:]
+
+        for data in decode_frame(frames[0]):
+            gammarf_util.console_message("{}{}".format(data,
+                " (+{} byte payload)".format(len(frames[1]))
+                if len(frames) > 1 else ""), MOD_NAME)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))